@@ -2,18 +2,151 @@ import json
 import math
 import random
 import os
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import urllib.parse as urlparse
-from PIL import Image, ImageDraw  # Стандартной библиотекой PIL не является, но часто идёт как Pillow.
+from collections import OrderedDict
+import numpy as np
+from PIL import Image  # Стандартной библиотекой PIL не является, но часто идёт как Pillow.
                                  # Если Pillow тоже считать "внешней" – тогда придётся писать свой модуль
                                  # для работы с изображениями. Здесь оставим для наглядности.
 
+##############################################################################
+# КЭШ ФОНОВЫХ ИЗОБРАЖЕНИЙ
+##############################################################################
+
+# Сколько байт декодированных фонов (RGBA) держим в памяти
+BACKGROUND_CACHE_BYTES = 512 * 1024 * 1024
+
+
+class BackgroundCache:
+    """
+    LRU декодированных фонов (RGBA). Запись сбрасывается, если у файла
+    изменились mtime или размер, поэтому PNG декодируется один раз на версию
+    фона, а не на каждую комбинацию параметров карты.
+    """
+
+    def __init__(self, max_bytes=BACKGROUND_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # путь -> (mtime_ns, размер файла, Image)
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+                self.entries.move_to_end(path)
+                return entry[2]
+
+        with Image.open(path) as image:
+            background = image.convert("RGBA")
+        nbytes = background.width * background.height * 4
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.size -= old[2].width * old[2].height * 4
+            if nbytes <= self.max_bytes:
+                self.entries[path] = (stat.st_mtime_ns, stat.st_size, background)
+                self.size += nbytes
+                while self.size > self.max_bytes:
+                    _, (_, _, evicted) = self.entries.popitem(last=False)
+                    self.size -= evicted.width * evicted.height * 4
+        return background
+
+
+##############################################################################
+# ВЫЧИСЛЕНИЕ ПЛОТНОСТИ (KDE)
+##############################################################################
+
+# Ограничение на размер промежуточной матрицы ядра (в элементах float64)
+KDE_BATCH_ELEMENTS = 1 << 22
+
+
+def kde_density_grid(points, img_width, img_height, bandwidth, grid_spacing):
+    """
+    Brute-force KDE по всем точкам без циклов Python по ячейкам.
+    Гауссово ядро сепарабельно: exp(-(dx^2+dy^2)/2h^2) = gy(dy) * gx(dx),
+    поэтому сетка плотности равна Ky @ Kx.T (считаем пачками точек).
+    Возвращает двумерный массив float64 формы (grid_h, grid_w).
+    """
+    if bandwidth <= 0:
+        bandwidth = 1.0
+    grid_w = int(img_width / grid_spacing)
+    grid_h = int(img_height / grid_spacing)
+    density = np.zeros((grid_h, grid_w), dtype=np.float64)
+    if grid_w == 0 or grid_h == 0:
+        return density
+
+    coords = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    xs = np.ascontiguousarray(coords[:, 0])
+    ys = np.ascontiguousarray(coords[:, 1])
+    x_centers = np.arange(grid_w) * grid_spacing + grid_spacing / 2
+    y_centers = np.arange(grid_h) * grid_spacing + grid_spacing / 2
+    inv_two_h2 = 1.0 / (2 * bandwidth * bandwidth)
+    batch = max(1, KDE_BATCH_ELEMENTS // (grid_w + grid_h))
+
+    for start in range(0, len(xs), batch):
+        dx = x_centers[:, None] - xs[None, start:start + batch]
+        dy = y_centers[:, None] - ys[None, start:start + batch]
+        density += np.exp(-(dy * dy) * inv_two_h2) @ np.exp(-(dx * dx) * inv_two_h2).T
+
+    density *= 1.0 / (2 * math.pi * bandwidth * bandwidth)
+    return density
+
+
 ##############################################################################
 # МОДУЛЬ БИЗНЕС-ЛОГИКИ: работа с данными, генерация тепловых карт
 ##############################################################################
 
+# Декодированные фоны процесса-отрисовщика (у каждого процесса пула свой кэш)
+WORKER_BACKGROUNDS = BackgroundCache()
+
+
+def render_heatmap(points, bg_path, bandwidth, grid_spacing, out_path):
+    """
+    Отрисовка тепловой карты в процессе пула: KDE по снимку точек,
+    наложение на фон и сохранение PNG в out_path.
+    """
+    # alpha_composite возвращает новое изображение, кэшированный фон не меняется
+    background = WORKER_BACKGROUNDS.get(bg_path)
+    img_width, img_height = background.size
+
+    # 1) Формируем сетку
+    grid_w = int(img_width / grid_spacing)
+    grid_h = int(img_height / grid_spacing)
+
+    # 2) Brute-force KDE: векторизованно, пачками точек
+    density_grid = kde_density_grid(points, img_width, img_height, bandwidth, grid_spacing)
+
+    # 3) Нормализация
+    normalized_grid = HeatmapService.normalize_density_grid(density_grid)
+
+    # 4) Создаём heatmap-слой
+    # Сетка -> RGBA-буфер (ячейка = пиксель) -> один resize вместо цикла прямоугольников
+    heatmap = Image.new("RGBA", (img_width, img_height), (0, 0, 0, 0))
+    if grid_h > 0 and grid_w > 0:
+        buffer = np.empty((grid_h, grid_w, 4), dtype=np.uint8)
+        buffer[..., :3] = (255, 0, 0)
+        buffer[..., 3] = np.asarray(normalized_grid, dtype=np.uint8)
+        cells = Image.frombuffer("RGBA", (grid_w, grid_h), buffer, "raw", "RGBA", 0, 1)
+        size = (min(img_width, int(round(grid_w * grid_spacing))),
+                min(img_height, int(round(grid_h * grid_spacing))))
+        heatmap.paste(cells.resize(size, Image.Resampling.NEAREST), (0, 0))
+
+    # 5) Альфа-композиция
+    result_image = Image.alpha_composite(background, heatmap)
+
+    # 6) Сохраняем в файл (кэш)
+    result_image.save(out_path)
+    return out_path
+
+
 class HeatmapService:
-    def __init__(self):
+    def __init__(self, workers=1):
         """
         Инициализация сервиса. Можно подключиться к БД, загрузить кэш и т.д.
         """
@@ -25,32 +158,47 @@ class HeatmapService:
         # Храним "сырые" данные взглядов тоже в памяти (page_id -> список точек)
         self.raw_data = {}
 
+        # Запросы обрабатываются в потоках: raw_data и cache меняем только под замком
+        self.lock = threading.Lock()
+
+        # Пул процессов для KDE; создаётся при первой отрисовке
+        self.workers = workers
+        self.pool = None
+
         # Папка для сохранения сгенерированных тепловых карт
         self.cache_dir = "cache_images"
         if not os.path.exists(self.cache_dir):
             os.makedirs(self.cache_dir)
 
+    def render_pool(self):
+        with self.lock:
+            if self.pool is None:
+                # spawn: fork процесса с потоками сервера небезопасен
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+            return self.pool
+
     def store_raw_data(self, page_id, points):
         """
         Сохранить сырые данные (список координат) для заданной страницы page_id.
         Здесь можно было бы обращаться к БД.
         """
-        if page_id not in self.raw_data:
-            self.raw_data[page_id] = []
-        self.raw_data[page_id].extend(points)  # добавляем точки
+        with self.lock:
+            if page_id not in self.raw_data:
+                self.raw_data[page_id] = []
+            self.raw_data[page_id].extend(points)  # добавляем точки
 
     def generate_heatmap(self, page_id, bandwidth, grid_spacing):
         """
         Генерация тепловой карты (простейший вариант) для указанных параметров.
         Возвращает путь к PNG-файлу с тепловой картой.
         """
-        # Проверяем кэш
-        cache_key = f"{page_id}_{bandwidth}_{grid_spacing}"
-        if cache_key in self.cache:
-            return self.cache[cache_key]
-
-        # Если нет в кэше, нужно сгенерировать
-        points = self.raw_data.get(page_id, [])
+        # Проверяем кэш и снимаем копию точек: загрузки из других потоков её не меняют
+        cache_key = self.make_cache_key(page_id, bandwidth, grid_spacing)
+        with self.lock:
+            if cache_key in self.cache:
+                return self.cache[cache_key]
+            points = list(self.raw_data.get(page_id, []))
         if not points:
             # Нет данных
             return None
@@ -61,54 +209,30 @@ class HeatmapService:
             # В реальном решении нужно вернуть ошибку или использовать заглушку
             return None
 
-        background = Image.open(bg_path).convert("RGBA")
-        img_width, img_height = background.size
-
-        # 1) Формируем сетку
-        grid_w = int(img_width / grid_spacing)
-        grid_h = int(img_height / grid_spacing)
-        density_grid = [[0.0 for _ in range(grid_w)] for _ in range(grid_h)]
-
-        # 2) Простейший brute-force KDE (без оптимизаций, только для демонстрации)
-        for i in range(grid_h):
-            y_center = i * grid_spacing + grid_spacing / 2
-            for j in range(grid_w):
-                x_center = j * grid_spacing + grid_spacing / 2
-                density = 0.0
-                for (px, py) in points:
-                    dx = x_center - px
-                    dy = y_center - py
-                    dist_sq = dx*dx + dy*dy
-                    density += self.gaussian_kernel(dist_sq, bandwidth)
-                density_grid[i][j] = density
-
-        # 3) Нормализация
-        normalized_grid = self.normalize_density_grid(density_grid)
-
-        # 4) Создаём heatmap-слой
-        heatmap = Image.new("RGBA", (img_width, img_height), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(heatmap)
-        for i in range(grid_h):
-            for j in range(grid_w):
-                intensity = normalized_grid[i][j]
-                color = (255, 0, 0, intensity)
-                x0 = int(j * grid_spacing)
-                y0 = int(i * grid_spacing)
-                x1 = int((j+1) * grid_spacing)
-                y1 = int((i+1) * grid_spacing)
-                draw.rectangle([x0, y0, x1, y1], fill=color)
-
-
-# 5) Альфа-композиция
-        result_image = Image.alpha_composite(background, heatmap)
-
-        # 6) Сохраняем в файл (кэш)
+        # В процесс пула передаём массив координат, а не список списков
+        coords = np.asarray(points, dtype=np.float64).reshape(-1, 2)
         out_path = os.path.join(self.cache_dir, f"heatmap_{cache_key}.png")
-        result_image.save(out_path)
+        self.render_pool().submit(
+            render_heatmap, coords, bg_path, bandwidth, grid_spacing, out_path).result()
 
-        self.cache[cache_key] = out_path
+        with self.lock:
+            self.cache[cache_key] = out_path
         return out_path
 
+    @staticmethod
+    def make_cache_key(page_id, bandwidth, grid_spacing):
+        """
+        Ключ кэша для комбинации параметров.
+        """
+        return f"{page_id}_{bandwidth}_{grid_spacing}"
+
+    def cached_heatmap(self, page_id, bandwidth, grid_spacing):
+        """
+        Путь к готовой тепловой карте из кэша или None (без вычислений).
+        """
+        with self.lock:
+            return self.cache.get(self.make_cache_key(page_id, bandwidth, grid_spacing))
+
     @staticmethod
     def gaussian_kernel(dist_sq, bandwidth):
         """
@@ -123,17 +247,12 @@ class HeatmapService:
         """
         Нормируем значения в диапазон [0..255].
         """
-        flat_vals = [val for row in density_grid for val in row]
-        min_val = min(flat_vals)
-        max_val = max(flat_vals)
+        density_grid = np.asarray(density_grid, dtype=np.float64)
+        min_val = density_grid.min()
+        max_val = density_grid.max()
         if max_val - min_val == 0:
-            return [[0 for _ in row] for row in density_grid]
-        norm = []
-        for row in density_grid:
-            norm.append([
-                int(255*(v - min_val)/(max_val - min_val)) for v in row
-            ])
-        return norm
+            return np.zeros(density_grid.shape, dtype=np.uint8).tolist()
+        return (255*(density_grid - min_val)/(max_val - min_val)).astype(np.uint8).tolist()
     
 
 
@@ -145,11 +264,19 @@ class HeatmapService:
 # МОДУЛЬ ВЕБ-СЕРВЕРА: принимаем HTTP-запросы, вызываем бизнес-логику
 ##############################################################################
 
+# Сколько тяжёлых отрисовок может идти одновременно (= процессов в пуле);
+# остальные запросы без готового результата получают 503
+MAX_CONCURRENT_RENDERS = int(os.environ.get("RENDER_WORKERS", os.cpu_count() or 1))
+# Через сколько секунд клиенту предлагается повторить запрос
+RETRY_AFTER_SECONDS = 2
+
 class SimpleRequestHandler(BaseHTTPRequestHandler):
     # Создаём единый экземпляр сервиса (HeatmapService)
     # В реальном решении лучше инициализировать в main() и передавать сюда,
     # но для демонстрации сделаем статическую переменную.
-    service = HeatmapService()
+    service = HeatmapService(workers=MAX_CONCURRENT_RENDERS)
+    # Слоты для отрисовок: кэш-хиты и загрузки их не занимают
+    render_slots = threading.BoundedSemaphore(MAX_CONCURRENT_RENDERS)
 
     def do_GET(self):
         """
@@ -164,8 +291,21 @@ class SimpleRequestHandler(BaseHTTPRequestHandler):
             bandwidth = float(query.get("bandwidth", [10])[0])
             grid = float(query.get("grid", [15])[0])
 
-            # Генерируем тепловую карту
-            result_path = self.service.generate_heatmap(page_id, bandwidth, grid)
+            # Сначала кэш: готовый результат отдаём сразу
+            result_path = self.service.cached_heatmap(page_id, bandwidth, grid)
+            if result_path is None:
+                if not self.render_slots.acquire(blocking=False):
+                    # Все слоты заняты - просим повторить позже
+                    self.send_response(503)
+                    self.send_header("Retry-After", str(RETRY_AFTER_SECONDS))
+                    self.end_headers()
+                    self.wfile.write(b"Server is busy, retry later.")
+                    return
+                try:
+                    # Генерируем тепловую карту
+                    result_path = self.service.generate_heatmap(page_id, bandwidth, grid)
+                finally:
+                    self.render_slots.release()
             if result_path and os.path.exists(result_path):
                 # Отдаём файл (image/png)
                 self.send_response(200)
@@ -218,9 +358,10 @@ class SimpleRequestHandler(BaseHTTPRequestHandler):
 
 def run_server(host="0.0.0.0", port=8080):
     """
-    Запуск простого HTTP-сервера.
+    Запуск многопоточного HTTP-сервера: каждый запрос обрабатывается
+    в своём потоке, поэтому долгая отрисовка не блокирует остальных клиентов.
     """
-    httpd = HTTPServer((host, port), SimpleRequestHandler)
+    httpd = ThreadingHTTPServer((host, port), SimpleRequestHandler)
     print(f"Server started at http://{host}:{port}")
     httpd.serve_forever()
 
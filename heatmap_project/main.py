@@ -3,6 +3,7 @@ import math
 import random
 import time
 
+import numpy as np
 from PIL import Image, ImageDraw
 
 
@@ -10,6 +11,7 @@ from PIL import Image, ImageDraw
 math – для математических функций (exp, pi, cos, sin и т.д.).
 random – для генерации случайных чисел (понадобится в случайном блуждании).
 time – для замера времени (сравнение производительности).
+numpy – для векторизованного вычисления KDE (массивы координат и пакетная математика).
 PIL (Pillow) – для загрузки, создания и сохранения изображений (формат PNG, наложение тепловой карты).
 
 '''
@@ -33,23 +35,25 @@ def load_background_image(image_path):
 
 # Шаг 3. Генерация данных методом случайного блуждания
 
-def generate_random_walk_data(width, height, num_walkers, points_per_walker, step_size):
+def generate_random_walk_data(width, height, num_walkers, points_per_walker, step_size, seed=None):
     """
     Генерирует набор точек (x, y) с помощью случайного блуждания.
     Параметры:
       width, height       - размеры области (в пикселях);
       num_walkers         - количество "респондентов";
       points_per_walker   - сколько точек генерируется для каждого респондента;
-      step_size           - шаг смещения при блуждании.
+      step_size           - шаг смещения при блуждании;
+      seed                - зерно генератора (одинаковое зерно - одинаковые точки).
     Возвращает список кортежей (x, y).
     """
+    rng = random.Random(seed)
     all_points = []
     for _ in range(num_walkers):
         # Начинаем с случайной позиции внутри [0, width] × [0, height]
-        x = random.uniform(0, width)
-        y = random.uniform(0, height)
+        x = rng.uniform(0, width)
+        y = rng.uniform(0, height)
         for _ in range(points_per_walker):
-            angle = random.uniform(0, 2 * math.pi)  # случайный угол
+            angle = rng.uniform(0, 2 * math.pi)  # случайный угол
             dx = step_size * math.cos(angle)
             dy = step_size * math.sin(angle)
             # Обновляем x, y, следя, чтобы не выйти за границы
@@ -171,6 +175,132 @@ def kde_accumulate(points, width, height, bandwidth, grid_spacing):
 '''
 
 
+# Шаг 6.1. Метод 3: векторизованный KDE (NumPy)
+
+# Ограничение на размер промежуточной матрицы ядра (в элементах float64)
+KDE_BATCH_ELEMENTS = 1 << 22
+
+
+def kde_vectorized(points, width, height, bandwidth, grid_spacing):
+    """
+    Тот же результат, что и kde_brute_force, но без циклов Python по ячейкам и точкам.
+    Точки хранятся в непрерывных массивах float64, а гауссово ядро раскладывается
+    на множители: exp(-(dx^2 + dy^2) / 2h^2) = gy(dy) * gx(dx).
+    Тогда density = Ky @ Kx.T, где Ky[i, p] = gy(y_i - y_p), Kx[j, p] = gx(x_j - x_p).
+    Точки обрабатываются пачками, чтобы матрицы Ky и Kx помещались в память.
+    Возвращает массив numpy формы (grid_h, grid_w).
+    """
+    grid_w = int(width / grid_spacing)
+    grid_h = int(height / grid_spacing)
+    density_grid = np.zeros((grid_h, grid_w), dtype=np.float64)
+    if grid_w == 0 or grid_h == 0:
+        return density_grid
+
+    coords = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    xs = np.ascontiguousarray(coords[:, 0])
+    ys = np.ascontiguousarray(coords[:, 1])
+
+    # Центры ячеек по горизонтали и вертикали
+    x_centers = np.arange(grid_w) * grid_spacing + grid_spacing / 2
+    y_centers = np.arange(grid_h) * grid_spacing + grid_spacing / 2
+    inv_two_h2 = 1.0 / (2 * bandwidth * bandwidth)
+    batch = max(1, KDE_BATCH_ELEMENTS // (grid_w + grid_h))
+
+    for start in range(0, len(xs), batch):
+        dx = x_centers[:, None] - xs[None, start:start + batch]
+        dy = y_centers[:, None] - ys[None, start:start + batch]
+        density_grid += np.exp(-(dy * dy) * inv_two_h2) @ np.exp(-(dx * dx) * inv_two_h2).T
+
+    density_grid *= 1.0 / (2 * math.pi * bandwidth * bandwidth)
+    return density_grid
+
+
+def max_relative_error(reference_grid, density_grid):
+    """
+    Максимальное отклонение density_grid от эталонной сетки,
+    отнесённое к максимуму эталона (для проверки совпадения методов).
+    """
+    reference = np.asarray(reference_grid, dtype=np.float64)
+    candidate = np.asarray(density_grid, dtype=np.float64)
+    scale = np.abs(reference).max()
+    if scale == 0:
+        return float(np.abs(candidate).max())
+    return float(np.abs(candidate - reference).max() / scale)
+
+
+'''
+Сложность по-прежнему ~O(M * N), но внутренний цикл выполняется в NumPy (BLAS),
+а экспонента считается только (grid_w + grid_h) * N раз вместо grid_w * grid_h * N.
+'''
+
+
+# Шаг 6.2. Метод 4: биннинг + свёртка через FFT
+
+# Ядро обрезается на таком числе bandwidth
+FFT_KERNEL_SIGMAS = 5
+# Сколько бинов должно приходиться на один bandwidth
+FFT_BINS_PER_BANDWIDTH = 2
+
+
+def kde_binned_fft(points, width, height, bandwidth, grid_spacing):
+    """
+    Приближённый KDE в два этапа:
+      1) линейный биннинг: каждая точка делит единичный вес между
+         четырьмя ближайшими центрами бинов (билинейные веса);
+      2) свёртка полученной сетки с гауссовым ядром через FFT.
+    Если ячейка крупнее bandwidth / FFT_BINS_PER_BANDWIDTH, каждая ячейка делится
+    на sub x sub бинов (sub нечётное), а плотность берётся в центральных бинах.
+    Сетка дополняется pad бинами с каждой стороны, чтобы учесть точки у краёв,
+    и нулями до полного размера свёртки, чтобы свёртка не была циклической.
+    Возвращает массив numpy формы (grid_h, grid_w).
+    """
+    grid_w = int(width / grid_spacing)
+    grid_h = int(height / grid_spacing)
+    if grid_w == 0 or grid_h == 0:
+        return np.zeros((grid_h, grid_w), dtype=np.float64)
+
+    coords = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    sub = max(1, int(math.ceil(FFT_BINS_PER_BANDWIDTH * grid_spacing / bandwidth)) | 1)
+    spacing = grid_spacing / sub
+    pad = int(math.ceil(FFT_KERNEL_SIGMAS * bandwidth / spacing))
+    ext_h, ext_w = grid_h * sub + 2 * pad, grid_w * sub + 2 * pad
+
+    # 1) Линейный биннинг (координаты в единицах бинов относительно их центров)
+    fx = coords[:, 0] / spacing - 0.5 + pad
+    fy = coords[:, 1] / spacing - 0.5 + pad
+    j0 = np.floor(fx)
+    i0 = np.floor(fy)
+    tx = fx - j0
+    ty = fy - i0
+    j0 = j0.astype(np.int64)
+    i0 = i0.astype(np.int64)
+    keep = (j0 >= 0) & (j0 + 1 < ext_w) & (i0 >= 0) & (i0 + 1 < ext_h)
+    j0, i0, tx, ty = j0[keep], i0[keep], tx[keep], ty[keep]
+    base = i0 * ext_w + j0
+    indices = np.concatenate((base, base + 1, base + ext_w, base + ext_w + 1))
+    weights = np.concatenate(((1 - ty) * (1 - tx), (1 - ty) * tx, ty * (1 - tx), ty * tx))
+    binned = np.bincount(indices, weights=weights, minlength=ext_h * ext_w).reshape(ext_h, ext_w)
+
+    # 2) Свёртка с предвычисленным ядром
+    offsets = np.arange(-pad, pad + 1) * spacing
+    profile = np.exp(-(offsets * offsets) / (2 * bandwidth * bandwidth))
+    kernel = np.outer(profile, profile)
+    shape = (ext_h + 2 * pad, ext_w + 2 * pad)
+    full = np.fft.irfft2(np.fft.rfft2(binned, shape) * np.fft.rfft2(kernel, shape), shape)
+
+    # Центр ячейки i совпадает с центром бина i*sub + sub//2
+    start = 2 * pad + sub // 2
+    density_grid = full[start:start + grid_h * sub:sub, start:start + grid_w * sub:sub]
+    return np.maximum(density_grid, 0.0) / (2 * math.pi * bandwidth * bandwidth)
+
+
+'''
+Сложность ~O(N + M log M): биннинг линеен по числу точек, а свёртка
+зависит только от размера сетки. Точность падает, если бин
+сравним с bandwidth (ошибка биннинга), поэтому крупные ячейки дробятся.
+'''
+
+
 # Шаг 7. Нормализация плотностей
 
 def normalize_density_grid(density_grid):
@@ -205,10 +335,11 @@ def normalize_density_grid(density_grid):
 # Шаг 8. Создание изображения тепловой карты
 
 
-def create_heatmap_image(normalized_grid, grid_spacing, width, height):
+def create_heatmap_image_rectangles(normalized_grid, grid_spacing, width, height):
     """
     Создаёт полупрозрачное изображение (RGBA), где каждая ячейка сетки закрашена
     в красный цвет с интенсивностью, зависящей от нормализованного значения.
+    Эталонная версия: по одному вызову draw.rectangle на ячейку.
     """
     heatmap = Image.new("RGBA", (width, height), (0, 0, 0, 0))
     draw = ImageDraw.Draw(heatmap)
@@ -240,6 +371,44 @@ Image.new("RGBA", ...) создаёт пустое полупрозрачное
 '''
 
 
+# Шаг 8.1. Быстрая отрисовка одним буфером
+
+RESAMPLE_METHODS = {
+    "nearest": Image.Resampling.NEAREST,
+    "bilinear": Image.Resampling.BILINEAR,
+}
+
+
+def create_heatmap_image(normalized_grid, grid_spacing, width, height, resample="nearest"):
+    """
+    То же, что create_heatmap_image_rectangles, но без цикла по ячейкам:
+    сетка собирается в RGBA-буфер (одна ячейка - один пиксель), превращается
+    в изображение через Image.frombuffer и растягивается одним resize.
+    resample="bilinear" даёт плавные переходы между ячейками.
+    """
+    heatmap = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    alpha = np.asarray(normalized_grid, dtype=np.uint8)
+    if alpha.size == 0:
+        return heatmap
+    grid_h, grid_w = alpha.shape
+
+    buffer = np.empty((grid_h, grid_w, 4), dtype=np.uint8)
+    buffer[..., :3] = (255, 0, 0)
+    buffer[..., 3] = alpha
+    cells = Image.frombuffer("RGBA", (grid_w, grid_h), buffer, "raw", "RGBA", 0, 1)
+
+    size = (min(width, int(round(grid_w * grid_spacing))),
+            min(height, int(round(grid_h * grid_spacing))))
+    heatmap.paste(cells.resize(size, RESAMPLE_METHODS[resample]), (0, 0))
+    return heatmap
+
+'''
+Цикл с draw.rectangle стоит O(число ячеек) вызовов Python; здесь вся
+работа - в одном resize внутри Pillow, поэтому на мелкой сетке разница
+в десятки раз (см. замер в main()).
+'''
+
+
 
 
 # Шаг 9. Наложение тепловой карты на фон
@@ -278,6 +447,10 @@ def main():
     step_size = float(os.getenv("STEP_SIZE", 5.0))
     bandwidth = float(os.getenv("BANDWIDTH", 10.0))
     grid_spacing = float(os.getenv("GRID_SPACING", 10.0))
+    kde_method = os.getenv("KDE_METHOD", "accumulate")
+    resample = os.getenv("RESAMPLE", "nearest")
+    seed = os.getenv("SEED")
+    seed = int(seed) if seed else None
 
 
 
@@ -286,7 +459,8 @@ def main():
 
     # 2. Генерация данных случайного блуждания
     start_time = time.time()
-    points = generate_random_walk_data(width, height, num_walkers, points_per_walker, step_size)
+    points = generate_random_walk_data(width, height, num_walkers, points_per_walker, step_size,
+                                       seed)
     gen_time = time.time() - start_time
     print(f"Сгенерировано {len(points)} точек за {gen_time:.2f} сек")
 
@@ -302,15 +476,43 @@ def main():
     acc_time = time.time() - start_time
     print(f"Accumulate завершён за {acc_time:.2f} сек")
 
-    # Выбираем, какую карту визуализировать (brute или accumulate)
-    # Для наглядности используем accumulate
-    density_grid = density_grid_acc
+    # 4.1. Вычисление плотности векторизованным методом
+    start_time = time.time()
+    density_grid_vec = kde_vectorized(points, width, height, bandwidth, grid_spacing)
+    vec_time = time.time() - start_time
+    print(f"Vectorized завершён за {vec_time:.2f} сек")
+
+    # 4.2. Вычисление плотности методом биннинга + FFT
+    start_time = time.time()
+    density_grid_fft = kde_binned_fft(points, width, height, bandwidth, grid_spacing)
+    fft_time = time.time() - start_time
+    print(f"Binned FFT завершён за {fft_time:.2f} сек")
+
+    # Выбираем, какую карту визуализировать (KDE_METHOD в .env)
+    # По умолчанию для наглядности используем accumulate
+    density_grids = {
+        "brute": density_grid_brute,
+        "accumulate": density_grid_acc,
+        "vectorized": density_grid_vec,
+        "fft": density_grid_fft,
+    }
+    if kde_method not in density_grids:
+        raise ValueError(f"Неизвестный KDE_METHOD: {kde_method}")
+    density_grid = density_grids[kde_method]
 
     # 5. Нормализация
     normalized_grid = normalize_density_grid(density_grid)
 
-    # 6. Создание тепловой карты
-    heatmap = create_heatmap_image(normalized_grid, grid_spacing, width, height)
+    # 6. Создание тепловой карты (сравниваем отрисовку прямоугольниками и буфером)
+    start_time = time.time()
+    create_heatmap_image_rectangles(normalized_grid, grid_spacing, width, height)
+    rect_time = time.time() - start_time
+    print(f"Отрисовка прямоугольниками завершена за {rect_time:.3f} сек")
+
+    start_time = time.time()
+    heatmap = create_heatmap_image(normalized_grid, grid_spacing, width, height, resample)
+    raster_time = time.time() - start_time
+    print(f"Отрисовка буфером ({resample}) завершена за {raster_time:.3f} сек")
 
     # 7. Наложение тепловой карты на исходное изображение
     result_image = overlay_heatmap(background, heatmap)
@@ -323,6 +525,14 @@ def main():
     print(f"\nСравнение времени вычисления KDE:")
     print(f" - Brute force: {brute_time:.2f} сек")
     print(f" - Accumulate:  {acc_time:.2f} сек")
+    print(f" - Vectorized:  {vec_time:.2f} сек")
+    print(f" - Binned FFT:  {fft_time:.2f} сек")
+
+    # Проверка совпадения результатов
+    print(f"\nОтклонение от brute force (отн. к максимуму плотности):")
+    print(f" - Accumulate:  {max_relative_error(density_grid_brute, density_grid_acc):.2e}")
+    print(f" - Vectorized:  {max_relative_error(density_grid_brute, density_grid_vec):.2e}")
+    print(f" - Binned FFT:  {max_relative_error(density_grid_brute, density_grid_fft):.2e}")
 
 if __name__ == "__main__":
     main()
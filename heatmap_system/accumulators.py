@@ -0,0 +1,65 @@
+import threading
+from collections import deque
+
+import numpy as np
+
+from kde_engine import INCREMENTAL_METHODS, KDE_METHODS, as_point_arrays, grid_shape
+
+
+class DensityAccumulator:
+    """
+    Сетка плотности для одной комбинации (bandwidth, grid_spacing, method),
+    которая обновляется при загрузке новых точек, а не пересчитывается целиком.
+    KDE линеен по точкам, поэтому вклад новой партии просто прибавляется:
+    для accumulate - только в окрестности точек, для остальных методов -
+    сеткой, посчитанной по одной новой партии.
+    """
+
+    def __init__(self, width, height, bandwidth, grid_spacing, method):
+        self.width = width
+        self.height = height
+        self.bandwidth = bandwidth
+        self.grid_spacing = grid_spacing
+        self.method = method
+        self.density = np.zeros(grid_shape(width, height, grid_spacing), dtype=np.float64)
+        self.num_points = 0
+        # Партии, поставленные в очередь под блокировкой сервиса (queue), прибавляются
+        # позже (sync) - в порядке загрузки, кто бы из потоков ни забрал их первым
+        self.pending = deque()
+        self.lock = threading.Lock()
+
+    def queue(self, points):
+        self.pending.append(points)
+
+    def sync(self):
+        with self.lock:
+            self._drain()
+
+    def snapshot(self, num_points):
+        """
+        Копия сетки, если в ней учтено ровно num_points точек, иначе None.
+        """
+        with self.lock:
+            self._drain()
+            if self.num_points != num_points:
+                return None
+            return self.density.copy()
+
+    def _drain(self):
+        while self.pending:
+            self.add(self.pending.popleft())
+
+    def add(self, points):
+        xs, ys = as_point_arrays(points)
+        if len(xs) == 0:
+            return
+        add_into = INCREMENTAL_METHODS.get(self.method)
+        if add_into is not None:
+            add_into(self.density, xs, ys, self.bandwidth, self.grid_spacing)
+        else:
+            self.density += KDE_METHODS[self.method](
+                xs, ys, self.width, self.height, self.bandwidth, self.grid_spacing)
+        self.num_points += len(xs)
+
+    def matches(self, width, height):
+        return self.width == width and self.height == height
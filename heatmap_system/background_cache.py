@@ -0,0 +1,150 @@
+import os
+import threading
+import urllib.parse as urlparse
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from grid_cache import GRID_FILE_SUFFIX, load_grid
+
+BACKGROUND_CACHE_BYTES = 512 * 1024 * 1024
+
+
+def decode_background(path):
+    """
+    Декодирует фон в массив RGBA формы (height, width, 4), uint8.
+    """
+    with Image.open(path) as image:
+        return np.asarray(image.convert("RGBA"))
+
+
+def background_image(pixels):
+    """
+    Image поверх массива RGBA без копирования пикселей.
+    """
+    height, width = pixels.shape[:2]
+    return Image.frombuffer("RGBA", (width, height), pixels, "raw", "RGBA", 0, 1)
+
+
+class BackgroundCache:
+    """
+    Декодированные фоновые изображения (RGBA) в LRU с ограничением по байтам.
+    Запись действительна, пока не изменились mtime и размер файла фона.
+    С sidecar_dir рядом хранится сырой RGBA в .npy (mtime сайдкара равен
+    mtime фона): его открывают через mmap, в том числе воркеры отрисовки,
+    так что PNG декодируется один раз на версию фона.
+    """
+
+    def __init__(self, max_bytes=BACKGROUND_CACHE_BYTES, sidecar_dir=None):
+        self.max_bytes = max_bytes
+        self.sidecar_dir = sidecar_dir
+        self.entries = OrderedDict()  # путь -> (отметка файла, пиксели)
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.decodes = 0
+        self.sidecar_loads = 0
+        self.evictions = 0
+        if sidecar_dir is not None:
+            os.makedirs(sidecar_dir, exist_ok=True)
+
+    def sidecar_path(self, path):
+        if self.sidecar_dir is None:
+            return None
+        return os.path.join(self.sidecar_dir, urlparse.quote(path, safe="") + GRID_FILE_SUFFIX)
+
+    def get(self, path):
+        """
+        Пиксели фона (массив RGBA только для чтения).
+        FileNotFoundError, если файла фона нет.
+        """
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == stamp:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+
+        pixels = self._load_sidecar(path, stat)
+        if pixels is None:
+            pixels = decode_background(path)
+            pixels.flags.writeable = False
+            self._save_sidecar(path, stat, pixels)
+            with self.lock:
+                self.decodes += 1
+        else:
+            with self.lock:
+                self.sidecar_loads += 1
+        self._put(path, stamp, pixels)
+        return pixels
+
+    def _load_sidecar(self, path, stat):
+        sidecar = self.sidecar_path(path)
+        if sidecar is None:
+            return None
+        try:
+            if os.stat(sidecar).st_mtime_ns != stat.st_mtime_ns:
+                return None
+            return load_grid(sidecar)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _save_sidecar(self, path, stat, pixels):
+        sidecar = self.sidecar_path(path)
+        if sidecar is None:
+            return
+        tmp_path = f"{sidecar}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, pixels)
+        # Отметка действительности сайдкара - mtime исходного файла
+        os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(tmp_path, sidecar)
+
+    def _put(self, path, stamp, pixels):
+        with self.lock:
+            self._discard(path)
+            if pixels.nbytes > self.max_bytes:
+                return
+            self.entries[path] = (stamp, pixels)
+            self.size += pixels.nbytes
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted.nbytes
+                self.evictions += 1
+
+    def _discard(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size -= entry[1].nbytes
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "decodes": self.decodes,
+                "sidecar_loads": self.sidecar_loads,
+                "evictions": self.evictions,
+            }
+
+
+# Кэш процесса: воркеры пула отрисовки без сайдкаров декодируют фон
+# один раз на процесс, а не на каждую комбинацию параметров
+BACKGROUNDS = BackgroundCache()
+
+
+def load_background(bg_path, sidecar_path=None):
+    """
+    Фон для отрисовки: из сайдкара (mmap), если он передан, иначе из кэша процесса.
+    """
+    if sidecar_path is not None:
+        try:
+            return load_grid(sidecar_path)
+        except FileNotFoundError:
+            pass
+    return BACKGROUNDS.get(bg_path)
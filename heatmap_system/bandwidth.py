@@ -0,0 +1,100 @@
+import math
+
+import numpy as np
+
+# bandwidth=auto - правило Скотта; правило можно назвать и явно
+AUTO_BANDWIDTH = "auto"
+BANDWIDTH_RULES = ("scott", "silverman")
+# Выбранное значение округляется до шага, чтобы каждая загрузка не меняла ключ кэша
+AUTO_BANDWIDTH_STEP = 0.5
+MIN_AUTO_BANDWIDTH = 1.0
+# Пока точек меньше двух, разброс не определён
+FALLBACK_BANDWIDTH = 10.0
+# Размер равномерной выборки точек (reservoir sampling) для квартилей
+RESERVOIR_SIZE = 4096
+
+
+class PointMoments:
+    """
+    Потоковая статистика координат страницы: число точек, средние и суммы квадратов
+    отклонений (партии объединяются по формуле Чана) и равномерная выборка точек
+    для квартилей. Загрузка партии обновляет статистику за O(размер партии).
+    """
+
+    def __init__(self, seed=0):
+        self.count = 0
+        self.mean = np.zeros(2)
+        self.m2 = np.zeros(2)
+        self.sample = np.empty((0, 2))
+        self.rng = np.random.default_rng(seed)
+
+    def extend(self, xs, ys):
+        batch = np.column_stack((xs, ys)).astype(np.float64)
+        count = len(batch)
+        if count == 0:
+            return
+        batch_mean = batch.mean(axis=0)
+        total = self.count + count
+        delta = batch_mean - self.mean
+        self.m2 += ((batch - batch_mean) ** 2).sum(axis=0) + delta * delta * self.count * count / total
+        self.mean += delta * count / total
+
+        taken = min(count, RESERVOIR_SIZE - len(self.sample))
+        self.sample = np.concatenate((self.sample, batch[:taken]))
+        rest = batch[taken:]
+        if len(rest):
+            # Алгоритм R: i-я точка потока заменяет случайный элемент выборки с вероятностью size / (i + 1)
+            seen = self.count + taken + np.arange(len(rest))
+            slots = (self.rng.random(len(rest)) * (seen + 1)).astype(np.int64)
+            keep = slots < RESERVOIR_SIZE
+            self.sample[slots[keep]] = rest[keep]
+        self.count = total
+
+    def std(self):
+        return np.sqrt(self.m2 / max(1, self.count - 1))
+
+    def iqr(self):
+        low, high = np.percentile(self.sample, (25, 75), axis=0)
+        return high - low
+
+
+def scott_bandwidth(moments):
+    # Двумерное правило Скотта h = sigma * n^(-1/6); ядро изотропное - берём среднее
+    # геометрическое отклонений по осям
+    return math.sqrt(np.prod(moments.std())) * moments.count ** (-1 / 6)
+
+
+def silverman_bandwidth(moments):
+    # Правило Сильвермана для размерности d: (4 / (d + 2))^(1 / (d + 4)) * min(sigma, IQR / 1.34)
+    # * n^(-1 / (d + 4)); при d = 2 множитель равен 1. От правила Скотта отличается устойчивой
+    # оценкой разброса: для скученных данных (несколько плотных областей) ядро уже
+    dims = 2
+    std = moments.std()
+    spread = np.minimum(std, moments.iqr() / 1.34)
+    spread = np.where(spread > 0, spread, std)
+    factor = (4 / (dims + 2)) ** (1 / (dims + 4))
+    return factor * math.sqrt(np.prod(spread)) * moments.count ** (-1 / (dims + 4))
+
+
+BANDWIDTH_RULE_FUNCTIONS = {
+    "scott": scott_bandwidth,
+    "silverman": silverman_bandwidth,
+}
+
+
+def is_bandwidth_rule(value):
+    return value == AUTO_BANDWIDTH or value in BANDWIDTH_RULES
+
+
+def select_bandwidth(moments, rule):
+    """
+    bandwidth по правилу rule (auto, scott, silverman), округлённый до AUTO_BANDWIDTH_STEP.
+    """
+    if rule == AUTO_BANDWIDTH:
+        rule = BANDWIDTH_RULES[0]
+    if moments is None or moments.count < 2:
+        return FALLBACK_BANDWIDTH
+    value = BANDWIDTH_RULE_FUNCTIONS[rule](moments)
+    if not math.isfinite(value):
+        return FALLBACK_BANDWIDTH
+    return max(MIN_AUTO_BANDWIDTH, round(value / AUTO_BANDWIDTH_STEP) * AUTO_BANDWIDTH_STEP)
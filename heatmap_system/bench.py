@@ -0,0 +1,477 @@
+"""
+Набор замеров производительности: методы KDE, отрисовка, кодирование и HTTP-сервис.
+
+    python bench.py --out results.json
+    python bench.py --config bench.json --suites kde,render --out results.json
+    python bench.py --out new.json --baseline results.json --threshold 0.2
+
+Входные точки - случайное блуждание с фиксированным seed, поэтому повторный
+запуск считает те же данные. Результаты пишутся в JSON; с --baseline каждый
+замер сравнивается с сохранённым, и рост времени больше threshold считается
+регрессией (код возврата 1).
+"""
+import argparse
+import functools
+import http.client
+import io
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from kde_engine import KDE_METHODS, compute_density, normalize_density
+from parallel_kde import kde_parallel
+from renderer import INTERPOLATIONS, overlay_palette, render_overlay, save_image
+
+# Входные точки - генератор случайного блуждания из heatmap_project/main.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                                "heatmap_project"))
+import main as reference  # noqa: E402
+
+DEFAULT_CONFIG = {
+    "seed": 0,
+    "repeats": 3,
+    "walkers": 200,
+    "step_size": 5.0,
+    "points": [10000, 100000],
+    "image_sizes": [[1280, 720], [1920, 1080]],
+    "bandwidths": [10, 30],
+    "grid_spacings": [5, 15],
+    "methods": sorted(KDE_METHODS),
+    # brute на больших наборах считается минутами - ограничиваем число точек
+    "method_max_points": {"brute": 20000},
+    "interpolations": sorted(INTERPOLATIONS),
+    # Варианты кодирования ответа (как параметры format, level, overlay у /heatmap)
+    "encodings": [
+        {"format": "png"},
+        {"format": "png", "level": 1},
+        {"format": "png", "level": 9},
+        {"format": "webp"},
+        {"format": "webp", "level": 50},
+        {"format": "jpeg"},
+        {"format": "png", "overlay": True},
+        {"format": "webp", "overlay": True},
+    ],
+    "http": {
+        "points": 100000,
+        "image_size": [1920, 1080],
+        "bandwidth": 10,
+        "grid_spacing": 10,
+        "method": "fft",
+        "clients": [1, 4, 16],
+        "requests_per_client": 10,
+        "render_workers": 2,
+        "max_pending": 8,
+    },
+    # Одна большая карта (длинная страница, мелкая сетка) на разном числе процессов
+    "parallel": {
+        "points": 2000000,
+        "image_size": [1920, 6000],
+        "bandwidth": 10,
+        "grid_spacing": 2,
+        "methods": ["accumulate", "fft"],
+        "workers": [1, 2, 4, 8],
+    },
+}
+
+QUICK_CONFIG = dict(DEFAULT_CONFIG, repeats=1, points=[10000], image_sizes=[[1280, 720]],
+                    bandwidths=[10], grid_spacings=[10],
+                    http=dict(DEFAULT_CONFIG["http"], points=20000, clients=[1, 4],
+                              requests_per_client=4),
+                    parallel=dict(DEFAULT_CONFIG["parallel"], points=300000,
+                                  image_size=[1280, 2000], workers=[1, 2]))
+
+SUITES = ("kde", "render", "encode", "http", "parallel")
+DEFAULT_THRESHOLD = 0.2
+SERVER_START_TIMEOUT = 30
+
+
+@functools.lru_cache(maxsize=8)
+def random_walk(width, height, num_walkers, points_per_walker, step_size, seed):
+    """
+    Точки generate_random_walk_data из heatmap_project (тот же seed - те же точки),
+    массивом формы (num_walkers * points_per_walker, 2), точки блуждающего подряд.
+    Генератор - цикл Python, поэтому набор строится один раз на все замеры.
+    """
+    points = np.asarray(reference.generate_random_walk_data(
+        width, height, num_walkers, points_per_walker, step_size, seed=seed), dtype=np.float64)
+    points.flags.writeable = False
+    return points
+
+
+def walk_points(config, count, width, height):
+    walkers = min(config["walkers"], count)
+    points = random_walk(width, height, walkers, -(-count // walkers), config["step_size"],
+                         config["seed"])
+    return points[:count]
+
+
+def measure(func, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return {"seconds": min(times), "median": statistics.median(times)}
+
+
+def record(results, suite, name, params, timing):
+    results.append(dict({"suite": suite, "name": name, "params": params}, **timing))
+    speedup = f"  x{timing['speedup']:.2f}" if "speedup" in timing else ""
+    size = f"  {timing['bytes'] / 1024:.0f} KiB" if "bytes" in timing else ""
+    print(f"{name:<60} {timing['seconds'] * 1000:>10.1f} ms{speedup}{size}")
+
+
+def bench_kde(config, results):
+    limits = config["method_max_points"]
+    for width, height in config["image_sizes"]:
+        for count in config["points"]:
+            xs, ys = walk_points(config, count, width, height).T
+            for bandwidth in config["bandwidths"]:
+                for grid_spacing in config["grid_spacings"]:
+                    for method in config["methods"]:
+                        if count > limits.get(method, count):
+                            continue
+                        params = {"method": method, "points": count, "size": [width, height],
+                                  "bandwidth": bandwidth, "grid_spacing": grid_spacing}
+                        timing = measure(lambda: compute_density(
+                            (xs, ys), width, height, bandwidth, grid_spacing, method),
+                            config["repeats"])
+                        record(results, "kde", f"kde/{method}/n={count}/{width}x{height}"
+                               f"/bw={bandwidth}/grid={grid_spacing}", params, timing)
+
+
+def bench_render(config, results):
+    """
+    Этап отрисовки: слой карты, наложение на фон и кодирование PNG.
+    """
+    count = config["points"][-1]
+    for width, height in config["image_sizes"]:
+        xs, ys = walk_points(config, count, width, height).T
+        background = Image.new("RGBA", (width, height), (255, 255, 255, 255))
+        for grid_spacing in config["grid_spacings"]:
+            density = compute_density((xs, ys), width, height, config["bandwidths"][0],
+                                      grid_spacing, "fft")
+            normalized = normalize_density(density)
+            for interpolation in config["interpolations"]:
+                def render():
+                    overlay = render_overlay(normalized, grid_spacing, (width, height),
+                                             (255, 0, 0), 1.0, interpolation)
+                    Image.alpha_composite(background, overlay).save(io.BytesIO(), format="PNG")
+                params = {"size": [width, height], "grid_spacing": grid_spacing,
+                          "interpolation": interpolation}
+                record(results, "render", f"render/{interpolation}/{width}x{height}"
+                       f"/grid={grid_spacing}", params, measure(render, config["repeats"]))
+
+
+def synthetic_page(width, height, seed):
+    """
+    Фон, похожий на скриншот: блоки разных цветов и строки мелкого "текста".
+    На однотонном фоне сжатие было бы неправдоподобно быстрым.
+    """
+    rng = np.random.default_rng(seed)
+    page = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(page)
+    for _ in range(40):
+        x0, y0 = int(rng.integers(0, width)), int(rng.integers(0, height))
+        x1, y1 = x0 + int(rng.integers(50, 600)), y0 + int(rng.integers(20, 300))
+        draw.rectangle((x0, y0, x1, y1), fill=tuple(int(c) for c in rng.integers(120, 256, 3)))
+    for y in range(20, height, 24):
+        x = int(rng.integers(10, 200))
+        while x < width - 20:
+            word = int(rng.integers(10, 80))
+            draw.rectangle((x, y, x + word, y + 10), fill=(40, 40, 40))
+            x += word + int(rng.integers(6, 20))
+    return page.convert("RGBA")
+
+
+def bench_encode(config, results):
+    """
+    Кодирование готовой карты в каждый вариант из config["encodings"]:
+    время (как этап encode сервиса) и размер ответа (bytes).
+    """
+    count = config["points"][-1]
+    grid_spacing = config["grid_spacings"][0]
+    for width, height in config["image_sizes"]:
+        xs, ys = walk_points(config, count, width, height).T
+        background = synthetic_page(width, height, config["seed"])
+        normalized = normalize_density(compute_density(
+            (xs, ys), width, height, config["bandwidths"][0], grid_spacing, "fft"))
+        overlay = render_overlay(normalized, grid_spacing, (width, height), (255, 0, 0))
+        composite = Image.alpha_composite(background, overlay)
+        palette = overlay_palette(overlay, (255, 0, 0))
+        for encoding in config["encodings"]:
+            output_format = encoding["format"]
+            level = encoding.get("level")
+            image = composite
+            if encoding.get("overlay"):
+                image = palette if output_format == "png" else overlay
+            sizes = []
+
+            def encode():
+                buffer = io.BytesIO()
+                save_image(image, buffer, output_format, level)
+                sizes.append(buffer.tell())
+
+            timing = measure(encode, config["repeats"])
+            timing["bytes"] = sizes[-1]
+            name = (f"encode/{output_format}" + (f"/level={level}" if level is not None else "")
+                    + ("/overlay" if encoding.get("overlay") else "") + f"/{width}x{height}")
+            record(results, "encode", name, dict(encoding, size=[width, height]), timing)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def request(port, method, path, body=None, headers=None):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+    try:
+        connection.request(method, path, body, headers or {})
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def request_etag(port, path):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+    try:
+        connection.request("GET", path)
+        response = connection.getresponse()
+        response.read()
+        return response.getheader("ETag")
+    finally:
+        connection.close()
+
+
+def start_server(workdir, port, settings):
+    """
+    Запускает run_server в отдельном процессе с рабочим каталогом workdir
+    (там его images/, data/ и кэши) и ждёт, пока он начнёт отвечать.
+    """
+    code = (f"from server import run_server; run_server(port={port}, "
+            f"render_workers={settings['render_workers']}, max_pending={settings['max_pending']})")
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.Popen([sys.executable, "-c", code], cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + SERVER_START_TIMEOUT
+    while time.time() < deadline:
+        try:
+            if request(port, "GET", "/stats")[0] == 200:
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Server did not start")
+
+
+def run_clients(port, clients, paths, headers=None):
+    """
+    clients параллельных клиентов выполняют запросы paths (списки путей по клиентам),
+    каждый - по своему соединению keep-alive. Ответы 200 и 304 - успешные.
+    Возвращает задержки успешных запросов, число ответов 503 и ошибок и общее время.
+    """
+    def client(client_paths):
+        latencies, busy, failed = [], 0, 0
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+        for path in client_paths:
+            start = time.perf_counter()
+            try:
+                connection.request("GET", path, headers=headers or {})
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                status = None
+            if status in (200, 304):
+                latencies.append(time.perf_counter() - start)
+            elif status == 503:
+                busy += 1
+            else:
+                failed += 1
+        connection.close()
+        return latencies, busy, failed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        outcomes = list(executor.map(client, paths))
+    elapsed = time.perf_counter() - start
+    latencies = sorted(value for outcome in outcomes for value in outcome[0])
+    return latencies, sum(outcome[1] for outcome in outcomes), \
+        sum(outcome[2] for outcome in outcomes), elapsed
+
+
+def latency_timing(latencies, busy, failed, elapsed):
+    if not latencies:
+        return {"seconds": float("nan"), "median": float("nan"), "busy": busy, "failed": failed}
+
+    def percentile(share):
+        return latencies[min(len(latencies) - 1, int(share * len(latencies)))]
+
+    # seconds - p95: по нему сравнение с базовым замером
+    return {"seconds": percentile(0.95), "median": percentile(0.5), "p99": percentile(0.99),
+            "requests_per_second": len(latencies) / elapsed, "busy": busy, "failed": failed}
+
+
+def bench_http(config, results):
+    """
+    Сквозные запросы к локальному run_server: холодные (каждый запрос - новые
+    параметры, полная отрисовка), повторные (ответ из кэша) и повторные с
+    If-None-Match (ответ 304 без тела) при разном числе одновременных клиентов.
+    """
+    settings = config["http"]
+    width, height = settings["image_size"]
+    page = "bench"
+    with tempfile.TemporaryDirectory() as workdir:
+        os.makedirs(os.path.join(workdir, "images"))
+        Image.new("RGB", (width, height), "white").save(
+            os.path.join(workdir, "images", f"{page}.png"))
+        port = free_port()
+        process = start_server(workdir, port, settings)
+        try:
+            points = walk_points(config, settings["points"], width, height).astype("<f4")
+            status, body = request(port, "POST", f"/upload_data?page_id={page}", points.tobytes(),
+                                   {"Content-Type": "application/octet-stream"})
+            if status != 200:
+                raise RuntimeError(f"Upload failed: {status} {body[:200]!r}")
+            base = (f"/heatmap?page_id={page}&grid={settings['grid_spacing']}"
+                    f"&method={settings['method']}")
+            # Уникальные bandwidth для холодных запросов во всех прогонах
+            counter = iter(range(10 ** 9))
+            for clients in settings["clients"]:
+                per_client = settings["requests_per_client"]
+                for mode in ("cold", "warm", "revalidate"):
+                    headers = None
+                    if mode == "cold":
+                        paths = [[f"{base}&bandwidth={settings['bandwidth'] + next(counter) * 0.01:g}"
+                                  for _ in range(per_client)] for _ in range(clients)]
+                    else:
+                        path = f"{base}&bandwidth={settings['bandwidth']}"
+                        etag = request_etag(port, path)
+                        if mode == "revalidate":
+                            headers = {"If-None-Match": etag}
+                        paths = [[path] * per_client for _ in range(clients)]
+                    timing = latency_timing(*run_clients(port, clients, paths, headers))
+                    params = {"mode": mode, "clients": clients, "requests_per_client": per_client,
+                              "points": settings["points"], "size": [width, height],
+                              "method": settings["method"],
+                              "render_workers": settings["render_workers"]}
+                    record(results, "http", f"http/{mode}/clients={clients}", params, timing)
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def bench_parallel(config, results):
+    """
+    kde_parallel против расчёта в одном процессе; speedup - во сколько раз быстрее.
+    """
+    settings = config["parallel"]
+    width, height = settings["image_size"]
+    xs, ys = walk_points(config, settings["points"], width, height).T
+    bandwidth, grid_spacing = settings["bandwidth"], settings["grid_spacing"]
+    for method in settings["methods"]:
+        serial = measure(lambda: compute_density((xs, ys), width, height, bandwidth, grid_spacing,
+                                                 method), config["repeats"])
+        params = {"method": method, "points": len(xs), "size": [width, height],
+                  "bandwidth": bandwidth, "grid_spacing": grid_spacing, "workers": 0}
+        record(results, "parallel", f"parallel/{method}/serial", params, serial)
+        for workers in settings["workers"]:
+            # Первый вызов запускает процессы пула - его не считаем
+            kde_parallel(xs, ys, width, height, bandwidth, grid_spacing, method, workers)
+            timing = measure(lambda: kde_parallel(xs, ys, width, height, bandwidth, grid_spacing,
+                                                  method, workers), config["repeats"])
+            timing["speedup"] = serial["seconds"] / timing["seconds"]
+            record(results, "parallel", f"parallel/{method}/workers={workers}",
+                   dict(params, workers=workers), timing)
+
+
+BENCHMARKS = {"kde": bench_kde, "render": bench_render, "encode": bench_encode,
+              "http": bench_http, "parallel": bench_parallel}
+
+
+def compare(results, baseline, threshold):
+    """
+    Сравнивает замеры с базовыми по имени. Возвращает список регрессий.
+    """
+    previous = {entry["name"]: entry for entry in baseline["results"]}
+    regressions = []
+    print(f"\n{'замер':<60} {'было':>10} {'стало':>10} {'изм.':>8}")
+    for entry in results:
+        old = previous.get(entry["name"])
+        if old is None or not old["seconds"] > 0 or entry["seconds"] != entry["seconds"]:
+            continue
+        change = entry["seconds"] / old["seconds"] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  РЕГРЕССИЯ"
+            regressions.append({"name": entry["name"], "baseline": old["seconds"],
+                                "seconds": entry["seconds"], "change": change})
+        print(f"{entry['name']:<60} {old['seconds'] * 1000:>10.1f} {entry['seconds'] * 1000:>10.1f}"
+              f" {change:>+8.0%}{flag}")
+    return regressions
+
+
+def environment():
+    return {"python": platform.python_version(), "numpy": np.__version__,
+            "pillow": Image.__version__, "platform": platform.platform(),
+            "cpu_count": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Замеры производительности тепловых карт")
+    parser.add_argument("--config", help="JSON с параметрами (поверх значений по умолчанию)")
+    parser.add_argument("--quick", action="store_true", help="маленький набор для проверки")
+    parser.add_argument("--suites", default=",".join(SUITES),
+                        help="через запятую: " + ", ".join(SUITES))
+    parser.add_argument("--out", help="куда записать результаты (JSON)")
+    parser.add_argument("--baseline", help="результаты для сравнения (JSON)")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="допустимый рост времени, доля (по умолчанию 0.2)")
+    args = parser.parse_args(argv)
+
+    config = dict(QUICK_CONFIG if args.quick else DEFAULT_CONFIG)
+    if args.config:
+        with open(args.config, "r", encoding="utf-8") as f:
+            overrides = json.load(f)
+        for section in ("http", "parallel"):
+            if section in overrides:
+                overrides[section] = dict(config[section], **overrides[section])
+        config.update(overrides)
+    suites = [name.strip() for name in args.suites.split(",") if name.strip()]
+    unknown = set(suites) - set(SUITES)
+    if unknown:
+        parser.error(f"unknown suites: {', '.join(sorted(unknown))}")
+
+    results = []
+    for name in suites:
+        BENCHMARKS[name](config, results)
+    report = {"environment": environment(), "config": config, "results": results}
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            report["regressions"] = compare(results, json.load(f), args.threshold)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if report.get("regressions"):
+        print(f"\nРегрессий: {len(report['regressions'])}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
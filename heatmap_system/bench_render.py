@@ -0,0 +1,56 @@
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from renderer import INTERPOLATIONS, render_overlay
+
+IMAGE_SIZE = (1920, 1080)
+GRID_SPACINGS = (40, 20, 10, 5, 2)
+REPEATS = 3
+
+
+def render_rectangles(normalized, grid_spacing, size, color):
+    """
+    Прежняя отрисовка: по одному draw.rectangle на ячейку (для сравнения).
+    """
+    layer = Image.new("RGBA", size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(layer)
+    grid = normalized.tolist()
+    for i, row in enumerate(grid):
+        for j, intensity in enumerate(row):
+            draw.rectangle([int(j * grid_spacing), int(i * grid_spacing),
+                            int((j + 1) * grid_spacing), int((i + 1) * grid_spacing)],
+                           fill=color + (intensity,))
+    return layer
+
+
+def best_time(func, *args):
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    width, height = IMAGE_SIZE
+    color = (255, 0, 0)
+    rng = np.random.default_rng(0)
+    print(f"Изображение {width}x{height}, лучшее из {REPEATS} запусков, мс")
+    print(f"{'сетка':>12} {'ячеек':>9} {'rectangle':>10}"
+          + "".join(f" {name:>9}" for name in INTERPOLATIONS))
+    for grid_spacing in GRID_SPACINGS:
+        shape = (int(height / grid_spacing), int(width / grid_spacing))
+        normalized = rng.integers(0, 256, shape, dtype=np.uint8)
+        row = [best_time(render_rectangles, normalized, grid_spacing, IMAGE_SIZE, color)]
+        for name in INTERPOLATIONS:
+            row.append(best_time(render_overlay, normalized, grid_spacing, IMAGE_SIZE,
+                                 color, 1.0, name))
+        print(f"{shape[1]:>5}x{shape[0]:<6} {normalized.size:>9} "
+              + " ".join(f"{seconds * 1000:>9.1f}" for seconds in row))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import bisect
+import hashlib
+import http.client
+import json
+import threading
+import time
+import uuid
+
+# Точек на кольце у каждого узла: чем больше, тем ровнее страницы делятся между узлами
+VIRTUAL_NODES = 64
+# Сколько простаивающих соединений держать к каждому узлу
+MAX_IDLE_CONNECTIONS = 8
+# Соединение, простоявшее дольше, не переиспользуется: узел мог закрыть его по таймауту keep-alive
+MAX_IDLE_SECONDS = 30
+FORWARD_TIMEOUT = 600
+# Заголовок пересланного запроса: узел-владелец обрабатывает его сам, не пересылая дальше
+FORWARDED_HEADER = "X-Heatmap-Forwarded"
+# Заголовки, которые передаются владельцу и обратно клиенту (X-Client-Id выставляет сервер)
+REQUEST_HEADERS = ("Content-Type", "If-None-Match", "Accept")
+RESPONSE_HEADERS = ("Content-Type", "ETag", "Cache-Control", "X-Bandwidth", "Retry-After",
+                    "Location", "Content-Disposition")
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Согласованное хэширование: у каждого узла virtual_nodes точек на кольце,
+    ключ принадлежит узлу первой точки по часовой стрелке от хэша ключа.
+    При добавлении или удалении узла переезжает только ~1/N ключей.
+    """
+
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        points = sorted((_hash(f"{node}#{index}"), node)
+                        for node in nodes for index in range(virtual_nodes))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def owner(self, key):
+        index = bisect.bisect_right(self.hashes, _hash(key))
+        return self.nodes[index % len(self.nodes)]
+
+
+class ConnectionPool:
+    """
+    Пул соединений keep-alive к одному узлу (http.client.HTTPConnection).
+    """
+
+    def __init__(self, address, max_idle=MAX_IDLE_CONNECTIONS):
+        host, _, port = address.rpartition(":")
+        self.host = host
+        self.port = int(port)
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+        self.created = 0
+
+    def get(self):
+        """
+        (соединение, переиспользовано ли оно).
+        """
+        now = time.monotonic()
+        with self.lock:
+            while self.idle:
+                connection, released = self.idle.pop()
+                if now - released < MAX_IDLE_SECONDS:
+                    return connection, True
+                connection.close()
+            self.created += 1
+        return http.client.HTTPConnection(self.host, self.port, timeout=FORWARD_TIMEOUT), False
+
+    def put(self, connection):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append((connection, time.monotonic()))
+                return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection, _ in idle:
+            connection.close()
+
+
+class ForwardError(Exception):
+    pass
+
+
+class Cluster:
+    """
+    Кластер узлов из статического файла конфигурации:
+    {"nodes": {"a": "127.0.0.1:8081", "b": "127.0.0.1:8082"}, "virtual_nodes": 64}.
+    Каждая страница (page_id) принадлежит одному узлу по HashRing: только он
+    хранит её точки и кэш карт, остальные пересылают ему запросы страницы.
+    """
+
+    def __init__(self, node_id, nodes, virtual_nodes=VIRTUAL_NODES):
+        if node_id not in nodes:
+            raise ValueError(f"Node {node_id} is not in the cluster config")
+        self.node_id = node_id
+        self.nodes = dict(nodes)
+        self.ring = HashRing(self.nodes, virtual_nodes)
+        self.pools = {node: ConnectionPool(address) for node, address in self.nodes.items()
+                      if node != node_id}
+        self.lock = threading.Lock()
+        self.forwarded = {node: 0 for node in self.pools}
+
+    @classmethod
+    def from_file(cls, path, node_id):
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        return cls(node_id, config["nodes"], config.get("virtual_nodes", VIRTUAL_NODES))
+
+    def owner(self, key):
+        return self.ring.owner(key)
+
+    def is_local(self, key):
+        return self.owner(key) == self.node_id
+
+    def new_job_id(self):
+        """
+        Номер задания, который сам указывает на этот узел: хэш номера на кольце
+        попадает сюда, поэтому любой узел перешлёт /heatmap/jobs/{id} владельцу.
+        В среднем нужно столько попыток, сколько узлов в кластере.
+        """
+        while True:
+            job_id = uuid.uuid4().hex
+            if self.is_local(job_id):
+                return job_id
+
+    def forward(self, node, method, path, body=None, headers=()):
+        """
+        Выполняет запрос на узле node. body - bytes или итератор кусков
+        (передаётся chunked, не собираясь в памяти). Возвращает
+        (код, [(заголовок, значение)], тело). Запрос с bytes повторяется один раз
+        на новом соединении, если переиспользованное оказалось закрыто узлом.
+        """
+        pool = self.pools[node]
+        # Итератор читается один раз - повторить такой запрос нельзя
+        replayable = body is None or isinstance(body, bytes)
+        request_headers = dict(headers)
+        request_headers[FORWARDED_HEADER] = self.node_id
+        with self.lock:
+            self.forwarded[node] += 1
+        for attempt in range(2):
+            connection, reused = pool.get()
+            try:
+                # Для итератора http.client сам выставляет Transfer-Encoding: chunked
+                connection.request(method, path, body, request_headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                connection.close()
+                if reused and attempt == 0 and replayable:
+                    continue
+                raise ForwardError(f"Node {node} is unavailable: {e}") from e
+            response_headers = [(name, response.getheader(name)) for name in RESPONSE_HEADERS
+                                if response.getheader(name) is not None]
+            if response.will_close:
+                connection.close()
+            else:
+                pool.put(connection)
+            return response.status, response_headers, data
+
+    def stats(self):
+        with self.lock:
+            forwarded = dict(self.forwarded)
+        return {
+            "node": self.node_id,
+            "nodes": self.nodes,
+            "forwarded": forwarded,
+            "connections": {node: {"idle": len(pool.idle), "created": pool.created}
+                            for node, pool in self.pools.items()},
+        }
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
@@ -0,0 +1,61 @@
+import os
+import threading
+
+import numpy as np
+
+from heatmap_cache import DiskCache
+
+GRID_FILE_SUFFIX = ".npy"
+
+
+def save_grid(path, grid):
+    """
+    Сохраняет сетку в .npy атомарно (через временный файл).
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, grid)
+    os.replace(tmp_path, path)
+
+
+def load_grid(path):
+    """
+    Открывает сетку из .npy через mmap (без чтения файла целиком).
+    """
+    return np.load(path, mmap_mode="r")
+
+
+class GridCache:
+    """
+    Промежуточные сетки конвейера (плотность float32, нормированная uint8)
+    в файлах .npy с бюджетом на диске. Файлы пишут воркеры отрисовки,
+    сервис только регистрирует их (add) и отдаёт пути для mmap.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.disk = DiskCache(cache_dir, max_bytes, suffix=GRID_FILE_SUFFIX)
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        return self.disk.path(key)
+
+    def find(self, key):
+        with self.lock:
+            return self.disk.find(key)
+
+    def add(self, key):
+        with self.lock:
+            if os.path.exists(self.disk.path(key)):
+                self.disk.add(key)
+
+    def keys(self):
+        with self.lock:
+            return self.disk.keys()
+
+    def discard(self, key):
+        with self.lock:
+            self.disk.discard(key)
+
+    def stats(self):
+        with self.lock:
+            return self.disk.stats()
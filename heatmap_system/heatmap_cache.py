@@ -0,0 +1,317 @@
+import hashlib
+import os
+import threading
+import urllib.parse as urlparse
+from collections import OrderedDict
+
+# Суффикс не зависит от формата: в кэше лежат png, webp, jpeg, gif и zip
+CACHE_FILE_SUFFIX = ".bin"
+# Так назывались файлы карт раньше - при старте они удаляются
+LEGACY_CACHE_SUFFIX = ".png"
+KEY_SEPARATOR = "+"
+# Имена длиннее (длинный срез filter=) заменяются хэшем: предел ФС - 255 байт,
+# и нужен запас на суффикс временного файла
+MAX_STEM_BYTES = 200
+# Начало хэшированного имени: quote() кодирует "=", в обычном имени его нет
+HASHED_PREFIX = "="
+# Ключ файла с хэшированным именем лежит рядом в файле с этим суффиксом
+KEY_FILE_SUFFIX = ".key"
+
+
+def canonical_part(value):
+    """
+    Каноническая строка для части ключа: числа 10 и 10.0 дают "10".
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        text = repr(float(value))
+        return text[:-2] if text.endswith(".0") else text
+    return str(value)
+
+
+def normalize_key(*parts):
+    return tuple(canonical_part(part) for part in parts)
+
+
+def key_stem(key):
+    # quote(safe="") кодирует и "+", поэтому разделитель однозначен; результат - ASCII
+    return KEY_SEPARATOR.join(urlparse.quote(part, safe="") for part in key)
+
+
+def stem_to_key(stem):
+    return tuple(urlparse.unquote(part) for part in stem.split(KEY_SEPARATOR))
+
+
+def key_to_filename(key, suffix=CACHE_FILE_SUFFIX):
+    stem = key_stem(key)
+    if len(stem) > MAX_STEM_BYTES:
+        stem = HASHED_PREFIX + hashlib.sha256(stem.encode("ascii")).hexdigest()
+    return stem + suffix
+
+
+def key_etag(key):
+    """
+    Сильный ETag ответа по ключу кэша: в ключе версия данных страницы и все
+    параметры, поэтому одинаковый ключ - одинаковое изображение.
+    """
+    digest = hashlib.sha256(key_stem(key).encode("utf-8")).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def filename_to_key(filename, suffix=CACHE_FILE_SUFFIX):
+    # Ключ хэшированного имени по имени не восстановить - он в файле .key
+    if not filename.endswith(suffix) or filename.startswith(HASHED_PREFIX):
+        return None
+    return stem_to_key(filename[:-len(suffix)])
+
+
+class MemoryLRU:
+    """
+    LRU закодированных изображений (bytes) с ограничением на суммарный размер.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, count_miss=True):
+        data = self.entries.get(key)
+        if data is None:
+            self.misses += count_miss
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        self.discard(key)
+        self.entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def discard(self, key):
+        data = self.entries.pop(key, None)
+        if data is not None:
+            self.size -= len(data)
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class DiskCache:
+    """
+    Файловый кэш в cache_dir с бюджетом в байтах. Индекс (ключ -> размер
+    в порядке последнего обращения) восстанавливается при старте по файлам
+    (для хэшированных имён - по файлам .key). Файлы с суффиксами stale_suffixes
+    при старте удаляются.
+    """
+
+    def __init__(self, cache_dir, max_bytes, suffix=CACHE_FILE_SUFFIX, stale_suffixes=()):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.stale_suffixes = stale_suffixes
+        self.index = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._rebuild_index()
+
+    def _rebuild_index(self):
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, filename)
+            if filename.endswith(self.stale_suffixes):
+                # Файлы старого формата имён в индекс не попали бы и не вытеснялись бы
+                os.remove(path)
+                continue
+            if filename.startswith(HASHED_PREFIX) and filename.endswith(self.suffix):
+                key = self._read_key_file(path)
+                if key is None:
+                    # Сбой между записью файла и add: ключ неизвестен, файл не нужен
+                    os.remove(path)
+                    continue
+            else:
+                key = filename_to_key(filename, self.suffix)
+                if key is None:
+                    continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, key, stat.st_size))
+        for _, key, size in sorted(entries):
+            self.index[key] = size
+            self.size += size
+        self._evict()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key_to_filename(key, self.suffix))
+
+    @staticmethod
+    def _read_key_file(path):
+        try:
+            with open(path + KEY_FILE_SUFFIX, "r", encoding="ascii") as f:
+                return stem_to_key(f.read())
+        except (FileNotFoundError, UnicodeDecodeError):
+            return None
+
+    def find(self, key, count_miss=True):
+        """
+        Путь к файлу ключа (с отметкой об обращении) или None.
+        """
+        if key not in self.index:
+            self.misses += count_miss
+            return None
+        path = self.path(key)
+        if not os.path.exists(path):
+            self._forget(key)
+            self.misses += count_miss
+            return None
+        self.index.move_to_end(key)
+        self.hits += 1
+        return path
+
+    def open(self, key, count_miss=True):
+        """
+        Открытый файл ключа или None. Открытый файл читается и после вытеснения.
+        """
+        path = self.find(key, count_miss)
+        if path is None:
+            return None
+        try:
+            return open(path, "rb")
+        except FileNotFoundError:
+            self._forget(key)
+            return None
+
+    def get(self, key, count_miss=True):
+        f = self.open(key, count_miss)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def add(self, key):
+        """
+        Регистрирует файл, уже записанный по пути path(key).
+        """
+        self._forget(key)
+        path = self.path(key)
+        size = os.path.getsize(path)
+        if os.path.basename(path).startswith(HASHED_PREFIX):
+            with open(path + KEY_FILE_SUFFIX, "w", encoding="ascii") as f:
+                f.write(key_stem(key))
+        self.index[key] = size
+        self.size += size
+        self._evict()
+
+    def discard(self, key):
+        if key in self.index:
+            self._forget(key)
+            self._remove_file(key)
+
+    def keys(self):
+        return list(self.index)
+
+    def _forget(self, key):
+        size = self.index.pop(key, None)
+        if size is not None:
+            self.size -= size
+
+    def _remove_file(self, key):
+        path = self.path(key)
+        paths = [path]
+        if os.path.basename(path).startswith(HASHED_PREFIX):
+            paths.append(path + KEY_FILE_SUFFIX)
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.index:
+            key, size = self.index.popitem(last=False)
+            self.size -= size
+            self._remove_file(key)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "entries": len(self.index),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class TwoTierCache:
+    """
+    Кэш готовых тепловых карт: память (MemoryLRU) поверх диска (DiskCache).
+    Ключи - кортежи строк из normalize_key.
+    """
+
+    def __init__(self, cache_dir, memory_bytes, disk_bytes):
+        self.memory = MemoryLRU(memory_bytes)
+        self.disk = DiskCache(cache_dir, disk_bytes, stale_suffixes=(LEGACY_CACHE_SUFFIX,))
+        self.lock = threading.Lock()
+
+    def get(self, key, count_miss=True, as_file=False):
+        """
+        count_miss=False - повторная проверка того же ключа, промах уже учтён.
+        as_file=True - файл с диска не читается в память, а возвращается открытым
+        (для отправки через sendfile); закрывает его вызывающий.
+        """
+        with self.lock:
+            data = self.memory.get(key, count_miss)
+            if data is None:
+                if as_file:
+                    return self.disk.open(key, count_miss)
+                data = self.disk.get(key, count_miss)
+                if data is not None:
+                    self.memory.put(key, data)
+            return data
+
+    def path(self, key):
+        return self.disk.path(key)
+
+    def add_file(self, key):
+        """
+        Регистрирует файл path(key) и возвращает его содержимое (оно же попадает в память).
+        """
+        with open(self.path(key), "rb") as f:
+            data = f.read()
+        with self.lock:
+            self.disk.add(key)
+            self.memory.put(key, data)
+        return data
+
+    def keys(self):
+        with self.lock:
+            return set(self.memory.entries) | set(self.disk.index)
+
+    def discard(self, key):
+        with self.lock:
+            self.memory.discard(key)
+            self.disk.discard(key)
+
+    def stats(self):
+        with self.lock:
+            return {"memory": self.memory.stats(), "disk": self.disk.stats()}
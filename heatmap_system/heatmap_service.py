@@ -1,72 +1,893 @@
 import math
 import os
-from PIL import Image, ImageDraw
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+from PIL import Image
+
+from accumulators import DensityAccumulator
+from bandwidth import is_bandwidth_rule, select_bandwidth
+from background_cache import (BACKGROUND_CACHE_BYTES, BACKGROUNDS, BackgroundCache,
+                              background_image, load_background)
+from grid_cache import GridCache, load_grid, save_grid
+from heatmap_cache import TwoTierCache, canonical_part, normalize_key
+from kde_engine import (DEFAULT_METHOD, DEFAULT_NORMALIZATION, NONLINEAR_METHODS, as_point_arrays,
+                        compute_density, grid_shape, normalize_density)
+from metrics import METRICS, StageTimer
+from parallel_kde import can_run_parallel, kde_parallel
+from point_store import PointStore, load_source
+from renderer import (DEFAULT_FORMAT, DEFAULT_INTERPOLATION, overlay_palette, render_overlay,
+                      save_image)
+from single_flight import SingleFlight
+from slice_index import filter_key, split_filter
+from spatial_index import dwell_times, region_mass
+from tile_pyramid import max_zoom, pyramid_level, reduce_grid, render_tile_image, tile_count, tile_scale
+from time_frames import (MAX_ANIMATION_PIXELS, animation_windows, build_frames, frame_layout,
+                         save_animation, window_density)
+
+# После скольких запросов комбинация (bandwidth, grid_spacing, method)
+# считается "горячей" и получает инкрементальные сетки плотности
+HOT_PARAMS_THRESHOLD = 3
+MAX_HOT_PARAMS = 8
+# Для скольких ещё не горячих комбинаций хранится число запросов
+MAX_TRACKED_PARAMS = 256
+
+MEMORY_CACHE_BYTES = 256 * 1024 * 1024
+DISK_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+GRID_CACHE_BYTES = 1024 * 1024 * 1024
+
+# Оформление карты: цвет (hex RRGGBB), непрозрачность [0..1], шкала нормировки,
+# интерполяция при растяжении сетки, кодирование ответа: формат (renderer.OUTPUT_FORMATS),
+# уровень сжатия (None - по умолчанию для формата) и overlay - только слой карты без фона.
+# Смена оформления не требует пересчёта плотности.
+Style = namedtuple("Style", ["color", "opacity", "norm", "interpolation", "format", "level",
+                             "overlay"], defaults=(DEFAULT_FORMAT, None, False))
+DEFAULT_STYLE = Style("ff0000", 1.0, DEFAULT_NORMALIZATION, DEFAULT_INTERPOLATION)
+
+def parse_color(color):
+    return tuple(int(color[k:k + 2], 16) for k in (0, 2, 4))
+
+
+def _load_cached_grid(path):
+    # Файл мог быть вытеснен между prepare_render и отрисовкой
+    try:
+        return load_grid(path)
+    except FileNotFoundError:
+        return None
+
+
+def _compute_density(spec, rows, shared, width, height):
+    if "points" not in shared:
+        shared["points"] = as_point_arrays(load_source(spec["points"]))
+    points = shared["points"]
+    # Биннинг общий только для расчётов по всем точкам страницы
+    bins = shared.setdefault("bins", {})
+    if rows is not None:
+        points = (points[0][rows], points[1][rows])
+        bins = None
+    workers = spec.get("kde_workers", 1)
+    if can_run_parallel(spec["method"], len(points[0]), workers):
+        # Одна большая карта: полосы сетки считаются на нескольких процессах
+        return kde_parallel(points[0], points[1], width, height, spec["bandwidth"],
+                            spec["grid_spacing"], spec["method"], workers).astype(np.float32)
+    return compute_density(points, width, height, spec["bandwidth"], spec["grid_spacing"],
+                           spec["method"], bins=bins).astype(np.float32)
+
+
+def _part_density(spec, part, shared, width, height):
+    density = _load_cached_grid(part["density_path"]) if part["density_cached"] else None
+    if density is None:
+        density = _compute_density(spec, part["rows"], shared, width, height)
+        save_grid(part["density_path"], density)
+    return density
+
+
+def _density_stage(spec, shared, width, height):
+    """
+    Сетка плотности задания: готовая (горячая или из кэша сеток) или посчитанная заново.
+    """
+    density_grid = spec["density"]
+    if density_grid is None and spec["density_cached"]:
+        density_grid = _load_cached_grid(spec["density_path"])
+    if density_grid is None:
+        if spec["parts"]:
+            density_grid = sum(_part_density(spec, part, shared, width, height)
+                               for part in spec["parts"])
+        else:
+            density_grid = _compute_density(spec, spec["rows"], shared, width, height)
+        save_grid(spec["density_path"], density_grid)
+    return density_grid
+
+
+def _save_image(image, out_path, style):
+    # Пишем во временный файл и переименовываем, чтобы читатели не видели недописанный файл
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    save_image(image, tmp_path, style.format, style.level)
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def render_heatmap(spec, shared=None):
+    """
+    Строит тепловую карту по заданию из HeatmapService.prepare_render и
+    сохраняет PNG. Функция уровня модуля, чтобы её можно было выполнять
+    в пуле процессов. Возвращает путь к файлу и время этапов (StageTimer).
+    Этапы: плотность (float32) -> нормированная сетка (uint8) -> PNG;
+    уже посчитанные этапы берутся из кэша сеток, новые туда записываются.
+    shared - словарь, общий для заданий одной страницы: загруженные точки и биннинг.
+    Плотность среза из нескольких частей (spec["parts"]) - сумма плотностей частей,
+    каждая из которых берётся из кэша сеток или считается по своим строкам.
+    """
+    shared = {} if shared is None else shared
+    timer = StageTimer()
+    grid_spacing = spec["grid_spacing"]
+    style = spec["style"]
+    # Для слоя без фона фон не загружается: размер страницы уже есть в задании
+    background = None
+    if not style.overlay:
+        with timer("background"):
+            background = background_image(load_background(spec["bg_path"], spec["bg_sidecar"]))
+    img_width, img_height = spec["size"]
+
+    normalized = None
+    if spec["normalized_cached"]:
+        with timer("normalize"):
+            normalized = _load_cached_grid(spec["normalized_path"])
+    if normalized is None:
+        with timer("kde"):
+            density_grid = _density_stage(spec, shared, img_width, img_height)
+        with timer("normalize"):
+            normalized = normalize_density(density_grid, style.norm)
+            save_grid(spec["normalized_path"], normalized)
+
+    with timer("render"):
+        heatmap = render_overlay(normalized, grid_spacing, (img_width, img_height),
+                                 parse_color(style.color), style.opacity, style.interpolation)
+        if style.overlay and style.format == "png":
+            heatmap = overlay_palette(heatmap, parse_color(style.color))
+    if background is None:
+        image = heatmap
+    else:
+        with timer("composite"):
+            image = Image.alpha_composite(background, heatmap)
+    with timer("encode"):
+        out_path = _save_image(image, spec["out_path"], style)
+    return out_path, timer.timings
+
+
+def render_tile(spec):
+    """
+    Строит один тайл по заданию из HeatmapService.prepare_tile и сохраняет PNG.
+    Уровень пирамиды берётся из кэша сеток или получается из ближайшего
+    готового уровня ниже (в крайнем случае - из сетки плотности) уменьшением 2x.
+    Нормировка - по всему уровню, поэтому соседние тайлы согласованы.
+    Возвращает путь к файлу и время этапов; наложение и смешение с фоном
+    делаются вместе (render_tile_image) и попадают в этап render.
+    """
+    timer = StageTimer()
+    with timer("background"):
+        pixels = load_background(spec["bg_path"], spec["bg_sidecar"])
+    height, width = pixels.shape[:2]
+    style = spec["style"]
+
+    normalized = None
+    if spec["level_normalized_cached"]:
+        with timer("normalize"):
+            normalized = _load_cached_grid(spec["level_normalized_path"])
+    if normalized is None:
+        with timer("kde"):
+            grid = None
+            start = 0
+            for index in range(len(spec["levels"]) - 1, -1, -1):
+                if spec["levels"][index]["cached"]:
+                    grid = _load_cached_grid(spec["levels"][index]["path"])
+                    if grid is not None:
+                        start = index + 1
+                        break
+            if grid is None:
+                grid = _density_stage(spec, {}, width, height)
+            for level in spec["levels"][start:]:
+                grid = reduce_grid(grid)
+                save_grid(level["path"], grid)
+        with timer("normalize"):
+            normalized = normalize_density(grid, style.norm)
+            save_grid(spec["level_normalized_path"], normalized)
+
+    cell_size = spec["grid_spacing"] * 2 ** spec["level"]
+    with timer("render"):
+        tile = render_tile_image(pixels, normalized, cell_size, spec["tile"], spec["zoom"],
+                                 parse_color(style.color), style.opacity, style.interpolation,
+                                 with_background=not style.overlay)
+        if style.overlay and style.format == "png":
+            tile = overlay_palette(tile, parse_color(style.color))
+    with timer("encode"):
+        out_path = _save_image(tile, spec["out_path"], style)
+    return out_path, timer.timings
+
+def render_animation(spec):
+    """
+    Строит анимацию по заданию из HeatmapService.prepare_animation и сохраняет файл.
+    Накопленные кадры плотности берутся из кэша сеток или строятся одним проходом
+    по точкам в порядке времени; плотность каждого окна - разность двух кадров
+    плюс остатки у краёв окна. Нормировка общая для всех кадров анимации.
+    Возвращает путь к файлу и время этапов.
+    """
+    timer = StageTimer()
+    with timer("background"):
+        background = background_image(load_background(spec["bg_path"], spec["bg_sidecar"]))
+    width, height = background.size
+    params = (width, height, spec["bandwidth"], spec["grid_spacing"], spec["method"])
+    animation = spec["animation"]
+    style = spec["style"]
+
+    with timer("kde"):
+        xs, ys = as_point_arrays(load_source(spec["points"]))
+        frames = _load_cached_grid(spec["frames_path"]) if spec["frames_cached"] else None
+        if frames is None:
+            frames = build_frames(xs, ys, spec["times"], spec["rows"], *params,
+                                  animation.interval)
+            save_grid(spec["frames_path"], frames)
+        densities = np.stack([
+            window_density(frames, spec["times"], spec["rows"], xs, ys, t0, t1,
+                           animation.interval, *params)
+            for t0, t1 in spec["windows"]])
+    with timer("normalize"):
+        # Общая шкала: иначе яркость одинаковой плотности менялась бы от кадра к кадру
+        normalized = normalize_density(densities, style.norm)
+
+    def images():
+        for grid in normalized:
+            with timer("render"):
+                overlay = render_overlay(grid, spec["grid_spacing"], (width, height),
+                                         parse_color(style.color), style.opacity,
+                                         style.interpolation)
+            with timer("composite"):
+                image = Image.alpha_composite(background, overlay)
+                if image.size != spec["frame_size"]:
+                    image = image.resize(spec["frame_size"], Image.Resampling.BILINEAR,
+                                         reducing_gap=2.0)
+            yield image
+
+    # Кадры строятся по мере записи файла: из общего времени записи вычитаются их этапы
+    with timer("encode"):
+        out_path = save_animation(images(), animation, spec["windows"], spec["out_path"])
+    timer.timings["encode"] -= timer.timings.get("render", 0.0) + timer.timings.get("composite", 0.0)
+    return out_path, timer.timings
+
+
+def render_heatmap_group(specs):
+    """
+    Отрисовывает задания одной страницы подряд в одном процессе: точки
+    загружаются один раз, биннинг (метод fft) переиспользуется между заданиями.
+    Возвращает пары (путь к файлу, время этапов) в порядке specs.
+    """
+    shared = {}
+    return [render_heatmap(spec, shared) for spec in specs]
+
 
 class HeatmapService:
-    def __init__(self):
-        self.raw_data = {}
-        self.cache = {}
-        self.cache_dir = "cache_images"
-        if not os.path.exists(self.cache_dir):
-            os.makedirs(self.cache_dir)
-
-    def store_raw_data(self, page_id, points):
-        if page_id not in self.raw_data:
-            self.raw_data[page_id] = []
-        self.raw_data[page_id].extend(points)
-
-    def generate_heatmap(self, page_id, bandwidth, grid_spacing):
-        cache_key = (page_id, bandwidth, grid_spacing)
-        if cache_key in self.cache:
-            return self.cache[cache_key]
-
-        points = self.raw_data.get(page_id, [])
-        if not points:
+    def __init__(self, hot_params=(), data_dir=None,
+                 memory_cache_bytes=MEMORY_CACHE_BYTES, disk_cache_bytes=DISK_CACHE_BYTES,
+                 grid_cache_bytes=GRID_CACHE_BYTES, background_dir="cache_backgrounds",
+                 background_cache_bytes=BACKGROUND_CACHE_BYTES, kde_workers=1,
+                 cache_dir="cache_images", grid_dir="cache_grids"):
+        self.points = PointStore(data_dir)
+        # Процессов на одну большую карту (parallel_kde); 1 - считать в одном процессе
+        self.kde_workers = kde_workers
+        self.accumulators = {}
+        # Горячие комбинации и счётчики запросов - в порядке последнего запроса
+        self.hot_params = OrderedDict((params, None) for params in hot_params)
+        self.param_requests = OrderedDict()
+        self.lock = threading.RLock()
+        self.flights = SingleFlight()
+        self.cache_dir = cache_dir
+        self.cache = TwoTierCache(self.cache_dir, memory_cache_bytes, disk_cache_bytes)
+        self.grids = GridCache(grid_dir, grid_cache_bytes)
+        # Время взгляда по точкам: page_id -> (версия данных, массив)
+        self.dwell = {}
+        # Без background_dir фон декодируется в кэш процесса (общий с render_heatmap)
+        if background_dir is None:
+            self.backgrounds = BACKGROUNDS
+        else:
+            self.backgrounds = BackgroundCache(background_cache_bytes, background_dir)
+
+    def store_raw_data(self, page_id, points, attributes=None):
+        with self.lock:
+            batch = self.points.append(page_id, points, attributes)
+            accumulators = list(self.accumulators.get(page_id, {}).values())
+            # Под блокировкой только порядок партий; их вклад считается после неё
+            for accumulator in accumulators:
+                accumulator.queue((batch["x"], batch["y"]))
+        for accumulator in accumulators:
+            accumulator.sync()
+        self._drop_stale_cache(page_id)
+
+    def data_version(self, page_id):
+        # Точки только дописываются, поэтому внутри набора данных версию задаёт их число;
+        # поколение страницы отличает другой набор того же размера (новый сегмент,
+        # перезапуск без data_dir, смена узла-владельца) от карт в дисковом кэше.
+        # Без точек - 0
+        count = self.points.count(page_id)
+        return f"{count}-{self.points.generation(page_id)}" if count else 0
+
+    def _drop_stale_cache(self, page_id):
+        # Вне блокировки сервиса: у кэшей свои блокировки, а версия берётся текущая
+        version = canonical_part(self.data_version(page_id))
+        for cache in (self.cache, self.grids):
+            for key in cache.keys():
+                if len(key) > 1 and key[0] == page_id and key[1] != version:
+                    cache.discard(key)
+
+    def resolve_bandwidth(self, page_id, bandwidth):
+        """
+        Число вместо правила выбора bandwidth (auto, scott, silverman) - по потоковой
+        статистике точек страницы; числа возвращаются как есть.
+        """
+        if not is_bandwidth_rule(bandwidth):
+            return bandwidth
+        with self.lock:
+            moments = self.points.point_moments(page_id) if page_id in self.points else None
+            return select_bandwidth(moments, bandwidth)
+
+    def _track_params(self, params):
+        # Нелинейные методы нельзя обновлять прибавлением вклада новых точек
+        if params[2] in NONLINEAR_METHODS:
+            return
+        with self.lock:
+            if params in self.hot_params:
+                self.hot_params.move_to_end(params)
+                return
+            count = self.param_requests.pop(params, 0) + 1
+            if count < HOT_PARAMS_THRESHOLD:
+                self.param_requests[params] = count
+                if len(self.param_requests) > MAX_TRACKED_PARAMS:
+                    self.param_requests.popitem(last=False)
+                return
+            if len(self.hot_params) >= MAX_HOT_PARAMS:
+                # Остывает комбинация, которую дольше всех не запрашивали, - с её сетками
+                cold, _ = self.hot_params.popitem(last=False)
+                for page_id in list(self.accumulators):
+                    self.accumulators[page_id].pop(cold, None)
+                    if not self.accumulators[page_id]:
+                        del self.accumulators[page_id]
+            self.hot_params[params] = None
+
+    def _hot_density(self, page_id, version, count, width, height, params):
+        """
+        Сетка плотности горячей комбинации params для версии данных version
+        (count точек) или None - тогда плотность считает отрисовка.
+        """
+        with self.lock:
+            if params not in self.hot_params:
+                return None
+            accumulator = self.accumulators.get(page_id, {}).get(params)
+        if accumulator is not None and accumulator.matches(width, height):
+            # Копия: загрузки продолжают менять сетку аккумулятора на месте
+            return accumulator.snapshot(count)
+        return self._seed_accumulator(page_id, version, count, (width, height), params)
+
+    def _seed_accumulator(self, page_id, version, count, size, params):
+        """
+        Заводит аккумулятор горячей комбинации по готовой сетке плотности из кэша
+        сеток: KDE по всей странице считает отрисовка в пуле, а не поток запроса.
+        Аккумулятор ставится, только если версия данных не изменилась.
+        Возвращает копию сетки или None, если сетки ещё нет.
+        """
+        width, height = size
+        with self.lock:
+            if params not in self.hot_params:
+                return None
+            existing = self.accumulators.get(page_id, {}).get(params)
+            if existing is not None and existing.matches(width, height):
+                return None
+        cached_path = self.grids.find(self._density_key(page_id, version, *params))
+        cached = _load_cached_grid(cached_path) if cached_path else None
+        accumulator = DensityAccumulator(width, height, *params)
+        if cached is None or cached.shape != accumulator.density.shape:
+            return None
+        accumulator.density[:] = cached
+        accumulator.num_points = count
+        density = accumulator.density.copy()
+        with self.lock:
+            if (params in self.hot_params
+                    and canonical_part(self.data_version(page_id)) == canonical_part(version)):
+                self.accumulators.setdefault(page_id, {})[params] = accumulator
+        return density
+
+    @staticmethod
+    def _slice_suffix(slice_filter):
+        # Срез - последняя часть ключа; без среза ключи прежние
+        return (filter_key(slice_filter),) if slice_filter else ()
+
+    @staticmethod
+    def _style_parts(style):
+        # Кодирование - в ключе, только если оно не по умолчанию: прежние ключи не меняются
+        parts = (style.norm, style.color, style.opacity, style.interpolation)
+        if (style.format, style.level, style.overlay) != (DEFAULT_FORMAT, None, False):
+            parts += (style.format, "" if style.level is None else style.level,
+                      "overlay" if style.overlay else "")
+        return parts
+
+    @classmethod
+    def _image_key(cls, page_id, version, bandwidth, grid_spacing, method, style, slice_filter=()):
+        return normalize_key(page_id, version, bandwidth, grid_spacing, method,
+                             *cls._style_parts(style), *cls._slice_suffix(slice_filter))
+
+    @classmethod
+    def _density_key(cls, page_id, version, bandwidth, grid_spacing, method, slice_filter=()):
+        return normalize_key(page_id, version, "density", bandwidth, grid_spacing, method,
+                             *cls._slice_suffix(slice_filter))
+
+    @classmethod
+    def _tile_key(cls, page_id, version, zoom, tile_x, tile_y, bandwidth, grid_spacing, method,
+                  style, slice_filter=()):
+        return normalize_key(page_id, version, "tile", bandwidth, grid_spacing, method,
+                             *cls._style_parts(style), zoom, tile_x, tile_y,
+                             *cls._slice_suffix(slice_filter))
+
+    @classmethod
+    def _animation_key(cls, page_id, version, bandwidth, grid_spacing, method, style, animation,
+                       slice_filter=()):
+        return normalize_key(page_id, version, "animation", bandwidth, grid_spacing, method,
+                             style.norm, style.color, style.opacity, style.interpolation,
+                             *("" if value is None else value for value in animation),
+                             *cls._slice_suffix(slice_filter))
+
+    def cache_key(self, page_id, bandwidth, grid_spacing, method=DEFAULT_METHOD, style=DEFAULT_STYLE,
+                  slice_filter=()):
+        return self._image_key(page_id, self.data_version(page_id), bandwidth, grid_spacing,
+                               method, style, slice_filter)
+
+    def tile_cache_key(self, page_id, zoom, tile_x, tile_y, bandwidth, grid_spacing,
+                       method=DEFAULT_METHOD, style=DEFAULT_STYLE, slice_filter=()):
+        return self._tile_key(page_id, self.data_version(page_id), zoom, tile_x, tile_y, bandwidth,
+                              grid_spacing, method, style, slice_filter)
+
+    def animation_cache_key(self, page_id, bandwidth, grid_spacing, method=DEFAULT_METHOD,
+                            style=DEFAULT_STYLE, animation=None, slice_filter=()):
+        return self._animation_key(page_id, self.data_version(page_id), bandwidth, grid_spacing,
+                                   method, style, animation, slice_filter)
+
+    def lookup(self, page_id, bandwidth, grid_spacing, method=DEFAULT_METHOD, style=DEFAULT_STYLE,
+               slice_filter=(), as_file=False):
+        self._track_params((bandwidth, grid_spacing, method))
+        return self.cache.get(self.cache_key(page_id, bandwidth, grid_spacing, method, style,
+                                             slice_filter), as_file=as_file)
+
+    def _slice_parts(self, page_id, version, bandwidth, grid_spacing, method, slice_filter):
+        """
+        Части составного среза (см. split_filter): ключ и путь сетки плотности,
+        наличие в кэше и номера строк. Пустой список - срез считается целиком.
+        """
+        parts = split_filter(slice_filter)
+        if len(parts) == 1 or method in NONLINEAR_METHODS:
+            return []
+        result = []
+        for part in parts:
+            key = self._density_key(page_id, version, bandwidth, grid_spacing, method, part)
+            result.append({
+                "density_key": key,
+                "density_path": self.grids.path(key),
+                "density_cached": self.grids.find(key) is not None,
+                "rows": self.points.select(page_id, part),
+            })
+        return result
+
+    def prepare_render(self, page_id, bandwidth, grid_spacing, method=DEFAULT_METHOD,
+                       style=DEFAULT_STYLE, slice_filter=()):
+        """
+        Готовит задание на отрисовку для render_heatmap (можно передать в другой процесс).
+        Возвращает None, если нет точек или фонового изображения.
+        slice_filter - срез по атрибутам (slice_index.parse_filter).
+        """
+        with self.lock:
+            version = self.data_version(page_id)
+            if not version:
+                return None
+            count = self.points.count(page_id)
+            points = self.points.page(page_id).source()
+            rows = None
+            parts = []
+            if slice_filter:
+                # Строки выбираются по индексам под той же блокировкой, что и версия
+                parts = self._slice_parts(page_id, version, bandwidth, grid_spacing, method,
+                                          slice_filter)
+                if not parts:
+                    rows = self.points.select(page_id, slice_filter)
+
+        bg_path = os.path.join("images", f"{page_id}.png")
+        try:
+            # Декодирует фон (или берёт из кэша) и готовит сайдкар для воркеров
+            background = self.backgrounds.get(bg_path)
+        except FileNotFoundError:
             return None
+        img_height, img_width = background.shape[:2]
+
+        cache_key = self._image_key(page_id, version, bandwidth, grid_spacing, method, style,
+                                    slice_filter)
+        density_key = self._density_key(page_id, version, bandwidth, grid_spacing, method,
+                                        slice_filter)
+        normalized_key = normalize_key(page_id, version, "normalized", bandwidth, grid_spacing,
+                                       method, style.norm, *self._slice_suffix(slice_filter))
+        normalized_cached = self.grids.find(normalized_key) is not None
+        density = None
+        density_cached = False
+        params = (bandwidth, grid_spacing, method)
+        if not normalized_cached:
+            if not slice_filter:
+                density = self._hot_density(page_id, version, count, img_width, img_height,
+                                            params)
+            density_cached = density is None and self.grids.find(density_key) is not None
+        return {
+            "cache_key": cache_key,
+            "density_key": density_key,
+            "normalized_key": normalized_key,
+            "bg_path": bg_path,
+            "bg_sidecar": self.backgrounds.sidecar_path(bg_path),
+            "points": points if density is None else None,
+            "rows": rows,
+            "parts": parts,
+            "density": density,
+            "density_cached": density_cached,
+            "density_path": self.grids.path(density_key),
+            "normalized_cached": normalized_cached,
+            "normalized_path": self.grids.path(normalized_key),
+            "bandwidth": bandwidth,
+            "grid_spacing": grid_spacing,
+            "method": method,
+            "style": style,
+            "out_path": self.cache.path(cache_key),
+            "size": (img_width, img_height),
+            "grid_keys": [],
+            "kde_workers": self.kde_workers,
+            # Горячая комбинация без аккумулятора засевается сеткой этой отрисовки
+            "seed": (count, params) if density is None and not slice_filter else None,
+            "kind": "heatmap",
+        }
+
+    def prepare_tile(self, page_id, zoom, tile_x, tile_y, bandwidth, grid_spacing,
+                     method=DEFAULT_METHOD, style=DEFAULT_STYLE, slice_filter=()):
+        """
+        Задание на отрисовку тайла для render_tile. None - нет точек или фона;
+        ValueError - тайла с такими координатами нет.
+        """
+        spec = self.prepare_render(page_id, bandwidth, grid_spacing, method, style, slice_filter)
+        if spec is None:
+            return None
+        width, height = spec["size"]
+        top_zoom = max_zoom(width, height)
+        if not 0 <= zoom <= top_zoom:
+            raise ValueError(f"Zoom must be in [0, {top_zoom}]")
+        scale = tile_scale(zoom, top_zoom)
+        columns, rows = tile_count(width, height, scale)
+        if not (0 <= tile_x < columns and 0 <= tile_y < rows):
+            raise ValueError(f"Tile {tile_x},{tile_y} is outside the {columns}x{rows} grid")
+
+        version = spec["cache_key"][1]
+        suffix = self._slice_suffix(slice_filter)
+        level = pyramid_level(grid_spacing, scale)
+        levels = []
+        for number in range(1, level + 1):
+            key = normalize_key(page_id, version, "pyramid", bandwidth, grid_spacing, method,
+                                number, *suffix)
+            levels.append({"key": key, "path": self.grids.path(key),
+                           "cached": self.grids.find(key) is not None})
+        level_normalized_key = normalize_key(page_id, version, "pyramid_normalized", bandwidth,
+                                             grid_spacing, method, style.norm, level, *suffix)
+        tile_key = self._tile_key(page_id, version, zoom, tile_x, tile_y, bandwidth, grid_spacing,
+                                  method, style, slice_filter)
+        if spec["density"] is None and not spec["density_cached"]:
+            # prepare_render не ищет плотность, если готова нормированная сетка всей карты
+            spec["density_cached"] = self.grids.find(spec["density_key"]) is not None
+        spec.update({
+            "kind": "tile",
+            "cache_key": tile_key,
+            "out_path": self.cache.path(tile_key),
+            "tile": (zoom, tile_x, tile_y),
+            "zoom": top_zoom,
+            "level": level,
+            "levels": levels,
+            "level_normalized_key": level_normalized_key,
+            "level_normalized_path": self.grids.path(level_normalized_key),
+            "level_normalized_cached": self.grids.find(level_normalized_key) is not None,
+            "grid_keys": [entry["key"] for entry in levels] + [level_normalized_key],
+        })
+        return spec
+
+    def _timeline(self, page_id, slice_filter):
+        """
+        Времена точек страницы по возрастанию и номера их строк (из индекса по t;
+        точки без времени не входят). Вызывается под блокировкой.
+        """
+        values, rows = self.points.index(page_id).sorted["t"].merged()
+        # NaN в индексе стоят в конце
+        count = np.searchsorted(values, np.inf, side="right")
+        times, rows = values[:count], rows[:count]
+        if slice_filter:
+            keep = np.isin(rows, self.points.select(page_id, slice_filter), assume_unique=True)
+            times, rows = times[keep], rows[keep]
+        return times.copy(), rows.copy()
+
+    def prepare_animation(self, page_id, bandwidth, grid_spacing, method=DEFAULT_METHOD,
+                          style=DEFAULT_STYLE, slice_filter=(), animation=None):
+        """
+        Задание для render_animation. None - нет точек со временем или фона;
+        ValueError - слишком много кадров (уменьшите период, увеличьте шаг или интервал).
+        """
+        if method in NONLINEAR_METHODS:
+            raise ValueError(f"Method {method} does not support time windows")
+        with self.lock:
+            version = self.data_version(page_id)
+            if not version:
+                return None
+            points = self.points.page(page_id).source()
+            times, rows = self._timeline(page_id, slice_filter)
+        if not len(times):
+            return None
+        start = float(times[0]) if animation.start is None else animation.start
+        # Окна полуоткрытые [t0, t1): по умолчанию конец сразу за последней точкой
+        end = math.nextafter(float(times[-1]), math.inf) if animation.end is None else animation.end
+        if end <= start:
+            raise ValueError("Animation end must be after its start")
+        windows = animation_windows(start, end, animation.step or animation.interval,
+                                    animation.window)
 
         bg_path = os.path.join("images", f"{page_id}.png")
-        if not os.path.exists(bg_path):
+        try:
+            background = self.backgrounds.get(bg_path)
+        except FileNotFoundError:
             return None
+        img_height, img_width = background.shape[:2]
+        grid_h, grid_w = grid_shape(img_width, img_height, grid_spacing)
+        # Проверка до отрисовки: накопленные кадры занимают (число + 1) * сетка ячеек
+        frame_layout(times, animation.interval, grid_h * grid_w)
+        frame_size = (max(1, round(img_width * animation.scale)),
+                      max(1, round(img_height * animation.scale)))
+        if (animation.format != "zip"
+                and len(windows) * frame_size[0] * frame_size[1] > MAX_ANIMATION_PIXELS):
+            raise ValueError("Animation is too large, reduce scale or the number of frames")
+
+        cache_key = self._animation_key(page_id, version, bandwidth, grid_spacing, method, style,
+                                        animation, slice_filter)
+        frames_key = normalize_key(page_id, version, "frames", bandwidth, grid_spacing, method,
+                                   animation.interval, *self._slice_suffix(slice_filter))
+        return {
+            "cache_key": cache_key,
+            "bg_path": bg_path,
+            "bg_sidecar": self.backgrounds.sidecar_path(bg_path),
+            "points": points,
+            "times": times,
+            "rows": rows,
+            "parts": [],
+            "frames_cached": self.grids.find(frames_key) is not None,
+            "frames_path": self.grids.path(frames_key),
+            "bandwidth": bandwidth,
+            "grid_spacing": grid_spacing,
+            "method": method,
+            "style": style,
+            "animation": animation,
+            "windows": windows,
+            "frame_size": frame_size,
+            "out_path": self.cache.path(cache_key),
+            "grid_keys": [frames_key],
+            "kind": "animation",
+        }
+
+    def finish_render(self, spec, result):
+        """
+        Регистрирует готовый файл в кэше и возвращает его содержимое (PNG).
+        result - то, что вернула функция отрисовки: путь к файлу и время этапов
+        (попадает в метрики). Если пока шла отрисовка пришли новые точки,
+        результат отдаётся, но не кэшируется.
+        """
+        out_path, timings = result
+        METRICS.observe_stages(spec["kind"], timings)
+        page_id, version = spec["cache_key"][:2]
+        # У анимации нет сеток плотности всей карты - только накопленные кадры в grid_keys
+        grid_keys = [part["density_key"] for part in spec["parts"]]
+        grid_keys += [spec[name] for name in ("density_key", "normalized_key") if name in spec]
+        grid_keys += spec["grid_keys"]
+        with self.lock:
+            current = version == canonical_part(self.data_version(page_id))
+            if current:
+                for key in grid_keys:
+                    self.grids.add(key)
+                data = self.cache.add_file(spec["cache_key"])
+        if current:
+            if spec.get("seed"):
+                count, params = spec["seed"]
+                self._seed_accumulator(page_id, version, count, spec["size"], params)
+            return data
+        with open(out_path, "rb") as f:
+            data = f.read()
+        for path in [out_path] + [self.grids.path(key) for key in grid_keys]:
+            if os.path.exists(path):
+                os.remove(path)
+        return data
+
+    def generate_heatmap(self, page_id, bandwidth, grid_spacing, method=DEFAULT_METHOD,
+                         style=DEFAULT_STYLE, slice_filter=(), runner=None, as_file=False):
+        """
+        Возвращает PNG тепловой карты (bytes), при необходимости строя её.
+        runner(spec) выполняет отрисовку (по умолчанию - render_heatmap в этом потоке).
+        Одновременные запросы с одним ключом кэша считаются один раз.
+        as_file=True - карта из дискового кэша возвращается открытым файлом (см. TwoTierCache.get).
+        """
+        cached = self.lookup(page_id, bandwidth, grid_spacing, method, style, slice_filter,
+                             as_file)
+        if cached is not None:
+            return cached
+
+        def compute():
+            cached = self.cache.get(key, count_miss=False)
+            if cached is not None:
+                return cached
+            spec = self.prepare_render(page_id, bandwidth, grid_spacing, method, style,
+                                       slice_filter)
+            if spec is None:
+                return None
+            return self.finish_render(spec, (runner or render_heatmap)(spec))
+
+        key = self.cache_key(page_id, bandwidth, grid_spacing, method, style, slice_filter)
+        return self.flights.do(key, compute)
+
+    def generate_tile(self, page_id, zoom, tile_x, tile_y, bandwidth, grid_spacing,
+                      method=DEFAULT_METHOD, style=DEFAULT_STYLE, slice_filter=(), runner=None,
+                      as_file=False):
+        """
+        PNG тайла (z, x, y) тепловой карты; тайлы строятся лениво и кэшируются по отдельности.
+        runner(spec) выполняет отрисовку (по умолчанию - render_tile в этом потоке).
+        """
+        key = self.tile_cache_key(page_id, zoom, tile_x, tile_y, bandwidth, grid_spacing, method,
+                                  style, slice_filter)
+        cached = self.cache.get(key, as_file=as_file)
+        if cached is not None:
+            return cached
+
+        def compute():
+            cached = self.cache.get(key, count_miss=False)
+            if cached is not None:
+                return cached
+            spec = self.prepare_tile(page_id, zoom, tile_x, tile_y, bandwidth, grid_spacing,
+                                     method, style, slice_filter)
+            if spec is None:
+                return None
+            return self.finish_render(spec, (runner or render_tile)(spec))
+
+        return self.flights.do(key, compute)
+
+    def generate_animation(self, page_id, bandwidth, grid_spacing, method=DEFAULT_METHOD,
+                           style=DEFAULT_STYLE, slice_filter=(), animation=None, runner=None,
+                           as_file=False):
+        """
+        Анимация изменения карты во времени (формат - animation.format).
+        runner(spec) выполняет отрисовку (по умолчанию - render_animation в этом потоке).
+        """
+        key = self.animation_cache_key(page_id, bandwidth, grid_spacing, method, style, animation,
+                                       slice_filter)
+        cached = self.cache.get(key, as_file=as_file)
+        if cached is not None:
+            return cached
+
+        def compute():
+            cached = self.cache.get(key, count_miss=False)
+            if cached is not None:
+                return cached
+            spec = self.prepare_animation(page_id, bandwidth, grid_spacing, method, style,
+                                          slice_filter, animation)
+            if spec is None:
+                return None
+            return self.finish_render(spec, (runner or render_animation)(spec))
+
+        return self.flights.do(key, compute)
+
+    def generate_batch(self, items, group_runner=None, parallel=1):
+        """
+        Карты для списка параметров items:
+        [(page_id, bandwidth, grid_spacing, method, style, slice_filter), ...].
+        Готовые карты берутся из кэша, остальные группируются по странице
+        (render_heatmap_group), группы считаются параллельно - до parallel сразу.
+        Выдаёт пары (индекс в items, PNG | None | исключение) по мере готовности.
+        """
+        groups = {}
+        for index, item in enumerate(items):
+            cached = self.lookup(*item)
+            if cached is not None:
+                yield index, cached
+                continue
+            spec = self.prepare_render(*item)
+            if spec is None:
+                yield index, None
+                continue
+            # Одинаковые параметры в одном пакете отрисовываются один раз
+            page_group = groups.setdefault(item[0], {})
+            page_group.setdefault(spec["cache_key"], (spec, []))[1].append(index)
+
+        run_group = group_runner or render_heatmap_group
+        with ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+            futures = {}
+            for page_group in groups.values():
+                # Сначала большие bandwidth: их биннинг с большим запасом подходит остальным
+                entries = sorted(page_group.values(), key=lambda entry: -entry[0]["bandwidth"])
+                futures[executor.submit(run_group, [spec for spec, _ in entries])] = entries
+            for future in as_completed(futures):
+                entries = futures[future]
+                try:
+                    results = future.result()
+                except Exception as e:
+                    for _, indexes in entries:
+                        for index in indexes:
+                            yield index, e
+                    continue
+                for (spec, indexes), result in zip(entries, results):
+                    data = self.finish_render(spec, result)
+                    for index in indexes:
+                        yield index, data
+
+    def _dwell_times(self, page_id, version, columns):
+        # Вызывается под блокировкой; пересчитывается только при новых точках
+        cached = self.dwell.get(page_id)
+        if cached is None or cached[0] != version:
+            cached = (version, dwell_times(columns["t"], columns["session"]))
+            self.dwell[page_id] = cached
+        return cached[1]
+
+    def aoi_stats(self, page_id, regions, bandwidth=None, slice_filter=()):
+        """
+        Статистика по областям интереса regions - [(имя, x0, y0, x1, y1), ...]:
+        число точек и их доля, число сеансов, время взгляда (с) и, если задан
+        bandwidth, масса плотности KDE в области. Точки области находятся
+        по сеточному индексу страницы. None - у страницы нет точек.
+        """
+        with self.lock:
+            version = self.data_version(page_id)
+            if not version:
+                return None
+            columns = self.points.page(page_id).view()
+            xs, ys = columns["x"], columns["y"]
+            index = self.points.spatial_index(page_id)
+            # Версия данных - строка "число-поколение", число точек берётся из хранилища
+            count = self.points.count(page_id)
+            mask = None
+            total = count
+            if slice_filter:
+                mask = np.zeros(count, dtype=bool)
+                mask[self.points.select(page_id, slice_filter)] = True
+                total = int(np.count_nonzero(mask))
+            dwell = self._dwell_times(page_id, version, columns)
+            bandwidth = self.resolve_bandwidth(page_id, bandwidth)
+
+            result = []
+            for name, x0, y0, x1, y1 in regions:
+                rows = index.query(xs, ys, x0, y0, x1, y1)
+                if mask is not None:
+                    rows = rows[mask[rows]]
+                sessions = np.unique(columns["session"][rows])
+                entry = {
+                    "name": name,
+                    "rect": [x0, y0, x1, y1],
+                    "count": len(rows),
+                    "share": len(rows) / total if total else 0.0,
+                    "sessions": int(np.count_nonzero(sessions)),
+                    "dwell": float(dwell[rows].sum()),
+                }
+                if bandwidth is not None:
+                    entry["density"] = region_mass(index, xs, ys, (x0, y0, x1, y1), bandwidth,
+                                                   mask)
+                result.append(entry)
+        return {"page_id": page_id, "points": total, "bandwidth": bandwidth, "regions": result}
 
-        background = Image.open(bg_path).convert("RGBA")
-        img_width, img_height = background.size
-
-        grid_w = int(img_width / grid_spacing)
-        grid_h = int(img_height / grid_spacing)
-        density_grid = [[0.0 for _ in range(grid_w)] for _ in range(grid_h)]
-
-        for i in range(grid_h):
-            y_center = i * grid_spacing + grid_spacing / 2
-            for j in range(grid_w):
-                x_center = j * grid_spacing + grid_spacing / 2
-                density = 0.0
-                for (px, py) in points:
-                    dx = x_center - px
-                    dy = y_center - py
-                    dist_sq = dx*dx + dy*dy
-                    density += self.gaussian_kernel(dist_sq, bandwidth)
-                density_grid[i][j] = density
-
-        normalized_grid = self.normalize_density_grid(density_grid)
-
-        heatmap = Image.new("RGBA", (img_width, img_height), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(heatmap)
-        for i in range(grid_h):
-            for j in range(grid_w):
-                intensity = normalized_grid[i][j]
-                color = (255, 0, 0, intensity)
-                x0 = int(j * grid_spacing)
-                y0 = int(i * grid_spacing)
-                x1 = int((j+1) * grid_spacing)
-                y1 = int((i+1) * grid_spacing)
-                draw.rectangle([x0, y0, x1, y1], fill=color)
-
-        result_image = Image.alpha_composite(background, heatmap)
-        out_path = os.path.join(self.cache_dir, f"heatmap_{page_id}_{bandwidth}_{grid_spacing}.png")
-        result_image.save(out_path)
-
-        self.cache[cache_key] = out_path
-        return out_path
+    def stats(self):
+        # Загрузка в другом потоке может завести страницу и её индексы во время обхода
+        with self.lock:
+            stats = self.points.stats()
+        stats["renders"] = self.flights.stats()
+        stats["cache"] = self.cache.stats()
+        stats["cache"]["grids"] = self.grids.stats()
+        stats["cache"]["backgrounds"] = self.backgrounds.stats()
+        return stats
 
     @staticmethod
     def gaussian_kernel(dist_sq, bandwidth):
@@ -0,0 +1,224 @@
+import heapq
+import itertools
+import threading
+import time
+import uuid
+
+from heatmap_cache import canonical_part
+from render_pool import RenderPoolBusy
+
+# Приоритеты заданий: меньшее значение обслуживается раньше
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+DEFAULT_PRIORITY = "normal"
+
+MAX_JOBS_PER_CLIENT = 4
+# Сколько секунд хранится завершённое задание (статус и ссылка на результат)
+JOB_TTL_SECONDS = 600
+# Пауза перед повторной попыткой, если пул отрисовки переполнен
+BUSY_RETRY_SECONDS = 0.5
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+NOT_FOUND = "not_found"
+FINISHED = (DONE, FAILED, CANCELLED, NOT_FOUND)
+
+
+class JobLimitExceeded(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, client, priority, params, order, job_id=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.client = client
+        self.priority = priority
+        self.order = order
+        self.params = params
+        self.status = QUEUED
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.result_key = None
+        # Байты результата держим, только если его нет в кэше сервиса
+        # (пока шла отрисовка, пришли новые точки)
+        self.result = None
+
+    def to_dict(self):
+        info = {
+            "id": self.id,
+            "status": self.status,
+            "priority": self.priority,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            # Формат результата (params[4] - оформление карты)
+            "format": self.params[4].format,
+        }
+        if self.error is not None:
+            info["error"] = self.error
+        return info
+
+
+class JobQueue:
+    """
+    Асинхронные задания на отрисовку: очередь с приоритетами и рабочие потоки,
+    которые вызывают service.generate_heatmap (тяжёлая часть идёт в runner,
+    обычно в пул процессов). HTTP-запрос только ставит задание и сразу отвечает.
+    У каждого клиента не больше max_per_client незавершённых заданий.
+    Отмена снимает задание из очереди; уже идущая отрисовка доводится до конца
+    (её результат попадает в кэш), но задание помечается отменённым.
+    new_id - функция, выдающая номер нового задания (по умолчанию случайный uuid).
+    """
+
+    def __init__(self, service, workers=1, runner=None, max_per_client=MAX_JOBS_PER_CLIENT,
+                 ttl=JOB_TTL_SECONDS, new_id=None):
+        self.service = service
+        self.runner = runner
+        self.new_id = new_id
+        self.max_per_client = max_per_client
+        self.ttl = ttl
+        self.jobs = {}
+        self.active = {}  # клиент -> число незавершённых заданий
+        self.heap = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, client, params, priority=DEFAULT_PRIORITY):
+        """
+        params - (page_id, bandwidth, grid_spacing, method, style, slice_filter).
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}")
+        with self.condition:
+            self._expire()
+            if self.active.get(client, 0) >= self.max_per_client:
+                raise JobLimitExceeded()
+            job = Job(client, priority, params, (PRIORITIES[priority], next(self.counter)),
+                      self.new_id() if self.new_id is not None else None)
+            self.jobs[job.id] = job
+            self.active[client] = self.active.get(client, 0) + 1
+            heapq.heappush(self.heap, job.order + (job,))
+            self.condition.notify()
+            return job
+
+    def get(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            info = job.to_dict()
+            if job.status == QUEUED:
+                info["position"] = sum(1 for entry in self.heap
+                                       if entry[2].status == QUEUED and entry[:2] < job.order)
+            return info
+
+    def result(self, job_id):
+        """
+        (статус, PNG или None). PNG берётся из кэша сервиса по ключу результата.
+        """
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None, None
+            if job.status != DONE:
+                return job.status, None
+            key, data = job.result_key, job.result
+        if data is None:
+            data = self.service.cache.get(key)
+        return DONE, data
+
+    def cancel(self, job_id):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job.status in (QUEUED, RUNNING):
+                # Из кучи не удаляем: рабочий поток пропустит отменённое задание
+                self._finish(job, CANCELLED)
+            return job.to_dict()
+
+    def _finish(self, job, status, error=None):
+        job.status = status
+        job.error = error
+        job.finished = time.time()
+        self.active[job.client] -= 1
+        if not self.active[job.client]:
+            del self.active[job.client]
+
+    def _expire(self):
+        deadline = time.time() - self.ttl
+        for job_id in [job_id for job_id, job in self.jobs.items()
+                       if job.status in FINISHED and job.finished < deadline]:
+            del self.jobs[job_id]
+
+    def _next_job(self):
+        with self.condition:
+            while True:
+                if self.stopped:
+                    return None
+                while self.heap and self.heap[0][2].status != QUEUED:
+                    heapq.heappop(self.heap)
+                if self.heap:
+                    job = heapq.heappop(self.heap)[2]
+                    job.status = RUNNING
+                    job.started = time.time()
+                    return job
+                self.condition.wait()
+
+    def _worker(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            page_id = job.params[0]
+            try:
+                key = self.service.cache_key(*job.params)
+                data = self._render(job)
+            except Exception as e:
+                with self.condition:
+                    if job.status == RUNNING:
+                        self._finish(job, FAILED, str(e))
+                continue
+            with self.condition:
+                if job.status != RUNNING:
+                    continue
+                if data is None:
+                    self._finish(job, NOT_FOUND)
+                    continue
+                job.result_key = key
+                if key[1] != canonical_part(self.service.data_version(page_id)):
+                    # Версия данных сменилась - результат в кэш не попал
+                    job.result = data
+                self._finish(job, DONE)
+
+    def _render(self, job):
+        while True:
+            try:
+                return self.service.generate_heatmap(*job.params, runner=self.runner)
+            except RenderPoolBusy:
+                # Пул занят синхронными запросами: ждём, не теряя задания
+                if job.status != RUNNING:
+                    return None
+                time.sleep(BUSY_RETRY_SECONDS)
+
+    def stats(self):
+        with self.condition:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+            return {"jobs": counts, "clients": len(self.active)}
+
+    def shutdown(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,324 @@
+import math
+
+import numpy as np
+
+# Сколько элементов float64 допускаем в одной промежуточной матрице ядра
+BATCH_ELEMENTS = 1 << 22
+
+# Ядро для метода fft обрезается на таком числе bandwidth
+FFT_KERNEL_SIGMAS = 5
+# Сколько бинов должно приходиться на один bandwidth в методе fft
+FFT_BINS_PER_BANDWIDTH = 2
+
+DEFAULT_METHOD = "brute"
+
+# Адаптивный KDE: число классов bandwidth и предел локального множителя (в обе стороны)
+ADAPTIVE_CLASSES = 8
+ADAPTIVE_MAX_FACTOR = 4.0
+
+
+def as_point_arrays(points):
+    """
+    Переводит точки ([[x, y], ...] или пару массивов) в два массива
+    с плавающей точкой - в таком виде их принимают все методы KDE.
+    """
+    if isinstance(points, tuple) and len(points) == 2:
+        # Колонки float32 из хранилища точек используются без копирования
+        xs, ys = (np.asarray(column) for column in points)
+        if xs.dtype.kind != "f" or ys.dtype.kind != "f":
+            xs, ys = xs.astype(np.float64), ys.astype(np.float64)
+        return xs, ys
+    arr = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    return np.ascontiguousarray(arr[:, 0]), np.ascontiguousarray(arr[:, 1])
+
+
+def grid_shape(width, height, grid_spacing):
+    return int(height / grid_spacing), int(width / grid_spacing)
+
+
+def cell_centers(count, grid_spacing):
+    return np.arange(count, dtype=np.float64) * grid_spacing + grid_spacing / 2
+
+
+def effective_bandwidth(bandwidth):
+    return bandwidth if bandwidth > 0 else 1.0
+
+
+def kde_brute(xs, ys, width, height, bandwidth, grid_spacing):
+    """
+    Точный KDE по всем точкам (аналог kde_brute_force).
+    Гауссово ядро сепарабельно: exp(-(dx^2+dy^2)/2h^2) = gy(dy) * gx(dx),
+    поэтому сетка плотности - это Ky @ Kx.T, считаемая пачками точек.
+    """
+    bandwidth = effective_bandwidth(bandwidth)
+    grid_h, grid_w = grid_shape(width, height, grid_spacing)
+    density = np.zeros((grid_h, grid_w), dtype=np.float64)
+    if grid_h == 0 or grid_w == 0 or len(xs) == 0:
+        return density
+
+    x_centers = cell_centers(grid_w, grid_spacing)
+    y_centers = cell_centers(grid_h, grid_spacing)
+    inv_two_h2 = 1.0 / (2 * bandwidth * bandwidth)
+    batch = max(1, BATCH_ELEMENTS // (grid_h + grid_w))
+
+    for start in range(0, len(xs), batch):
+        dx = x_centers[:, None] - xs[None, start:start + batch]
+        dy = y_centers[:, None] - ys[None, start:start + batch]
+        kx = np.exp(-(dx * dx) * inv_two_h2)
+        ky = np.exp(-(dy * dy) * inv_two_h2)
+        density += ky @ kx.T
+
+    density *= 1.0 / (2 * math.pi * bandwidth * bandwidth)
+    return density
+
+
+def kde_accumulate(xs, ys, width, height, bandwidth, grid_spacing):
+    """
+    KDE с ограниченным радиусом влияния ~3*bandwidth (аналог kde_accumulate).
+    """
+    density = np.zeros(grid_shape(width, height, grid_spacing), dtype=np.float64)
+    add_accumulate(density, xs, ys, bandwidth, grid_spacing)
+    return density
+
+
+def add_accumulate(density, xs, ys, bandwidth, grid_spacing):
+    """
+    Добавляет в density (на месте) вклад точек в пределах радиуса ~3*bandwidth.
+    Вместо цикла по точкам перебираем смещения (di, dj) внутри радиуса
+    и для каждого смещения обрабатываем сразу все точки, так что стоимость
+    зависит только от числа новых точек, а не от размера сетки.
+    """
+    if not density.flags.c_contiguous:
+        raise ValueError("density must be a C-contiguous array")
+    bandwidth = effective_bandwidth(bandwidth)
+    grid_h, grid_w = density.shape
+    if grid_h == 0 or grid_w == 0 or len(xs) == 0:
+        return density
+
+    radius = 3 * bandwidth
+    radius_sq = radius * radius
+    cell_radius = int(math.ceil(radius / grid_spacing))
+    inv_two_h2 = 1.0 / (2 * bandwidth * bandwidth)
+    norm = 1.0 / (2 * math.pi * bandwidth * bandwidth)
+
+    center_i = np.floor_divide(ys, grid_spacing).astype(np.int64)
+    center_j = np.floor_divide(xs, grid_spacing).astype(np.int64)
+
+    flat = density.reshape(-1)
+    for di in range(-cell_radius, cell_radius + 1):
+        i = center_i + di
+        row_ok = (i >= 0) & (i < grid_h)
+        dy = i * grid_spacing + grid_spacing / 2 - ys
+        dy_sq = dy * dy
+        indices = []
+        weights = []
+        for dj in range(-cell_radius, cell_radius + 1):
+            j = center_j + dj
+            dx = j * grid_spacing + grid_spacing / 2 - xs
+            dist_sq = dx * dx + dy_sq
+            mask = row_ok & (j >= 0) & (j < grid_w) & (dist_sq <= radius_sq)
+            indices.append(i[mask] * grid_w + j[mask])
+            weights.append(np.exp(-dist_sq[mask] * inv_two_h2) * norm)
+        indices = np.concatenate(indices)
+        weights = np.concatenate(weights)
+        if len(indices) * 4 < flat.size:
+            # Мало точек: трогаем только ячейки в их окрестности
+            np.add.at(flat, indices, weights)
+        else:
+            flat += np.bincount(indices, weights=weights, minlength=flat.size)
+    return density
+
+
+def bin_points_linear(xs, ys, grid_h, grid_w, grid_spacing, pad=0):
+    """
+    Линейное (билинейное) биннинг-распределение точек по центрам ячеек:
+    каждая точка делит единичный вес между четырьмя ближайшими центрами.
+    Сетка расширяется на pad ячеек с каждой стороны, точки за её пределами
+    отбрасываются. Возвращает массив формы (grid_h + 2*pad, grid_w + 2*pad).
+    """
+    ext_h, ext_w = grid_h + 2 * pad, grid_w + 2 * pad
+    fx = xs.astype(np.float64) / grid_spacing - 0.5 + pad
+    fy = ys.astype(np.float64) / grid_spacing - 0.5 + pad
+    j0 = np.floor(fx)
+    i0 = np.floor(fy)
+    tx = fx - j0
+    ty = fy - i0
+    j0 = j0.astype(np.int64)
+    i0 = i0.astype(np.int64)
+
+    keep = (j0 >= 0) & (j0 + 1 < ext_w) & (i0 >= 0) & (i0 + 1 < ext_h)
+    j0, i0, tx, ty = j0[keep], i0[keep], tx[keep], ty[keep]
+    base = i0 * ext_w + j0
+    indices = np.concatenate((base, base + 1, base + ext_w, base + ext_w + 1))
+    weights = np.concatenate(((1 - ty) * (1 - tx), (1 - ty) * tx, ty * (1 - tx), ty * tx))
+    binned = np.bincount(indices, weights=weights, minlength=ext_h * ext_w)
+    return binned.reshape(ext_h, ext_w)
+
+
+def shared_binning(xs, ys, grid_h, grid_w, grid_spacing, pad, bins=None):
+    """
+    bin_points_linear с переиспользованием: bins - словарь, общий для вызовов
+    по одним и тем же точкам. Сетка с большим pad содержит сетку с меньшим,
+    поэтому результат вырезается из уже посчитанного биннинга.
+    """
+    if bins is None:
+        return bin_points_linear(xs, ys, grid_h, grid_w, grid_spacing, pad)
+    key = (grid_h, grid_w, grid_spacing)
+    cached = bins.get(key)
+    if cached is None or cached[0] < pad:
+        cached = (pad, bin_points_linear(xs, ys, grid_h, grid_w, grid_spacing, pad))
+        bins[key] = cached
+    offset = cached[0] - pad
+    binned = cached[1]
+    return binned[offset:binned.shape[0] - offset, offset:binned.shape[1] - offset]
+
+
+def kde_fft(xs, ys, width, height, bandwidth, grid_spacing, bins=None):
+    """
+    Приближённый KDE через биннинг и свёртку: точки раскладываются по сетке
+    (bin_points_linear), затем сетка сворачивается с гауссовым ядром через FFT.
+    Сложность O(N + M log M) - после биннинга число точек уже не важно.
+    Если ячейка крупнее bandwidth / FFT_BINS_PER_BANDWIDTH, биннинг идёт на
+    более мелкой сетке (нечётное число подъячеек), а результат берётся
+    в центрах исходных ячеек - иначе ошибка биннинга заметна.
+    bins - см. shared_binning.
+    """
+    bandwidth = effective_bandwidth(bandwidth)
+    grid_h, grid_w = grid_shape(width, height, grid_spacing)
+    if grid_h == 0 or grid_w == 0 or len(xs) == 0:
+        return np.zeros((grid_h, grid_w), dtype=np.float64)
+
+    sub = int(math.ceil(FFT_BINS_PER_BANDWIDTH * grid_spacing / bandwidth))
+    sub = max(1, sub | 1)
+    spacing = grid_spacing / sub
+    pad = int(math.ceil(FFT_KERNEL_SIGMAS * bandwidth / spacing))
+    binned = shared_binning(xs, ys, grid_h * sub, grid_w * sub, spacing, pad, bins)
+
+    offsets = np.arange(-pad, pad + 1) * spacing
+    profile = np.exp(-(offsets * offsets) / (2 * bandwidth * bandwidth))
+    kernel = np.outer(profile, profile)
+
+    # Линейная (не циклическая) свёртка: дополняем нулями до полного размера
+    shape = (binned.shape[0] + 2 * pad, binned.shape[1] + 2 * pad)
+    spectrum = np.fft.rfft2(binned, shape) * np.fft.rfft2(kernel, shape)
+    full = np.fft.irfft2(spectrum, shape)
+
+    # Центр исходной ячейки i совпадает с центром подъячейки i*sub + sub//2
+    start = 2 * pad + sub // 2
+    density = full[start:start + grid_h * sub:sub, start:start + grid_w * sub:sub]
+    density = np.maximum(density, 0.0)
+    density *= 1.0 / (2 * math.pi * bandwidth * bandwidth)
+    return np.ascontiguousarray(density)
+
+
+def adaptive_factors(xs, ys, width, height, bandwidth, grid_spacing, bins=None):
+    """
+    Локальные множители bandwidth по Абрамсону: lambda_i = (f(x_i) / g) ** -0.5,
+    где f - пилотная оценка (fft с исходным bandwidth) в ячейке точки, g - среднее
+    геометрическое f по точкам. В плотных местах ядро уже, в редких - шире.
+    """
+    pilot = kde_fft(xs, ys, width, height, bandwidth, grid_spacing, bins)
+    grid_h, grid_w = pilot.shape
+    i = np.clip(np.floor_divide(ys, grid_spacing).astype(np.int64), 0, grid_h - 1)
+    j = np.clip(np.floor_divide(xs, grid_spacing).astype(np.int64), 0, grid_w - 1)
+    values = pilot[i, j]
+    # Точки вне сетки и на пустом пилоте получают наибольший множитель
+    log_values = np.log(np.maximum(values, max(values.max(), 1e-300) * 1e-12))
+    factors = np.exp(-0.5 * (log_values - log_values.mean()))
+    return np.clip(factors, 1 / ADAPTIVE_MAX_FACTOR, ADAPTIVE_MAX_FACTOR)
+
+
+def kde_adaptive(xs, ys, width, height, bandwidth, grid_spacing, bins=None):
+    """
+    KDE с переменным bandwidth: множители adaptive_factors округляются до
+    ADAPTIVE_CLASSES уровней (геометрическая шкала), и каждый класс точек
+    считается методом fft со своим bandwidth - это 1 + ADAPTIVE_CLASSES свёрток
+    вместо отдельного ядра на точку. bins - общий биннинг для пилотной оценки.
+    """
+    bandwidth = effective_bandwidth(bandwidth)
+    grid_h, grid_w = grid_shape(width, height, grid_spacing)
+    density = np.zeros((grid_h, grid_w), dtype=np.float64)
+    if grid_h == 0 or grid_w == 0 or len(xs) == 0:
+        return density
+
+    factors = adaptive_factors(xs, ys, width, height, bandwidth, grid_spacing, bins)
+    levels = np.geomspace(1 / ADAPTIVE_MAX_FACTOR, ADAPTIVE_MAX_FACTOR, ADAPTIVE_CLASSES)
+    classes = np.rint(np.log(factors / levels[0]) / np.log(levels[1] / levels[0])).astype(np.int64)
+    for level in np.unique(classes):
+        selected = classes == level
+        density += kde_fft(xs[selected], ys[selected], width, height,
+                           bandwidth * levels[level], grid_spacing)
+    return density
+
+
+KDE_METHODS = {
+    "brute": kde_brute,
+    "accumulate": kde_accumulate,
+    "fft": kde_fft,
+    "adaptive": kde_adaptive,
+}
+
+
+# Методы, умеющие добавлять вклад новых точек в готовую сетку,
+# не трогая остальные ячейки: add(density, xs, ys, bandwidth, grid_spacing)
+INCREMENTAL_METHODS = {
+    "accumulate": add_accumulate,
+}
+
+
+# Методы, принимающие bins (общий биннинг для нескольких расчётов по одним точкам)
+SHARED_BINNING_METHODS = {"fft", "adaptive"}
+
+
+# Методы, плотность которых не равна сумме плотностей частей точек (bandwidth
+# точки зависит от всех остальных): для них нет инкрементальных сеток,
+# срезы не складываются из частей, окна времени не считаются разностью кадров
+NONLINEAR_METHODS = {"adaptive"}
+
+
+def register_method(name, func):
+    """
+    Подключает новый метод KDE. func(xs, ys, width, height, bandwidth, grid_spacing)
+    должна возвращать массив float64 формы (grid_h, grid_w).
+    """
+    KDE_METHODS[name] = func
+
+
+def compute_density(points, width, height, bandwidth, grid_spacing, method=DEFAULT_METHOD,
+                    bins=None):
+    """
+    Считает сетку плотности выбранным методом.
+    bins - словарь для общего биннинга между вызовами по тем же точкам.
+    """
+    if method not in KDE_METHODS:
+        raise ValueError(f"Unknown KDE method: {method}")
+    xs, ys = as_point_arrays(points)
+    if bins is not None and method in SHARED_BINNING_METHODS:
+        return KDE_METHODS[method](xs, ys, width, height, bandwidth, grid_spacing, bins=bins)
+    return KDE_METHODS[method](xs, ys, width, height, bandwidth, grid_spacing)
+
+
+# Шкалы нормировки: доля от максимума v в [0..1] -> доля яркости
+LOG_SCALE = 100.0
+NORMALIZATIONS = {
+    "linear": lambda v: v,
+    "sqrt": np.sqrt,
+    "log": lambda v: np.log1p(LOG_SCALE * v) / math.log1p(LOG_SCALE),
+}
+DEFAULT_NORMALIZATION = "linear"
+
+
+def normalize_density(density, scale=DEFAULT_NORMALIZATION):
+    """
+    Нормирует сетку плотности в диапазон [0..255] (uint8) по шкале scale.
+    """
+    if density.size == 0:
+        return np.zeros(density.shape, dtype=np.uint8)
+    min_val = density.min()
+    max_val = density.max()
+    if max_val - min_val == 0:
+        return np.zeros(density.shape, dtype=np.uint8)
+    if scale == "linear":
+        return (255 * (density - min_val) / (max_val - min_val)).astype(np.uint8)
+    fraction = (np.asarray(density, dtype=np.float64) - min_val) / (max_val - min_val)
+    return (255 * NORMALIZATIONS[scale](fraction)).astype(np.uint8)
@@ -2,10 +2,25 @@ from server import run_server
 
 def main():
     import os
-    if not os.path.exists("cache_images"):
-        os.makedirs("cache_images")
+    render_workers = int(os.getenv("RENDER_WORKERS", os.cpu_count() or 1))
+    max_pending = int(os.getenv("RENDER_QUEUE", 8))
+    job_workers = int(os.getenv("JOB_WORKERS", 0))
+    kde_workers = int(os.getenv("KDE_WORKERS", 1))
+    profile_slow_ms = float(os.getenv("PROFILE_SLOW_MS", 0))
+    profile_dir = os.getenv("PROFILE_DIR", "profiles")
+    # Кластер: файл со списком узлов и имя этого узла в нём
+    cluster_config = os.getenv("CLUSTER_CONFIG")
+    node_id = os.getenv("NODE_ID")
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", 8080))
+    # Свои каталоги точек и кэшей у каждого узла (несколько узлов из одного каталога)
+    data_dir = os.getenv("DATA_DIR", "data")
+    cache_dir = os.getenv("CACHE_DIR", ".")
     print("Starting Heatmap System server...")
-    run_server(host="0.0.0.0", port=8080)
+    run_server(host=host, port=port, render_workers=render_workers, max_pending=max_pending,
+               job_workers=job_workers, kde_workers=kde_workers, profile_slow_ms=profile_slow_ms,
+               profile_dir=profile_dir, cluster_config=cluster_config, node_id=node_id,
+               data_dir=data_dir, cache_dir=cache_dir)
 
 if __name__ == "__main__":
     main()
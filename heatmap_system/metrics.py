@@ -0,0 +1,288 @@
+import heapq
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# Границы корзин гистограмм времени, секунды
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Маршруты для меток: всё остальное - "other", чтобы число рядов не росло от путей
+ROUTE_PATTERNS = (
+    (re.compile(r"^/heatmap/tiles/"), "/heatmap/tiles"),
+    (re.compile(r"^/heatmap/jobs/[0-9a-f]{32}/result$"), "/heatmap/jobs/{id}/result"),
+    (re.compile(r"^/heatmap/jobs/[0-9a-f]{32}$"), "/heatmap/jobs/{id}"),
+)
+ROUTES = {"/heatmap", "/heatmap/animation", "/heatmap/aoi", "/heatmap/batch", "/heatmap/jobs",
+          "/upload_data", "/stats", "/metrics", "/debug/slow"}
+
+# Профилировщик медленных запросов: период выборки стеков и сколько запросов хранить
+PROFILE_INTERVAL = 0.01
+PROFILE_KEEP = 20
+PROFILE_MAX_DEPTH = 64
+
+
+def route_label(path):
+    if path in ROUTES:
+        return path
+    for pattern, label in ROUTE_PATTERNS:
+        if pattern.match(path):
+            return label
+    return "other"
+
+
+class StageTimer:
+    """
+    Время этапов отрисовки: with timer("kde"): ... Повторный этап суммируется.
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+
+
+def _escape(value):
+    # Экранирование значения метки по формату Prometheus: \\, \" и \n
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_histogram(lines, name, help_text, histograms, label_names):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for label_values, histogram in sorted(histograms.items()):
+        labels = dict(zip(label_names, label_values))
+        total = 0
+        for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+            total += count
+            lines.append(f"{name}_bucket{_labels(**labels, le=bound)} {total}")
+        lines.append(f"{name}_sum{_labels(**labels)} {histogram.sum}")
+        lines.append(f"{name}_count{_labels(**labels)} {total}")
+
+
+def _format_metric(lines, name, metric_type, help_text, samples):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {metric_type}")
+    for labels, value in samples:
+        lines.append(f"{name}{_labels(**labels) if labels else ''} {value}")
+
+
+def process_rss():
+    """
+    Резидентная память процесса в байтах (0, если узнать нельзя).
+    """
+    try:
+        with open("/proc/self/statm", "r", encoding="ascii") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    # ru_maxrss - пик, а не текущее значение; в Linux в килобайтах, в macOS в байтах
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Metrics:
+    """
+    Счётчики и гистограммы сервера: время запросов по маршрутам, время этапов
+    отрисовки. Остальное (кэши, точки, память) берётся из состояния при выдаче.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.responses = Counter()
+        self.stages = {}
+        self.started = time.time()
+
+    def observe_request(self, route, method, status, seconds):
+        with self.lock:
+            histogram = self.requests.setdefault((route, method), Histogram())
+            histogram.observe(seconds)
+            self.responses[(route, method, str(status))] += 1
+
+    def observe_stages(self, kind, timings):
+        with self.lock:
+            for stage, seconds in timings.items():
+                self.stages.setdefault((kind, stage), Histogram()).observe(seconds)
+
+    def render(self, stats=None, render_pool=None, jobs=None):
+        """
+        Текст в формате Prometheus. stats - HeatmapService.stats().
+        """
+        lines = []
+        with self.lock:
+            _format_histogram(lines, "heatmap_http_request_duration_seconds",
+                              "HTTP request latency by route.", self.requests, ("route", "method"))
+            _format_metric(lines, "heatmap_http_responses_total", "counter",
+                           "HTTP responses by route and status.",
+                           [(dict(route=route, method=method, status=status), count)
+                            for (route, method, status), count in sorted(self.responses.items())])
+            _format_histogram(lines, "heatmap_render_stage_seconds",
+                              "Time spent in each render stage.", self.stages, ("kind", "stage"))
+        if stats is not None:
+            self._render_service(lines, stats)
+        if render_pool is not None:
+            _format_metric(lines, "heatmap_render_pool_in_flight", "gauge",
+                           "Tasks submitted to the render process pool and not finished.",
+                           [({}, render_pool.in_flight)])
+        if jobs is not None:
+            _format_metric(lines, "heatmap_jobs", "gauge", "Render jobs by status.",
+                           [(dict(status=status), count)
+                            for status, count in sorted(jobs.stats()["jobs"].items())])
+        _format_metric(lines, "heatmap_process_resident_memory_bytes", "gauge",
+                       "Resident memory of the server process.", [({}, process_rss())])
+        _format_metric(lines, "heatmap_process_uptime_seconds", "gauge",
+                       "Seconds since the server started.", [({}, time.time() - self.started)])
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _render_service(lines, stats):
+        backgrounds = stats["cache"]["backgrounds"]
+        caches = {"memory": stats["cache"]["memory"], "disk": stats["cache"]["disk"],
+                  "grids": stats["cache"]["grids"],
+                  # Промах кэша фонов - декодирование или чтение сайдкара
+                  "backgrounds": dict(backgrounds, misses=backgrounds["decodes"]
+                                      + backgrounds["sidecar_loads"])}
+        for name, metric_type, help_text, field in (
+                ("heatmap_cache_hits_total", "counter", "Cache hits by tier.", "hits"),
+                ("heatmap_cache_misses_total", "counter", "Cache misses by tier.", "misses"),
+                ("heatmap_cache_evictions_total", "counter", "Cache evictions by tier.", "evictions"),
+                ("heatmap_cache_bytes", "gauge", "Bytes held by each cache tier.", "bytes")):
+            _format_metric(lines, name, metric_type, help_text,
+                           [(dict(cache=cache), values[field]) for cache, values in caches.items()])
+        ratios = []
+        for cache, values in caches.items():
+            lookups = values["hits"] + values["misses"]
+            ratios.append((dict(cache=cache), values["hits"] / lookups if lookups else 0.0))
+        _format_metric(lines, "heatmap_cache_hit_ratio", "gauge",
+                       "Share of lookups served by each cache tier.", ratios)
+        _format_metric(lines, "heatmap_background_loads_total", "counter",
+                       "Background images decoded or loaded from sidecars.",
+                       [(dict(source="decode"), backgrounds["decodes"]),
+                        (dict(source="sidecar"), backgrounds["sidecar_loads"])])
+
+        renders = stats["renders"]
+        _format_metric(lines, "heatmap_renders_total", "counter", "Renders actually computed.",
+                       [({}, renders["computations"])])
+        _format_metric(lines, "heatmap_renders_coalesced_total", "counter",
+                       "Requests that waited for an identical render in progress.",
+                       [({}, renders["coalesced"])])
+        _format_metric(lines, "heatmap_renders_in_flight", "gauge", "Renders in progress.",
+                       [({}, renders["in_flight"])])
+        _format_metric(lines, "heatmap_page_points", "gauge", "Stored points per page.",
+                       [(dict(page=page), values["points"])
+                        for page, values in sorted(stats["pages"].items())])
+        _format_metric(lines, "heatmap_page_bytes", "gauge", "Bytes of stored points per page.",
+                       [(dict(page=page), values["bytes"])
+                        for page, values in sorted(stats["pages"].items())])
+
+
+class SlowRequestProfiler:
+    """
+    Выборочный профилировщик: пока идёт запрос, фоновый поток раз в interval
+    снимает стек его потока (sys._current_frames). Запросы дольше threshold
+    секунд попадают в список самых медленных (keep штук), который пишется
+    в out_dir/slow_requests.json: путь, время и свёрнутые стеки с числом выборок
+    (формат folded для flamegraph). Работа в процессах пула отрисовки видна как
+    ожидание результата.
+    """
+
+    def __init__(self, threshold, out_dir, interval=PROFILE_INTERVAL, keep=PROFILE_KEEP):
+        self.threshold = threshold
+        self.out_dir = out_dir
+        self.interval = interval
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.active = {}
+        self.slowest = []
+        self.counter = 0
+        os.makedirs(out_dir, exist_ok=True)
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                for thread_id, samples in self.active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[self._fold(frame)] += 1
+
+    @staticmethod
+    def _fold(frame):
+        names = []
+        while frame is not None and len(names) < PROFILE_MAX_DEPTH:
+            code = frame.f_code
+            names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def start(self):
+        with self.lock:
+            self.active[threading.get_ident()] = Counter()
+
+    def stop(self, method, path, status, seconds):
+        with self.lock:
+            samples = self.active.pop(threading.get_ident(), Counter())
+            if seconds < self.threshold:
+                return
+            self.counter += 1
+            entry = (seconds, self.counter, {
+                "method": method, "path": path, "status": status,
+                "seconds": round(seconds, 4), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "samples": dict(samples.most_common()),
+            })
+            if len(self.slowest) < self.keep:
+                heapq.heappush(self.slowest, entry)
+            elif seconds > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, entry)
+            else:
+                return
+            report = [item[2] for item in sorted(self.slowest, reverse=True)]
+        path = os.path.join(self.out_dir, "slow_requests.json")
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=1)
+        os.replace(tmp_path, path)
+
+    def report(self):
+        with self.lock:
+            return [item[2] for item in sorted(self.slowest, reverse=True)]
+
+
+# Метрики процесса сервера (как BACKGROUNDS в background_cache - один экземпляр на процесс)
+METRICS = Metrics()
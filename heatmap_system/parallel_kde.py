@@ -0,0 +1,119 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from kde_engine import FFT_KERNEL_SIGMAS, KDE_METHODS, effective_bandwidth, grid_shape
+
+# Запас полосы по y в bandwidth: accumulate сам обрезает ядро на 3*bandwidth (результат
+# совпадает с расчётом целиком), для brute и fft хвост за 5*bandwidth меньше 4e-6 от пика
+HALO_SIGMAS = {"accumulate": 3, "brute": FFT_KERNEL_SIGMAS, "fft": FFT_KERNEL_SIGMAS}
+# Сервис распараллеливает только методы, время которых растёт с числом точек:
+# fft после биннинга и так быстр, раздача полос по процессам его только замедляет
+PARALLEL_METHODS = {"accumulate", "brute"}
+# Полос больше, чем процессов: полосы с разной плотностью точек выравниваются по времени
+BANDS_PER_WORKER = 4
+# Меньшие расчёты быстрее сделать в одном процессе, чем раздавать по полосам
+PARALLEL_MIN_POINTS = 200_000
+
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+
+def can_run_parallel(method, count, workers):
+    return workers > 1 and method in PARALLEL_METHODS and count >= PARALLEL_MIN_POINTS
+
+
+def _get_executor(workers):
+    # Пул процессов один на процесс (сервер или воркер отрисовки) и создаётся при первом расчёте
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = ProcessPoolExecutor(max_workers=workers,
+                                            mp_context=multiprocessing.get_context("spawn"))
+            _executor_workers = workers
+        return _executor
+
+
+def _compute_band(points_buffer, count, out_buffer, shape, band, width, bandwidth, grid_spacing,
+                  method):
+    start, stop, low, high = band
+    points = np.ndarray((2, count), dtype=np.float64, buffer=points_buffer)
+    out = np.ndarray(shape, dtype=np.float64, buffer=out_buffer)
+    # Полоса - отдельная сетка из stop - start строк со сдвинутыми на start строк точками
+    # (+0.5 ячейки, чтобы grid_shape не потерял строку из-за округления)
+    out[start:stop] = KDE_METHODS[method](
+        points[0, low:high], points[1, low:high] - start * grid_spacing, width,
+        (stop - start + 0.5) * grid_spacing, bandwidth, grid_spacing)
+
+
+def _band_density(points_name, count, out_name, shape, band, width, bandwidth, grid_spacing,
+                  method):
+    """
+    Считает строки [start, stop) сетки по точкам полосы с запасом (отсортированным
+    по y, номера [low, high)) и пишет их прямо в общий массив результата.
+    """
+    # Блоки создаёт и удаляет родитель; процессы spawn делят с ним трекер ресурсов,
+    # поэтому повторная регистрация при подключении ничего не меняет
+    points_block = shared_memory.SharedMemory(name=points_name)
+    out_block = shared_memory.SharedMemory(name=out_name)
+    try:
+        _compute_band(points_block.buf, count, out_block.buf, shape, band, width, bandwidth,
+                      grid_spacing, method)
+    finally:
+        points_block.close()
+        out_block.close()
+
+
+def kde_parallel(xs, ys, width, height, bandwidth, grid_spacing, method="accumulate", workers=2):
+    """
+    KDE одной карты на нескольких процессах: сетка делится на полосы строк,
+    каждой полосе достаются точки в её пределах плюс запас HALO_SIGMAS * bandwidth
+    по y. Точки (отсортированные по y) и сетка результата лежат в общей памяти
+    (multiprocessing.shared_memory), полосы пишут в неё свои строки без копирования.
+    """
+    grid_h, grid_w = grid_shape(width, height, grid_spacing)
+    count = len(xs)
+    if grid_h == 0 or grid_w == 0 or count == 0:
+        return np.zeros((grid_h, grid_w), dtype=np.float64)
+    bandwidth = effective_bandwidth(bandwidth)
+    halo = HALO_SIGMAS[method] * bandwidth
+    bands = min(grid_h, workers * BANDS_PER_WORKER)
+    bounds = np.linspace(0, grid_h, bands + 1).round().astype(np.int64)
+
+    points_block = shared_memory.SharedMemory(create=True, size=16 * count)
+    out_block = shared_memory.SharedMemory(create=True, size=8 * grid_h * grid_w)
+    try:
+        order = np.argsort(ys, kind="stable")
+        points = np.ndarray((2, count), dtype=np.float64, buffer=points_block.buf)
+        points[0] = np.asarray(xs)[order]
+        points[1] = np.asarray(ys)[order]
+        lows = np.searchsorted(points[1], bounds[:-1] * grid_spacing - halo, side="left")
+        highs = np.searchsorted(points[1], bounds[1:] * grid_spacing + halo, side="right")
+        del points
+        out = np.ndarray((grid_h, grid_w), dtype=np.float64, buffer=out_block.buf)
+        out[:] = 0.0
+
+        executor = _get_executor(workers)
+        futures = [
+            executor.submit(_band_density, points_block.name, count, out_block.name,
+                            (grid_h, grid_w), (int(start), int(stop), int(low), int(high)),
+                            width, bandwidth, grid_spacing, method)
+            for start, stop, low, high in zip(bounds[:-1], bounds[1:], lows, highs)
+            if stop > start
+        ]
+        for future in futures:
+            future.result()
+        density = out.copy()
+        del out
+        return density
+    finally:
+        points_block.close()
+        points_block.unlink()
+        out_block.close()
+        out_block.unlink()
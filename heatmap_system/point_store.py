@@ -0,0 +1,347 @@
+import json
+import os
+import urllib.parse as urlparse
+
+import numpy as np
+
+from bandwidth import PointMoments
+from segment_store import GENERATION_SIZE, SEGMENT_SUFFIX, PageSegment
+from slice_index import PageIndex
+from spatial_index import GridIndex
+
+# Колонки хранилища точек. Категориальные атрибуты (сессия, пол, устройство)
+# хранятся кодами, словари кодов общие для всех страниц.
+COLUMNS = {
+    "x": np.float32,
+    "y": np.float32,
+    "t": np.float64,
+    "session": np.uint32,
+    "gender": np.uint8,
+    "age": np.uint8,
+    "device": np.uint8,
+}
+CATEGORICAL = ("session", "gender", "device")
+
+# Значения "не указано" для каждой колонки
+MISSING = {
+    "x": 0.0,
+    "y": 0.0,
+    "t": np.nan,
+    "session": 0,
+    "gender": 0,
+    "age": 0,
+    "device": 0,
+}
+
+CATEGORIES_FILE = "categories.json"
+
+MIN_CAPACITY = 4096
+GROWTH_FACTOR = 1.5
+
+
+class PageColumns:
+    """
+    Точки одной страницы в виде колонок NumPy.
+    Ёмкость растёт кусками (в GROWTH_FACTOR раз), поэтому добавление
+    амортизированно O(1) на точку, а view() отдаёт срезы без копирования.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.capacity = 0
+        self.columns = {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+        # Страница в памяти не переживает перезапуск: у каждой своё поколение,
+        # чтобы новые точки того же числа не совпали с дисковым кэшем прошлого запуска
+        self.generation = os.urandom(GENERATION_SIZE).hex()
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, needed):
+        if needed <= self.capacity:
+            return
+        capacity = max(MIN_CAPACITY, int(self.capacity * GROWTH_FACTOR), needed)
+        for name, dtype in COLUMNS.items():
+            grown = np.empty(capacity, dtype=dtype)
+            grown[:self.size] = self.columns[name][:self.size]
+            self.columns[name] = grown
+        self.capacity = capacity
+
+    def append(self, batch):
+        count = len(batch["x"])
+        self._reserve(self.size + count)
+        end = self.size + count
+        for name in COLUMNS:
+            self.columns[name][self.size:end] = batch[name]
+        self.size = end
+
+    def view(self):
+        return {name: column[:self.size] for name, column in self.columns.items()}
+
+    def xy(self):
+        return self.columns["x"][:self.size], self.columns["y"][:self.size]
+
+    def source(self):
+        return ("arrays",) + self.xy()
+
+    @property
+    def nbytes(self):
+        return sum(column.itemsize for column in self.columns.values()) * self.size
+
+    @property
+    def allocated_nbytes(self):
+        return sum(column.nbytes for column in self.columns.values())
+
+
+def load_source(source):
+    """
+    Восстанавливает координаты (xs, ys) по описанию из source() страницы.
+    Сегмент открывается через mmap, поэтому в другой процесс передаётся
+    только путь к файлу и число записей, а не сами точки.
+    """
+    if source[0] == "segment":
+        return PageSegment.map_prefix(source[1], source[2]).xy()
+    return source[1], source[2]
+
+
+class PointStore:
+    """
+    Хранилище точек взгляда по страницам.
+    Без data_dir страницы живут в памяти (PageColumns); с data_dir каждая
+    страница - файл сегмента (PageSegment), который при старте только
+    отображается в память, а словари категорий лежат в categories.json.
+    """
+
+    def __init__(self, data_dir=None):
+        self.data_dir = data_dir
+        self.pages = {}
+        # Индексы атрибутов строятся при первом запросе среза страницы
+        self.indexes = {}
+        # Статистика координат для bandwidth=auto - тоже при первом запросе
+        self.moments = {}
+        # Сеточные индексы координат для запросов по областям - тоже лениво
+        self.spatial = {}
+        self.categories = {name: {} for name in CATEGORICAL}
+        self._categories_dirty = False
+        if data_dir is not None:
+            os.makedirs(data_dir, exist_ok=True)
+            self._load()
+
+    def _load(self):
+        categories_path = os.path.join(self.data_dir, CATEGORIES_FILE)
+        if os.path.exists(categories_path):
+            with open(categories_path, "r", encoding="utf-8") as f:
+                self.categories.update(json.load(f))
+        for filename in os.listdir(self.data_dir):
+            if filename.endswith(SEGMENT_SUFFIX):
+                page_id = urlparse.unquote(filename[:-len(SEGMENT_SUFFIX)])
+                self.pages[page_id] = PageSegment.open(os.path.join(self.data_dir, filename))
+
+    def _save_categories(self):
+        path = os.path.join(self.data_dir, CATEGORIES_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.categories, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        self._categories_dirty = False
+
+    def _new_page(self, page_id):
+        if self.data_dir is None:
+            return PageColumns()
+        filename = urlparse.quote(page_id, safe="") + SEGMENT_SUFFIX
+        return PageSegment.create(os.path.join(self.data_dir, filename))
+
+    def __contains__(self, page_id):
+        return page_id in self.pages
+
+    def page(self, page_id):
+        return self.pages.get(page_id)
+
+    def count(self, page_id):
+        page = self.pages.get(page_id)
+        return len(page) if page is not None else 0
+
+    def xy(self, page_id):
+        return self.pages[page_id].xy()
+
+    def generation(self, page_id):
+        page = self.pages.get(page_id)
+        return page.generation if page is not None else ""
+
+    def append(self, page_id, points, attributes=None):
+        """
+        Добавляет точки страницы. points - список [x, y], [x, y, t] или словарей
+        {"x", "y", "t", "session", "gender", "age", "device"} либо массив NumPy
+        формы (n, 2) или (n, 3); attributes задаёт
+        значения атрибутов по умолчанию для всех точек (например, для сеанса).
+        Возвращает добавленную партию в виде словаря колонок.
+        """
+        batch = self.parse_points(points, attributes or {})
+        if self.data_dir is not None and self._categories_dirty:
+            # Словари пишем до записей, чтобы на диске не было неизвестных кодов
+            self._save_categories()
+        if page_id not in self.pages:
+            self.pages[page_id] = self._new_page(page_id)
+        self.pages[page_id].append(batch)
+        if page_id in self.indexes:
+            self.indexes[page_id].extend(batch)
+        if page_id in self.moments:
+            self.moments[page_id].extend(batch["x"], batch["y"])
+        if page_id in self.spatial:
+            self.spatial[page_id].extend(batch["x"], batch["y"])
+        return batch
+
+    def index(self, page_id):
+        """
+        Индекс атрибутов страницы (при первом обращении - один проход по колонкам).
+        """
+        index = self.indexes.get(page_id)
+        if index is None:
+            index = PageIndex()
+            page = self.pages.get(page_id)
+            if page is not None:
+                index.extend(page.view())
+            self.indexes[page_id] = index
+        return index
+
+    def point_moments(self, page_id):
+        """
+        Потоковая статистика координат страницы (при первом обращении - один проход).
+        """
+        moments = self.moments.get(page_id)
+        if moments is None:
+            moments = PointMoments()
+            page = self.pages.get(page_id)
+            if page is not None:
+                moments.extend(*page.xy())
+            self.moments[page_id] = moments
+        return moments
+
+    def spatial_index(self, page_id):
+        """
+        Сеточный индекс координат страницы (при первом обращении - один проход).
+        """
+        index = self.spatial.get(page_id)
+        if index is None:
+            index = GridIndex()
+            page = self.pages.get(page_id)
+            if page is not None:
+                index.extend(*page.xy())
+            self.spatial[page_id] = index
+        return index
+
+    def select(self, page_id, slice_filter):
+        """
+        Номера строк страницы, попадающих в срез (см. slice_index.parse_filter).
+        """
+        return self.index(page_id).select(slice_filter, self.categories)
+
+    def parse_points(self, points, attributes):
+        # Новые коды категорий появляются в словарях при разборе; у отклонённой партии
+        # они убираются, чтобы не сохраниться и не занять коды (у uint8 их всего 255)
+        sizes = {name: len(codes) for name, codes in self.categories.items()}
+        dirty = self._categories_dirty
+        try:
+            # Слишком большие для float32 координаты становятся бесконечностью и отклоняются ниже
+            with np.errstate(over="ignore"):
+                batch = self._parse_points(points, attributes)
+            # NaN или бесконечность портят плотность всей страницы и остаются в сегменте
+            # навсегда - партия отклоняется до записи (для любого формата загрузки)
+            if not (np.isfinite(batch["x"]).all() and np.isfinite(batch["y"]).all()):
+                raise ValueError("Point coordinates must be finite")
+        except Exception:
+            self._rollback_categories(sizes, dirty)
+            raise
+        return batch
+
+    def _rollback_categories(self, sizes, dirty):
+        # Коды выдаются по порядку, поэтому новые - те, что больше прежнего размера словаря
+        for name, size in sizes.items():
+            codes = self.categories[name]
+            for key in [key for key, code in codes.items() if code > size]:
+                del codes[key]
+        self._categories_dirty = dirty
+
+    def _parse_points(self, points, attributes):
+        count = len(points)
+        defaults = {name: self._encode(name, attributes.get(name)) for name in COLUMNS}
+        if "user" in attributes and "session" not in attributes:
+            defaults["session"] = self._encode("session", attributes["user"])
+        batch = {name: np.full(count, defaults[name], dtype=dtype) for name, dtype in COLUMNS.items()}
+        if count == 0:
+            return batch
+
+        if isinstance(points, np.ndarray):
+            if points.ndim != 2 or points.shape[1] not in (2, 3):
+                raise ValueError("Point array must have shape (n, 2) or (n, 3)")
+            batch["x"][:] = points[:, 0]
+            batch["y"][:] = points[:, 1]
+            if points.shape[1] == 3:
+                batch["t"][:] = points[:, 2]
+            return batch
+
+        if all(not isinstance(point, dict) for point in points):
+            rows = [len(point) for point in points]
+            if min(rows) < 2 or max(rows) > 3:
+                raise ValueError("Each point must be [x, y] or [x, y, t]")
+            if min(rows) == max(rows):
+                coords = np.asarray(points, dtype=np.float64)
+                batch["x"][:] = coords[:, 0]
+                batch["y"][:] = coords[:, 1]
+                if coords.shape[1] == 3:
+                    batch["t"][:] = coords[:, 2]
+                return batch
+
+        for index, point in enumerate(points):
+            if isinstance(point, dict):
+                batch["x"][index] = float(point["x"])
+                batch["y"][index] = float(point["y"])
+                for name in ("t", "session", "gender", "age", "device"):
+                    value = point.get(name)
+                    if name == "session" and value is None:
+                        value = point.get("user")
+                    if value is not None:
+                        batch[name][index] = self._encode(name, value)
+            else:
+                batch["x"][index] = float(point[0])
+                batch["y"][index] = float(point[1])
+                if len(point) > 2:
+                    batch["t"][index] = float(point[2])
+        return batch
+
+    def _encode(self, name, value):
+        if value is None:
+            return MISSING[name]
+        if name in CATEGORICAL:
+            codes = self.categories[name]
+            key = str(value)
+            if key not in codes:
+                limit = np.iinfo(COLUMNS[name]).max
+                if len(codes) + 1 > limit:
+                    raise ValueError(f"Too many distinct values for {name}")
+                codes[key] = len(codes) + 1
+                self._categories_dirty = True
+            return codes[key]
+        if name == "age":
+            age = int(value)
+            if not 0 <= age <= 255:
+                raise ValueError(f"Invalid age: {value}")
+            return age
+        return float(value)
+
+    def stats(self):
+        pages = {}
+        total = {"points": 0, "bytes": 0, "allocated_bytes": 0}
+        # Копия: загрузка может добавить страницу, пока идёт обход
+        for page_id, page in list(self.pages.items()):
+            pages[page_id] = {
+                "points": len(page),
+                "bytes": page.nbytes,
+                "allocated_bytes": page.allocated_nbytes,
+                "bytes_per_point": page.nbytes / len(page) if len(page) else 0.0,
+            }
+            total["points"] += len(page)
+            total["bytes"] += page.nbytes
+            total["allocated_bytes"] += page.allocated_nbytes
+        total["bytes_per_point"] = total["bytes"] / total["points"] if total["points"] else 0.0
+        return {"pages": pages, "total": total}
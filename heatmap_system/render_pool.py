@@ -0,0 +1,50 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+
+class RenderPoolBusy(Exception):
+    pass
+
+
+class RenderPool:
+    """
+    Пул процессов для тяжёлых отрисовок (KDE + рендер) с ограниченной очередью:
+    одновременно принимается не больше workers + max_pending заданий,
+    остальные сразу получают RenderPoolBusy.
+    """
+
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        # spawn, а не fork: сервер многопоточный, fork копировал бы чужие блокировки
+        self.executor = ProcessPoolExecutor(max_workers=workers,
+                                            mp_context=multiprocessing.get_context("spawn"))
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def submit(self, func, *args, wait=False):
+        """
+        wait=True - дождаться свободного места вместо RenderPoolBusy
+        (для пакетной отрисовки, которая сама ограничивает параллелизм).
+        """
+        if not self._slots.acquire(blocking=wait):
+            raise RenderPoolBusy()
+        with self._lock:
+            self.in_flight += 1
+        try:
+            future = self.executor.submit(func, *args)
+        except Exception:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, _future):
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,87 @@
+import numpy as np
+from PIL import Image
+
+INTERPOLATIONS = {
+    "nearest": Image.Resampling.NEAREST,
+    "bilinear": Image.Resampling.BILINEAR,
+}
+DEFAULT_INTERPOLATION = "nearest"
+
+# Форматы ответа и их MIME-типы
+OUTPUT_FORMATS = {"png": "image/png", "webp": "image/webp", "jpeg": "image/jpeg"}
+DEFAULT_FORMAT = "png"
+# Уровень сжатия: для png - уровень zlib (0 - без сжатия, 1 - быстрее всего, 9 - меньше всего),
+# для webp и jpeg - качество. По умолчанию - значения Pillow (png 6, webp 80, jpeg 75).
+LEVEL_RANGES = {"png": (0, 9), "webp": (1, 100), "jpeg": (1, 100)}
+# Метод кодировщика webp: 0 - самый быстрый (по умолчанию в Pillow 4 - в разы медленнее)
+WEBP_METHOD = 0
+# Форматы с прозрачностью: только в них можно отдать слой карты без фона
+ALPHA_FORMATS = ("png", "webp")
+
+
+def grid_to_rgba(normalized, color, opacity=1.0):
+    """
+    Собирает RGBA-изображение размером с сетку (одна ячейка - один пиксель)
+    из одного буфера: цвет одинаковый, альфа = интенсивность * opacity.
+    """
+    grid_h, grid_w = normalized.shape
+    buffer = np.empty((grid_h, grid_w, 4), dtype=np.uint8)
+    buffer[..., :3] = color
+    if opacity == 1.0:
+        buffer[..., 3] = normalized
+    else:
+        buffer[..., 3] = (normalized * opacity).astype(np.uint8)
+    return Image.frombuffer("RGBA", (grid_w, grid_h), buffer, "raw", "RGBA", 0, 1)
+
+
+def render_overlay(normalized, grid_spacing, size, color, opacity=1.0,
+                   interpolation=DEFAULT_INTERPOLATION):
+    """
+    Слой тепловой карты размером size = (width, height): сетка растягивается
+    одним вызовом resize (nearest - резкие ячейки, bilinear - плавный переход)
+    вместо отрисовки прямоугольника на каждую ячейку.
+    """
+    width, height = size
+    grid_h, grid_w = normalized.shape
+    layer = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    if grid_h == 0 or grid_w == 0:
+        return layer
+
+    cells = grid_to_rgba(normalized, color, opacity)
+    target = (min(width, int(round(grid_w * grid_spacing))),
+              min(height, int(round(grid_h * grid_spacing))))
+    scaled = cells.resize(target, INTERPOLATIONS[interpolation])
+    if target == (width, height):
+        return scaled
+    layer.paste(scaled, (0, 0))
+    return layer
+
+
+def overlay_palette(overlay, color):
+    """
+    Слой карты одного цвета как изображение с палитрой: индекс пикселя - его
+    альфа, в палитре 256 степеней прозрачности цвета color (tRNS). Без потерь,
+    один байт на пиксель вместо четырёх.
+    """
+    alpha = overlay.getchannel("A").tobytes()
+    indexed = Image.frombuffer("P", overlay.size, alpha, "raw", "P", 0, 1)
+    indexed.putpalette(bytes(color) * 256)
+    indexed.info["transparency"] = bytes(range(256))
+    return indexed
+
+
+def save_image(image, fp, output_format=DEFAULT_FORMAT, level=None):
+    """
+    Кодирует изображение в fp (путь или файл). level - см. LEVEL_RANGES,
+    None - значение по умолчанию для формата.
+    """
+    if output_format == "png":
+        options = {} if level is None else {"compress_level": level}
+        image.save(fp, format="PNG", **options)
+    elif output_format == "webp":
+        options = {} if level is None else {"quality": level}
+        image.save(fp, format="WEBP", method=WEBP_METHOD, **options)
+    else:
+        # В jpeg нет альфа-канала: карта уже наложена на непрозрачный фон
+        options = {} if level is None else {"quality": level}
+        image.convert("RGB").save(fp, format="JPEG", **options)
@@ -0,0 +1,146 @@
+import os
+import struct
+
+import numpy as np
+
+# Формат сегмента страницы: заголовок фиксированного размера,
+# за ним записи фиксированной ширины (только дописываются в конец).
+SEGMENT_MAGIC = b"HMSEG\x00\x00\x01"
+SEGMENT_VERSION = 1
+SEGMENT_SUFFIX = ".seg"
+# magic, версия, размер записи, число записей, поколение (случайный номер набора данных)
+HEADER_FORMAT = "<8sIIQ8s"
+HEADER_SIZE = 64
+COUNT_OFFSET = struct.calcsize("<8sII")
+GENERATION_OFFSET = struct.calcsize("<8sIIQ")
+GENERATION_SIZE = 8
+
+RECORD_DTYPE = np.dtype([
+    ("x", "<f4"),
+    ("y", "<f4"),
+    ("t", "<f8"),
+    ("session", "<u4"),
+    ("gender", "u1"),
+    ("age", "u1"),
+    ("device", "u1"),
+    ("reserved", "u1"),
+])
+
+
+class SegmentError(Exception):
+    pass
+
+
+class PageSegment:
+    """
+    Точки одной страницы в файле сегмента, отображённом в память (mmap).
+    Открытие не читает записи, поэтому время старта не зависит от объёма
+    данных; view() и xy() отдают представления прямо над отображением.
+    """
+
+    def __init__(self, path, generation=b""):
+        self.path = path
+        self.size = 0
+        self.records = np.empty(0, dtype=RECORD_DTYPE)
+        self.generation = generation.hex()
+
+    @classmethod
+    def create(cls, path):
+        # Новый сегмент - новое поколение: кэш карт прежнего набора данных с тем же
+        # числом точек (после пересоздания страницы) ему не подходит
+        generation = os.urandom(GENERATION_SIZE)
+        segment = cls(path, generation)
+        with open(path, "wb") as f:
+            f.write(segment._header(0, generation))
+        return segment
+
+    @classmethod
+    def open(cls, path):
+        segment = cls(path)
+        with open(path, "rb") as f:
+            header = f.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise SegmentError(f"Truncated segment header: {path}")
+        magic, version, record_size, count, generation = struct.unpack_from(HEADER_FORMAT,
+                                                                            header)
+        if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+            raise SegmentError(f"Unsupported segment format: {path}")
+        if record_size != RECORD_DTYPE.itemsize:
+            raise SegmentError(f"Unexpected record size {record_size} in {path}")
+        if generation == bytes(GENERATION_SIZE):
+            # Сегмент, записанный до появления поколений, получает его при первом открытии
+            generation = os.urandom(GENERATION_SIZE)
+            with open(path, "r+b") as f:
+                f.seek(GENERATION_OFFSET)
+                f.write(generation)
+        segment.generation = generation.hex()
+        # Хвост после count записей (оборванная запись) будет перезаписан
+        available = (os.path.getsize(path) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+        segment.size = min(count, available)
+        segment._map()
+        return segment
+
+    @classmethod
+    def map_prefix(cls, path, count):
+        """
+        Отображает только первые count записей (снимок для другого процесса).
+        """
+        segment = cls(path)
+        segment.size = count
+        segment._map()
+        return segment
+
+    def _header(self, count, generation):
+        header = struct.pack(HEADER_FORMAT, SEGMENT_MAGIC, SEGMENT_VERSION,
+                             RECORD_DTYPE.itemsize, count, generation)
+        return header.ljust(HEADER_SIZE, b"\x00")
+
+    def _map(self):
+        if self.size == 0:
+            self.records = np.empty(0, dtype=RECORD_DTYPE)
+        else:
+            self.records = np.memmap(self.path, dtype=RECORD_DTYPE, mode="r",
+                                     offset=HEADER_SIZE, shape=(self.size,))
+
+    def __len__(self):
+        return self.size
+
+    def append(self, batch):
+        count = len(batch["x"])
+        if count == 0:
+            return
+        records = np.zeros(count, dtype=RECORD_DTYPE)
+        for name in RECORD_DTYPE.names:
+            if name in batch:
+                records[name] = batch[name]
+
+        # Сначала данные, потом счётчик в заголовке: при сбое между ними
+        # недописанные записи просто не будут видны. fsync нужен, чтобы ОС не
+        # записала на диск заголовок раньше данных (после сбоя питания счётчик
+        # указывал бы на мусор)
+        with open(self.path, "r+b") as f:
+            f.seek(HEADER_SIZE + self.size * RECORD_DTYPE.itemsize)
+            f.write(records.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+            f.seek(COUNT_OFFSET)
+            f.write(struct.pack("<Q", self.size + count))
+        self.size += count
+        self._map()
+
+    def view(self):
+        return {name: self.records[name] for name in RECORD_DTYPE.names if name != "reserved"}
+
+    def xy(self):
+        return self.records["x"], self.records["y"]
+
+    def source(self):
+        return ("segment", self.path, self.size)
+
+    @property
+    def nbytes(self):
+        return self.size * RECORD_DTYPE.itemsize
+
+    @property
+    def allocated_nbytes(self):
+        return HEADER_SIZE + self.nbytes
@@ -1,62 +1,817 @@
 import json
-from http.server import BaseHTTPRequestHandler, HTTPServer
-import urllib.parse as urlparse
+import math
 import os
-from heatmap_service import HeatmapService
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import urllib.parse as urlparse
+import re
+from bandwidth import is_bandwidth_rule
+from cluster import FORWARDED_HEADER, REQUEST_HEADERS, Cluster, ForwardError
+from heatmap_cache import canonical_part, key_etag
+from heatmap_service import (DEFAULT_STYLE, HeatmapService, Style, render_animation,
+                             render_heatmap, render_heatmap_group, render_tile)
+from job_queue import DEFAULT_PRIORITY, DONE, JobLimitExceeded, JobQueue
+from kde_engine import DEFAULT_METHOD, KDE_METHODS, NORMALIZATIONS
+from metrics import METRICS, SlowRequestProfiler, route_label
+from renderer import ALPHA_FORMATS, DEFAULT_FORMAT, INTERPOLATIONS, LEVEL_RANGES, OUTPUT_FORMATS
+from slice_index import filter_key, parse_filter
+from time_frames import ANIMATION_FORMATS, Animation
+from render_pool import RenderPool, RenderPoolBusy
+from upload_stream import STREAM_FORMATS, iter_body, stream_batches
+
+# Через сколько секунд клиенту предлагается повторить запрос при перегрузке
+RETRY_AFTER_SECONDS = 2
+
+COLOR_PATTERN = re.compile(r"^[0-9a-f]{6}$")
+JOB_PATH = re.compile(r"^/heatmap/jobs/([0-9a-f]{32})(/result)?$")
+TILE_PATH = re.compile(r"^/heatmap/tiles/([^/]+)/(\d+)/(\d+)/(\d+)\.png$")
+# Атрибуты сеанса для потоковой загрузки передаются в строке запроса
+UPLOAD_ATTRIBUTES = ("session", "user", "gender", "age", "device")
+MAX_BATCH_SPECS = 1000
+BATCH_FORMATS = ("zip", "multipart")
+MAX_ANIMATION_FPS = 50
+MAX_AOI_REGIONS = 1000
+# Сколько карт пакета запрашивается у других узлов кластера одновременно
+MAX_REMOTE_BATCH_REQUESTS = 8
+TRUE_VALUES = ("1", "true", "yes")
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Карта по тому же URL меняется с новыми точками: кэши хранят её, но каждый раз
+# сверяют ETag (ответ 304 без тела, если карта не изменилась)
+CACHE_CONTROL = "no-cache"
+# Сколько секунд соединение keep-alive ждёт следующего запроса
+KEEPALIVE_TIMEOUT = 60
+
+
+def parse_positive(name, value):
+    """
+    Конечное положительное число. float() принимает nan и inf, а nan <= 0 ложно,
+    поэтому без isfinite такие значения прошли бы проверку.
+    """
+    number = float(value)
+    if not (math.isfinite(number) and number > 0):
+        raise ValueError(f"Invalid {name}: {value}")
+    return number
+
+
+def parse_style(query, output=True):
+    """
+    Оформление карты из строки запроса. output=False - без параметров кодирования
+    (format, level, overlay), например для анимации со своим форматом.
+    """
+    color = query.get("color", [DEFAULT_STYLE.color])[0].lower().lstrip("#")
+    if not COLOR_PATTERN.match(color):
+        raise ValueError(f"Invalid color: {color}")
+    opacity = float(query.get("opacity", [DEFAULT_STYLE.opacity])[0])
+    if not 0.0 <= opacity <= 1.0:
+        raise ValueError(f"Invalid opacity: {opacity}")
+    norm = query.get("norm", [DEFAULT_STYLE.norm])[0]
+    if norm not in NORMALIZATIONS:
+        raise ValueError(f"Unknown norm: {norm}")
+    interpolation = query.get("interpolation", [DEFAULT_STYLE.interpolation])[0]
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError(f"Unknown interpolation: {interpolation}")
+    if not output:
+        return Style(color, opacity, norm, interpolation)
+    output_format = query.get("format", [DEFAULT_FORMAT])[0].lower()
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown format: {output_format}")
+    level = query.get("level", [None])[0]
+    if level is not None:
+        level = int(level)
+        low, high = LEVEL_RANGES[output_format]
+        if not low <= level <= high:
+            raise ValueError(f"Level for {output_format} must be in [{low}, {high}]")
+    overlay = query.get("overlay", ["0"])[0].lower() in TRUE_VALUES
+    if overlay and output_format not in ALPHA_FORMATS:
+        raise ValueError(f"overlay needs a format with transparency: {', '.join(ALPHA_FORMATS)}")
+    return Style(color, opacity, norm, interpolation, output_format, level, overlay)
+
+
+def parse_heatmap_query(query, output=True):
+    """
+    Параметры карты из строки запроса: (page_id, bandwidth, grid, method, style, slice_filter).
+    bandwidth - число или правило выбора (auto, scott, silverman), см. HeatmapService.resolve_bandwidth.
+    output - разбирать ли параметры кодирования ответа (см. parse_style).
+    """
+    page_id = query.get("page_id", ["unknown"])[0]
+    method = query.get("method", [DEFAULT_METHOD])[0]
+    bandwidth = query.get("bandwidth", [10])[0]
+    if not is_bandwidth_rule(bandwidth):
+        bandwidth = parse_positive("bandwidth", bandwidth)
+    grid = parse_positive("grid", query.get("grid", [15])[0])
+    if method not in KDE_METHODS:
+        raise ValueError(f"Unknown method: {method}")
+    slice_filter = parse_filter(query.get("filter", [""])[0])
+    return page_id, bandwidth, grid, method, parse_style(query, output), slice_filter
+
+
+def parse_animation(query):
+    """
+    Параметры анимации: interval (с, период накопленных кадров), t0, t1, step, window,
+    scale (0..1], fps, format (apng | gif | zip).
+    """
+    def optional(name, parse=float):
+        return parse(name, query[name][0]) if name in query else None
+
+    def finite(name, value):
+        number = float(value)
+        if not math.isfinite(number):
+            raise ValueError(f"Invalid {name}: {value}")
+        return number
+
+    interval = parse_positive("interval", query.get("interval", [60])[0])
+    step = optional("step", parse_positive)
+    window = optional("window", parse_positive)
+    scale = float(query.get("scale", [1])[0])
+    fps = float(query.get("fps", [4])[0])
+    animation_format = query.get("format", ["apng"])[0]
+    if not 0 < scale <= 1:
+        raise ValueError(f"Invalid scale: {scale}")
+    if not 0 < fps <= MAX_ANIMATION_FPS:
+        raise ValueError(f"Invalid fps: {fps}")
+    if animation_format not in ANIMATION_FORMATS:
+        raise ValueError(f"Unknown format: {animation_format}")
+    return Animation(interval, optional("t0", finite), optional("t1", finite), step, window,
+                     scale, fps, animation_format)
+
+
+def parse_batch(body):
+    """
+    Тело пакетного запроса: {"format": "zip" | "multipart", "specs": [{"page_id", "bandwidth",
+    "grid", "method", ...оформление}, ...]}. Возвращает (формат, список параметров карт,
+    исходные описания карт - строки запроса для пересылки в кластере).
+    """
+    data = json.loads(body.decode("utf-8"))
+    batch_format = data.get("format", "zip")
+    if batch_format not in BATCH_FORMATS:
+        raise ValueError(f"Unknown format: {batch_format}")
+    specs = data.get("specs")
+    if not isinstance(specs, list) or not specs:
+        raise ValueError("specs must be a non-empty list")
+    if len(specs) > MAX_BATCH_SPECS:
+        raise ValueError(f"Too many specs: {len(specs)} > {MAX_BATCH_SPECS}")
+    items = []
+    queries = []
+    for index, spec in enumerate(specs):
+        if not isinstance(spec, dict):
+            raise ValueError(f"Spec {index} must be an object")
+        query = {key: str(value) for key, value in spec.items()}
+        try:
+            items.append(parse_heatmap_query({key: [value] for key, value in query.items()}))
+        except ValueError as e:
+            raise ValueError(f"Spec {index}: {e}") from None
+        queries.append(query)
+    return batch_format, items, queries
+
+
+def parse_aoi(body):
+    """
+    Тело запроса статистики по областям: {"page_id", "regions": [{"name", "x", "y",
+    "width", "height"}, ...], "bandwidth" (необязательно), "filter" (необязательно)}.
+    Возвращает (page_id, области (имя, x0, y0, x1, y1), bandwidth, срез).
+    """
+    data = json.loads(body.decode("utf-8"))
+    page_id = str(data.get("page_id", "unknown"))
+    regions = data.get("regions")
+    if not isinstance(regions, list) or not regions:
+        raise ValueError("regions must be a non-empty list")
+    if len(regions) > MAX_AOI_REGIONS:
+        raise ValueError(f"Too many regions: {len(regions)} > {MAX_AOI_REGIONS}")
+    parsed = []
+    for index, region in enumerate(regions):
+        try:
+            x, y = float(region["x"]), float(region["y"])
+            width, height = float(region["width"]), float(region["height"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"Region {index} needs numeric x, y, width and height") from None
+        if not all(math.isfinite(value) for value in (x, y, width, height)):
+            raise ValueError(f"Region {index} needs finite x, y, width and height")
+        if width <= 0 or height <= 0:
+            raise ValueError(f"Region {index} must have a positive size")
+        parsed.append((str(region.get("name", index)), x, y, x + width, y + height))
+    bandwidth = data.get("bandwidth")
+    if bandwidth is not None and not is_bandwidth_rule(bandwidth):
+        bandwidth = parse_positive("bandwidth", bandwidth)
+    return page_id, parsed, bandwidth, parse_filter(data.get("filter", ""))
+
+
+def etag_matches(header, etag):
+    """
+    Совпадает ли ETag с заголовком If-None-Match (список через запятую или *).
+    Для If-None-Match сравнение слабое: префикс W/ не учитывается.
+    """
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class ChunkedWriter:
+    """
+    Тело ответа в кодировке Transfer-Encoding: chunked поверх wfile - для ответов,
+    длина которых заранее неизвестна, без закрытия соединения keep-alive.
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, data):
+        if data:
+            self.wfile.write(b"%x\r\n" % len(data))
+            self.wfile.write(data)
+            self.wfile.write(b"\r\n")
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def batch_filename(index, item):
+    page_id, bandwidth, grid, method, style = item[:5]
+    return (f"{index:04d}_{urlparse.quote(page_id, safe='')}_bw{canonical_part(bandwidth)}"
+            f"_grid{canonical_part(grid)}_{method}.{style.format}")
 
 class SimpleRequestHandler(BaseHTTPRequestHandler):
-    service = HeatmapService()
+    # HTTP/1.1: соединение переиспользуется, у каждого ответа есть Content-Length
+    # (или chunked для пакетов)
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+    # Заголовки и тело уходят отдельными записями: с алгоритмом Нейгла и отложенным
+    # ACK клиента каждый ответ по keep-alive ждал бы ~40 мс
+    disable_nagle_algorithm = True
+    # Вне обработчиков маршрутов (ошибки разбора запроса) тело не проверяется
+    body_read = True
+    # Создаётся в run_server: каталоги данных и кэшей задаются для каждого узла
+    service = None
+    render_pool = None
+    jobs = None
+    profiler = None
+    cluster = None
+
+    @classmethod
+    def runner(cls):
+        if cls.render_pool is None:
+            return None
+        return lambda spec: cls.render_pool.submit(render_heatmap, spec).result()
+
+    def render(self, page_id, bandwidth, grid, method, style, slice_filter=()):
+        return self.service.generate_heatmap(page_id, bandwidth, grid, method, style,
+                                             slice_filter, runner=self.runner(), as_file=True)
+
+    @classmethod
+    def group_runner(cls):
+        if cls.render_pool is None:
+            return None
+        return lambda specs: cls.render_pool.submit(render_heatmap_group, specs, wait=True).result()
+
+    def resolve(self, params):
+        # Правило выбора bandwidth заменяется числом до ключа кэша:
+        # auto и совпадающее с ним число дают одну и ту же карту
+        page_id, bandwidth, *rest = params
+        return (page_id, self.service.resolve_bandwidth(page_id, bandwidth), *rest)
+
+    def client_id(self):
+        # Клиент для лимита заданий: явный заголовок или адрес
+        return self.headers.get("X-Client-Id") or self.client_address[0]
+
+    def send_json(self, status, payload, headers=()):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_image(self, data, content_type="image/png", headers=()):
+        """
+        data - bytes или открытый файл из дискового кэша: файл отправляется
+        через socket.sendfile (os.sendfile), не читаясь в память процесса.
+        """
+        if isinstance(data, bytes):
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        with data:
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(os.fstat(data.fileno()).st_size))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            self.connection.sendfile(data)
+
+    def send_text(self, status, text, headers=()):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def cache_headers(key):
+        # Без точек (версия 0) карты нет - нечего и кэшировать
+        if key[1] == "0":
+            return []
+        return [("ETag", key_etag(key)), ("Cache-Control", CACHE_CONTROL)]
+
+    def not_modified(self, key, headers):
+        """
+        Отвечает 304, если клиент прислал If-None-Match с текущим ETag карты:
+        ни отрисовка, ни чтение файла не нужны. Ключ берётся до отрисовки, поэтому
+        при загрузке точек во время запроса ETag может быть старше карты -
+        тогда следующий запрос просто получит её заново.
+        """
+        header = self.headers.get("If-None-Match")
+        if header is None or key[1] == "0" or not etag_matches(header, key_etag(key)):
+            return False
+        self.send_response(304)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        return True
+
+    def remote_owner(self, key):
+        """
+        Узел кластера, которому принадлежит key (page_id или номер задания), если это
+        другой узел, иначе None. Пересланный запрос всегда обрабатывается на месте:
+        даже при разошедшихся конфигурациях узлов он не пойдёт по кругу.
+        """
+        if self.cluster is None or key is None or self.headers.get(FORWARDED_HEADER):
+            return None
+        node = self.cluster.owner(key)
+        return None if node == self.cluster.node_id else node
+
+    def forward(self, node, body=None):
+        """
+        Пересылает запрос узлу-владельцу и отдаёт клиенту его ответ. Непрочитанное
+        тело запроса передаётся кусками по мере чтения, не собираясь в памяти.
+        """
+        if body is None and not self.body_read:
+            body = self.body_chunks()
+        headers = [(name, self.headers[name]) for name in REQUEST_HEADERS if name in self.headers]
+        # Лимит заданий считается по исходному клиенту, а не по пересылающему узлу
+        headers.append(("X-Client-Id", self.client_id()))
+        try:
+            status, response_headers, data = self.cluster.forward(node, self.command, self.path,
+                                                                  body, headers)
+        except ForwardError as e:
+            self.send_text(502, str(e))
+            return
+        self.send_response(status)
+        for name, value in response_headers:
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def body_chunks(self):
+        # Тело, прочитанное до конца, отмечается: иначе соединение нельзя переиспользовать
+        yield from iter_body(self.rfile, self.headers)
+        self.body_read = True
+
+    def has_body(self):
+        return ("chunked" in self.headers.get("Transfer-Encoding", "").lower()
+                or int(self.headers.get("Content-Length") or 0) > 0)
+
+    def send_response(self, code, message=None):
+        # Код ответа запоминается для метрик запроса
+        self.status = code
+        super().send_response(code, message)
+        if not self.body_read:
+            # Ответ до конца тела запроса: остаток тела приняли бы за следующий
+            # запрос, поэтому соединение после ответа закрывается
+            self.send_header("Connection", "close")
+
+    def instrumented(self, handler):
+        """
+        Выполняет обработчик метода, записывая время запроса в метрики
+        (и в профилировщик медленных запросов, если он включён).
+        """
+        self.status = None
+        self.body_read = not self.has_body()
+        if self.profiler is not None:
+            self.profiler.start()
+        start = time.perf_counter()
+        try:
+            handler()
+        finally:
+            seconds = time.perf_counter() - start
+            # Без отправленного кода обработчик упал с исключением
+            status = self.status or 500
+            METRICS.observe_request(route_label(urlparse.urlparse(self.path).path), self.command,
+                                    status, seconds)
+            if self.profiler is not None:
+                self.profiler.stop(self.command, self.path, status, seconds)
 
     def do_GET(self):
+        self.instrumented(self.route_get)
+
+    def do_POST(self):
+        self.instrumented(self.route_post)
+
+    def do_DELETE(self):
+        self.instrumented(self.route_delete)
+
+    def job_info(self, info):
+        info["status_url"] = f"/heatmap/jobs/{info['id']}"
+        if info["status"] == DONE:
+            info["result_url"] = f"/heatmap/jobs/{info['id']}/result"
+        return info
+
+    def route_get(self):
         parsed_url = urlparse.urlparse(self.path)
         query = urlparse.parse_qs(parsed_url.query)
 
+        job_match = JOB_PATH.match(parsed_url.path)
+        tile_match = TILE_PATH.match(parsed_url.path)
+
+        # В кластере запросы чужой страницы (и чужого задания) уходят её владельцу
+        owner_key = None
+        if parsed_url.path in ("/heatmap", "/heatmap/animation"):
+            owner_key = query.get("page_id", ["unknown"])[0]
+        elif tile_match:
+            owner_key = urlparse.unquote(tile_match.group(1))
+        elif job_match:
+            owner_key = job_match.group(1)
+        node = self.remote_owner(owner_key)
+        if node is not None:
+            self.forward(node)
+            return
+
         if parsed_url.path == "/heatmap":
-            page_id = query.get("page_id", ["unknown"])[0]
-            bandwidth = float(query.get("bandwidth", [10])[0])
-            grid = float(query.get("grid", [15])[0])
-
-            result_path = self.service.generate_heatmap(page_id, bandwidth, grid)
-            if result_path and os.path.exists(result_path):
-                self.send_response(200)
-                self.send_header("Content-Type", "image/png")
-                self.end_headers()
-                with open(result_path, "rb") as f:
-                    self.wfile.write(f.read())
+            try:
+                params = self.resolve(parse_heatmap_query(query))
+            except ValueError as e:
+                self.send_text(400, str(e))
+                return
+            key = self.service.cache_key(*params)
+            # Выбранный bandwidth - чтобы клиент видел значение для bandwidth=auto
+            headers = [("X-Bandwidth", canonical_part(params[1]))] + self.cache_headers(key)
+            if self.not_modified(key, headers):
+                return
+
+            try:
+                result = self.render(*params)
+            except RenderPoolBusy:
+                self.send_text(503, "Render queue is full, retry later.",
+                               [("Retry-After", str(RETRY_AFTER_SECONDS))])
+                return
+            if result:
+                self.send_image(result, OUTPUT_FORMATS[params[4].format], headers)
+            else:
+                self.send_text(404, "Heatmap not found or no data.")
+        elif parsed_url.path == "/heatmap/animation":
+            try:
+                params = self.resolve(parse_heatmap_query(query, output=False))
+                animation = parse_animation(query)
+            except ValueError as e:
+                self.send_text(400, str(e))
+                return
+            key = self.service.animation_cache_key(*params[:5], animation, params[5])
+            headers = self.cache_headers(key)
+            if self.not_modified(key, headers):
+                return
+            runner = None
+            if self.render_pool is not None:
+                runner = lambda spec: self.render_pool.submit(render_animation, spec).result()
+            try:
+                result = self.service.generate_animation(*params, animation, runner, as_file=True)
+            except ValueError as e:
+                self.send_text(400, str(e))
+                return
+            except RenderPoolBusy:
+                self.send_text(503, "Render queue is full, retry later.",
+                               [("Retry-After", str(RETRY_AFTER_SECONDS))])
+                return
+            if result:
+                self.send_image(result, ANIMATION_FORMATS[animation.format], headers)
             else:
-                self.send_response(404)
-                self.end_headers()
-                self.wfile.write(b"Heatmap not found or no data.")
+                self.send_text(404, "Heatmap not found or no timed data.")
+        elif tile_match:
+            page_id = urlparse.unquote(tile_match.group(1))
+            zoom, tile_x, tile_y = (int(value) for value in tile_match.groups()[1:])
+            try:
+                _, bandwidth, grid, method, style, slice_filter = parse_heatmap_query(query)
+                bandwidth = self.service.resolve_bandwidth(page_id, bandwidth)
+            except ValueError as e:
+                self.send_text(400, str(e))
+                return
+            key = self.service.tile_cache_key(page_id, zoom, tile_x, tile_y, bandwidth, grid,
+                                              method, style, slice_filter)
+            headers = self.cache_headers(key)
+            if self.not_modified(key, headers):
+                return
+            runner = None
+            if self.render_pool is not None:
+                runner = lambda spec: self.render_pool.submit(render_tile, spec).result()
+            try:
+                result = self.service.generate_tile(page_id, zoom, tile_x, tile_y, bandwidth, grid,
+                                                    method, style, slice_filter, runner,
+                                                    as_file=True)
+            except ValueError as e:
+                self.send_text(404, str(e))
+                return
+            except RenderPoolBusy:
+                self.send_text(503, "Render queue is full, retry later.",
+                               [("Retry-After", str(RETRY_AFTER_SECONDS))])
+                return
+            if result:
+                self.send_image(result, OUTPUT_FORMATS[style.format], headers)
+            else:
+                self.send_text(404, "Heatmap not found or no data.")
+        elif job_match and self.jobs is not None:
+            job_id, result_suffix = job_match.groups()
+            if result_suffix:
+                info = self.jobs.get(job_id)
+                status, data = self.jobs.result(job_id)
+                if status is None:
+                    self.send_text(404, "Job not found.")
+                elif status != DONE:
+                    self.send_text(409, f"Job is {status}.")
+                elif data is None:
+                    self.send_text(410, "Result expired, submit the job again.")
+                else:
+                    self.send_image(data, OUTPUT_FORMATS[info["format"]])
+                return
+            info = self.jobs.get(job_id)
+            if info is None:
+                self.send_text(404, "Job not found.")
+            else:
+                self.send_json(200, self.job_info(info))
+        elif parsed_url.path == "/stats":
+            stats = self.service.stats()
+            if self.jobs is not None:
+                stats["jobs"] = self.jobs.stats()
+            if self.cluster is not None:
+                stats["cluster"] = self.cluster.stats()
+            self.send_json(200, stats)
+        elif parsed_url.path == "/metrics":
+            text = METRICS.render(self.service.stats(), self.render_pool, self.jobs)
+            self.send_text(200, text, [("Content-Type", METRICS_CONTENT_TYPE)])
+        elif parsed_url.path == "/debug/slow" and self.profiler is not None:
+            self.send_json(200, self.profiler.report())
         else:
-            self.send_response(404)
-            self.end_headers()
-            self.wfile.write(b"Not Found")
+            self.send_text(404, "Not Found")
 
-    def do_POST(self):
+    def route_post(self):
         parsed_url = urlparse.urlparse(self.path)
         query = urlparse.parse_qs(parsed_url.query)
 
-        if parsed_url.path == "/upload_data":
+        if parsed_url.path in ("/heatmap/jobs", "/upload_data"):
+            node = self.remote_owner(query.get("page_id", ["unknown"])[0])
+            if node is not None:
+                self.forward(node)
+                return
+
+        if parsed_url.path == "/heatmap/jobs" and self.jobs is not None:
+            try:
+                params = self.resolve(parse_heatmap_query(query))
+                priority = query.get("priority", [DEFAULT_PRIORITY])[0]
+                job = self.jobs.submit(self.client_id(), params, priority)
+            except ValueError as e:
+                self.send_text(400, str(e))
+                return
+            except JobLimitExceeded:
+                self.send_text(429, "Too many unfinished jobs for this client.",
+                               [("Retry-After", str(RETRY_AFTER_SECONDS))])
+                return
+            info = self.job_info(job.to_dict())
+            self.send_json(202, info, [("Location", info["status_url"])])
+        elif parsed_url.path == "/heatmap/batch":
+            try:
+                batch_format, items, queries = parse_batch(b"".join(self.body_chunks()))
+                # bandwidth=auto чужой страницы выбирает её владелец
+                owners = [self.remote_owner(item[0]) for item in items]
+                items = [item if node else self.resolve(item) for item, node in zip(items, owners)]
+            except ValueError as e:
+                self.send_text(400, str(e))
+                return
+            self.send_batch(batch_format, items, queries, owners)
+        elif parsed_url.path == "/heatmap/aoi":
+            try:
+                body = b"".join(self.body_chunks())
+                page_id, regions, bandwidth, slice_filter = parse_aoi(body)
+            except ValueError as e:
+                self.send_text(400, str(e))
+                return
+            node = self.remote_owner(page_id)
+            if node is not None:
+                self.forward(node, body)
+                return
+            result = self.service.aoi_stats(page_id, regions, bandwidth, slice_filter)
+            if result is None:
+                self.send_text(404, "No data for this page.")
+            else:
+                self.send_json(200, result)
+        elif parsed_url.path == "/upload_data":
             page_id = query.get("page_id", ["unknown"])[0]
-            content_length = int(self.headers.get('Content-Length', 0))
-            post_body = self.rfile.read(content_length)
+            content_type = self.headers.get("Content-Type", "application/json")
+            content_type = content_type.split(";", 1)[0].strip().lower()
+            if content_type in STREAM_FORMATS:
+                self.upload_stream(page_id, content_type, query)
+                return
             try:
+                post_body = b"".join(self.body_chunks())
                 data = json.loads(post_body.decode("utf-8"))
                 points = data.get("points", [])
-                self.service.store_raw_data(page_id, points)
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write(b"Data uploaded successfully.")
+                attributes = {key: value for key, value in data.items() if key != "points"}
+                self.service.store_raw_data(page_id, points, attributes)
+                self.send_text(200, "Data uploaded successfully.")
             except Exception as e:
-                self.send_response(400)
-                self.end_headers()
-                self.wfile.write(f"Error parsing data: {e}".encode("utf-8"))
+                self.send_text(400, f"Error parsing data: {e}")
         else:
-            self.send_response(404)
-            self.end_headers()
-            self.wfile.write(b"Not Found")
+            self.send_text(404, "Not Found")
+
+    def batch_results(self, items, queries, owners):
+        """
+        Пары (индекс, карта | None | исключение) пакета. Карты своих страниц рисуются
+        здесь, чужих - запрашиваются у владельцев (GET /heatmap) параллельно
+        с отрисовкой; выбранный владельцем bandwidth записывается в items.
+        """
+        parallel = self.render_pool.workers if self.render_pool else (os.cpu_count() or 1)
+        local = [index for index, node in enumerate(owners) if node is None]
+        remote = [index for index, node in enumerate(owners) if node is not None]
+        if not remote:
+            yield from self.service.generate_batch(items, self.group_runner(), parallel)
+            return
+        workers = min(len(remote), MAX_REMOTE_BATCH_REQUESTS)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(index, executor.submit(self.fetch_remote, owners[index], queries[index]))
+                       for index in remote]
+            if local:
+                results = self.service.generate_batch([items[index] for index in local],
+                                                      self.group_runner(), parallel)
+                for position, result in results:
+                    yield local[position], result
+            for index, future in futures:
+                bandwidth, result = future.result()
+                if bandwidth is not None:
+                    items[index] = (items[index][0], float(bandwidth), *items[index][2:])
+                yield index, result
+
+    def fetch_remote(self, node, query):
+        """
+        Карта чужой страницы с узла-владельца: (bandwidth | None, карта | None | исключение).
+        """
+        try:
+            status, headers, data = self.cluster.forward(node, "GET",
+                                                         "/heatmap?" + urlparse.urlencode(query))
+        except ForwardError as e:
+            return None, e
+        bandwidth = dict(headers).get("X-Bandwidth")
+        if status == 200:
+            return bandwidth, data
+        if status == 404:
+            return bandwidth, None
+        return bandwidth, RuntimeError(f"Node {node} answered {status}: "
+                                       f"{data.decode('utf-8', 'replace')}")
+
+    def send_batch(self, batch_format, items, queries, owners):
+        """
+        Отдаёт карты пакета по мере готовности: zip-архив или multipart/mixed,
+        в конце - manifest.json со статусом каждого задания. Длина ответа заранее
+        неизвестна: для HTTP/1.1 тело идёт кусками (chunked), для HTTP/1.0
+        ответ завершается закрытием соединения.
+        """
+        results = self.batch_results(items, queries, owners)
+        manifest = [None] * len(items)
+        boundary = uuid.uuid4().hex
+
+        self.send_response(200)
+        if batch_format == "zip":
+            self.send_header("Content-Type", "application/zip")
+            self.send_header("Content-Disposition", 'attachment; filename="heatmaps.zip"')
+        else:
+            self.send_header("Content-Type", f"multipart/mixed; boundary={boundary}")
+        if self.request_version == "HTTP/1.1":
+            self.send_header("Transfer-Encoding", "chunked")
+            out = ChunkedWriter(self.wfile)
+        else:
+            self.close_connection = True
+            out = self.wfile
+        self.end_headers()
+
+        def write_part(name, content_type, data):
+            out.write((f"--{boundary}\r\nContent-Type: {content_type}\r\n"
+                       f'Content-Disposition: attachment; filename="{name}"\r\n'
+                       f"Content-Length: {len(data)}\r\n\r\n").encode("utf-8"))
+            out.write(data + b"\r\n")
+
+        archive = zipfile.ZipFile(out, "w") if batch_format == "zip" else None
+        for index, result in results:
+            page_id, bandwidth, grid, method, _, slice_filter = items[index]
+            entry = {"index": index, "page_id": page_id, "bandwidth": bandwidth,
+                     "grid": grid, "method": method, "filter": filter_key(slice_filter)}
+            if isinstance(result, Exception):
+                entry.update(status="error", error=str(result))
+            elif result is None:
+                entry["status"] = "not_found"
+            else:
+                entry.update(status="ok", file=batch_filename(index, items[index]))
+                # Изображения уже сжаты - кладём в архив без повторного сжатия
+                if archive is not None:
+                    archive.writestr(entry["file"], result)
+                else:
+                    write_part(entry["file"], OUTPUT_FORMATS[items[index][4].format], result)
+            manifest[index] = entry
+        manifest_data = json.dumps(manifest).encode("utf-8")
+        if archive is not None:
+            archive.writestr("manifest.json", manifest_data)
+            archive.close()
+        else:
+            write_part("manifest.json", "application/json", manifest_data)
+            out.write(f"--{boundary}--\r\n".encode("utf-8"))
+        if isinstance(out, ChunkedWriter):
+            out.close()
+
+    def upload_stream(self, page_id, content_type, query):
+        """
+        Потоковая загрузка (NDJSON, CSV, бинарный float32): тело читается кусками,
+        каждая партия точек сразу пишется в хранилище, поэтому память не зависит
+        от размера загрузки. При ошибке уже записанные партии остаются.
+        """
+        attributes = {name: query[name][0] for name in UPLOAD_ATTRIBUTES if name in query}
+        stored = 0
+        try:
+            for batch in stream_batches(content_type, self.body_chunks()):
+                self.service.store_raw_data(page_id, batch, attributes)
+                stored += len(batch)
+        except (ValueError, KeyError, TypeError, UnicodeDecodeError) as e:
+            self.send_text(400, f"Error parsing data: {e} ({stored} points stored)")
+            return
+        self.send_json(200, {"page_id": page_id, "points": stored})
+
+    def route_delete(self):
+        job_match = JOB_PATH.match(urlparse.urlparse(self.path).path)
+        node = self.remote_owner(job_match.group(1) if job_match else None)
+        if node is not None:
+            self.forward(node)
+        elif job_match and not job_match.group(2) and self.jobs is not None:
+            info = self.jobs.cancel(job_match.group(1))
+            if info is None:
+                self.send_text(404, "Job not found.")
+            else:
+                self.send_json(200, self.job_info(info))
+        else:
+            self.send_text(404, "Not Found")
 
-def run_server(host="127.0.0.1", port=8080):
-    httpd = HTTPServer((host, port), SimpleRequestHandler)
+def run_server(host="127.0.0.1", port=8080, render_workers=0, max_pending=8, job_workers=0,
+               kde_workers=1, profile_slow_ms=0, profile_dir="profiles", cluster_config=None,
+               node_id=None, data_dir="data", cache_dir="."):
+    """
+    profile_slow_ms > 0 включает профилировщик: запросы дольше этого (мс)
+    с выборками стеков пишутся в profile_dir/slow_requests.json.
+    cluster_config - файл со списком узлов кластера (см. cluster.Cluster), node_id -
+    имя этого узла в нём: страницы других узлов обслуживают их владельцы.
+    data_dir - сегменты точек, cache_dir - каталог, в котором лежат cache_images,
+    cache_grids и cache_backgrounds. У каждого процесса сервера они должны быть свои:
+    общие каталоги узлы перезаписывают и чистят друг у друга.
+    """
+    SimpleRequestHandler.service = HeatmapService(
+        hot_params=[(10.0, 15.0, DEFAULT_METHOD)], data_dir=data_dir,
+        cache_dir=os.path.join(cache_dir, "cache_images"),
+        grid_dir=os.path.join(cache_dir, "cache_grids"),
+        background_dir=os.path.join(cache_dir, "cache_backgrounds"), kde_workers=kde_workers)
+    if cluster_config:
+        SimpleRequestHandler.cluster = Cluster.from_file(cluster_config, node_id)
+    if profile_slow_ms > 0:
+        SimpleRequestHandler.profiler = SlowRequestProfiler(profile_slow_ms / 1000, profile_dir)
+    if render_workers > 0:
+        SimpleRequestHandler.render_pool = RenderPool(render_workers, max_pending)
+    # Потоки заданий только ждут пул процессов, поэтому по умолчанию их столько же, сколько воркеров
+    SimpleRequestHandler.jobs = JobQueue(SimpleRequestHandler.service,
+                                         job_workers or render_workers or 1,
+                                         SimpleRequestHandler.runner(),
+                                         new_id=SimpleRequestHandler.cluster.new_job_id
+                                         if SimpleRequestHandler.cluster else None)
+    httpd = ThreadingHTTPServer((host, port), SimpleRequestHandler)
     print(f"Server started at http://{host}:{port}")
-    httpd.serve_forever()
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+        SimpleRequestHandler.jobs.shutdown()
+        SimpleRequestHandler.jobs = None
+        if SimpleRequestHandler.render_pool is not None:
+            SimpleRequestHandler.render_pool.shutdown()
+            SimpleRequestHandler.render_pool = None
+        if SimpleRequestHandler.cluster is not None:
+            SimpleRequestHandler.cluster.close()
+            SimpleRequestHandler.cluster = None
@@ -0,0 +1,211 @@
+import itertools
+import re
+
+import numpy as np
+
+from heatmap_cache import canonical_part
+
+# Атрибуты, по которым строятся индексы: категориальные - списки строк
+# по каждому коду (postings), числовые - отсортированный массив значений
+POSTING_ATTRIBUTES = ("session", "gender", "device")
+RANGE_ATTRIBUTES = ("age", "t")
+# user - синоним session, как при загрузке
+ATTRIBUTE_ALIASES = {"user": "session"}
+
+# Больше частей комбинированный срез не дробится (считается целиком)
+MAX_SLICE_PARTS = 16
+
+RANGE_PATTERN = re.compile(r"^([^-]*)-([^-]*)$")
+
+
+def parse_filter(text):
+    """
+    Разбирает filter=gender:f,m;device:mobile;age:18-34;t:0-60 в канонический срез:
+    кортеж пар (атрибут, значения), отсортированный по атрибуту. Значения в одном
+    условии объединяются (ИЛИ), условия по разным атрибутам - пересекаются (И).
+    Для age и t значение - диапазон lo-hi включительно (границу можно опустить).
+    """
+    clauses = {}
+    for clause in filter(None, (part.strip() for part in (text or "").split(";"))):
+        name, sep, values = clause.partition(":")
+        name = ATTRIBUTE_ALIASES.get(name.strip(), name.strip())
+        if not sep or name not in POSTING_ATTRIBUTES + RANGE_ATTRIBUTES:
+            raise ValueError(f"Invalid filter clause: {clause}")
+        if name in clauses:
+            raise ValueError(f"Duplicate filter attribute: {name}")
+        if name in RANGE_ATTRIBUTES:
+            clauses[name] = _parse_range(values.strip())
+        else:
+            items = tuple(sorted({value.strip() for value in values.split(",") if value.strip()}))
+            if not items:
+                raise ValueError(f"Empty filter values: {clause}")
+            clauses[name] = items
+    return tuple(sorted(clauses.items()))
+
+
+def _parse_range(text):
+    match = RANGE_PATTERN.match(text)
+    if match:
+        low, high = match.groups()
+    else:
+        low = high = text
+    low = float(low) if low else -np.inf
+    high = float(high) if high else np.inf
+    if low > high:
+        raise ValueError(f"Invalid range: {text}")
+    return (low, high)
+
+
+def filter_key(slice_filter):
+    """
+    Строка среза для ключа кэша (пустая - все точки).
+    """
+    parts = []
+    for name, values in slice_filter:
+        if name in RANGE_ATTRIBUTES:
+            text = "-".join("" if np.isinf(bound) else canonical_part(bound) for bound in values)
+        else:
+            text = ",".join(values)
+        parts.append(f"{name}:{text}")
+    return ";".join(parts)
+
+
+def split_filter(slice_filter):
+    """
+    Разбивает срез на непересекающиеся части - по одному значению каждого
+    категориального атрибута. Плотность среза равна сумме плотностей частей
+    (KDE линеен по точкам), поэтому части можно кэшировать и складывать.
+    Возвращает [slice_filter], если дробить нечего или частей слишком много.
+    """
+    choices = []
+    for name, values in slice_filter:
+        if name in RANGE_ATTRIBUTES:
+            choices.append([(name, values)])
+        else:
+            choices.append([(name, (value,)) for value in values])
+    count = 1
+    for options in choices:
+        count *= len(options)
+    if count == 1 or count > MAX_SLICE_PARTS:
+        return [slice_filter]
+    return [tuple(combination) for combination in itertools.product(*choices)]
+
+
+class SortedIndex:
+    """
+    Значения числового атрибута, отсортированные вместе с номерами строк, -
+    несколькими отсортированными отрезками. Партия загрузки становится новым
+    отрезком; последний отрезок сливается с предыдущим, когда дорастает до его
+    половины (как в LSM-дереве). Так каждая строка сливается O(log n) раз,
+    а не копируется вместе со всем массивом при каждой загрузке.
+    """
+
+    def __init__(self):
+        self.runs = []
+
+    def extend(self, values, start):
+        values = np.asarray(values, dtype=np.float64)
+        order = np.argsort(values, kind="stable")
+        self.runs.append((values[order], order + start))
+        while len(self.runs) > 1 and 2 * len(self.runs[-1][0]) >= len(self.runs[-2][0]):
+            self.runs[-2:] = [_merge_runs(self.runs[-2:])]
+
+    def range(self, low, high):
+        """
+        Номера строк со значением в [low, high] (NaN не попадает ни в один диапазон).
+        """
+        parts = [np.empty(0, dtype=np.int64)]
+        for values, rows in self.runs:
+            begin = np.searchsorted(values, low, side="left")
+            end = np.searchsorted(values, high, side="right")
+            parts.append(rows[begin:end])
+        return np.sort(np.concatenate(parts))
+
+    def merged(self):
+        """
+        Все значения по возрастанию (NaN в конце) и номера их строк: отрезки сливаются в один.
+        """
+        if not self.runs:
+            return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int64)
+        if len(self.runs) > 1:
+            self.runs = [_merge_runs(self.runs)]
+        return self.runs[0]
+
+
+def _merge_runs(runs):
+    values = np.concatenate([values for values, _ in runs])
+    rows = np.concatenate([rows for _, rows in runs])
+    # Устойчивая сортировка (timsort) сливает готовые отрезки почти за линейное время;
+    # при равных значениях строки более ранних отрезков остаются впереди
+    order = np.argsort(values, kind="stable")
+    return values[order], rows[order]
+
+
+class Postings:
+    """
+    Для каждого кода категории - возрастающий список номеров строк.
+    Строки только дописываются, поэтому новые номера добавляются в конец.
+    """
+
+    def __init__(self):
+        self.chunks = {}
+
+    def extend(self, codes, start):
+        order = np.argsort(codes, kind="stable")
+        sorted_codes = codes[order]
+        bounds = np.flatnonzero(np.diff(sorted_codes)) + 1
+        for group in np.split(order, bounds):
+            if len(group):
+                self.chunks.setdefault(int(codes[group[0]]), []).append(group + start)
+
+    def get(self, code):
+        chunks = self.chunks.get(code)
+        if not chunks:
+            return np.empty(0, dtype=np.int64)
+        if len(chunks) > 1:
+            chunks[:] = [np.concatenate(chunks)]
+        return chunks[0]
+
+
+class PageIndex:
+    """
+    Индексы атрибутов одной страницы: срез выбирает строки через индексы,
+    не просматривая колонки. Обновляется при каждой загрузке точек.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self.postings = {name: Postings() for name in POSTING_ATTRIBUTES}
+        self.sorted = {name: SortedIndex() for name in RANGE_ATTRIBUTES}
+
+    def extend(self, columns):
+        count = len(columns["x"])
+        if count == 0:
+            return
+        for name, index in self.postings.items():
+            index.extend(np.asarray(columns[name]), self.size)
+        for name, index in self.sorted.items():
+            values = np.asarray(columns[name], dtype=np.float64)
+            if name == "age":
+                # Возраст 0 означает "не указан" и не попадает ни в один диапазон
+                values = np.where(values == 0, np.nan, values)
+            index.extend(values, self.size)
+        self.size += count
+
+    def select(self, slice_filter, categories):
+        """
+        Отсортированные номера строк среза. categories - словари кодов хранилища.
+        """
+        rows = None
+        for name, values in slice_filter:
+            if name in RANGE_ATTRIBUTES:
+                selected = self.sorted[name].range(*values)
+            else:
+                codes = [categories[name][value] for value in values if value in categories[name]]
+                # Коды не пересекаются, поэтому объединение - просто слияние списков
+                selected = np.sort(np.concatenate(
+                    [self.postings[name].get(code) for code in codes] or [np.empty(0, np.int64)]))
+            rows = selected if rows is None else np.intersect1d(rows, selected, assume_unique=True)
+        if rows is None:
+            return np.arange(self.size, dtype=np.int64)
+        return rows
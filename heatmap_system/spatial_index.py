@@ -0,0 +1,118 @@
+import math
+
+import numpy as np
+
+from slice_index import Postings
+
+# Сторона корзины сеточного индекса в пикселях
+BUCKET_SIZE = 64
+# Номер корзины по каждой оси ограничен (точки за краем попадают в крайние корзины)
+BUCKET_LIMIT = 1 << 20
+# Ядро обрезается на таком числе bandwidth: дальше вклад точки меньше 3e-7
+KERNEL_REACH = 5
+# Разрыв между соседними точками сеанса больше этого (с) не считается временем взгляда
+MAX_DWELL_GAP = 2.0
+
+
+def bucket_codes(xs, ys, bucket_size=BUCKET_SIZE):
+    rows = np.clip(np.floor_divide(ys, bucket_size), 0, BUCKET_LIMIT - 1).astype(np.int64)
+    columns = np.clip(np.floor_divide(xs, bucket_size), 0, BUCKET_LIMIT - 1).astype(np.int64)
+    return rows * BUCKET_LIMIT + columns
+
+
+class GridIndex:
+    """
+    Равномерная сетка корзин BUCKET_SIZE x BUCKET_SIZE: для каждой корзины -
+    возрастающий список номеров строк (как Postings в индексах срезов).
+    Загрузка дописывает новые строки в их корзины, не трогая остальные.
+    """
+
+    def __init__(self, bucket_size=BUCKET_SIZE):
+        self.bucket_size = bucket_size
+        self.size = 0
+        self.postings = Postings()
+
+    def extend(self, xs, ys):
+        if len(xs) == 0:
+            return
+        self.postings.extend(bucket_codes(xs, ys, self.bucket_size), self.size)
+        self.size += len(xs)
+
+    def candidates(self, x0, y0, x1, y1):
+        """
+        Строки из корзин, пересекающих прямоугольник [x0, x1) x [y0, y1) (надмножество ответа).
+        """
+        size = self.bucket_size
+        j0, j1 = (int(np.clip(math.floor(value / size), 0, BUCKET_LIMIT - 1)) for value in (x0, x1))
+        i0, i1 = (int(np.clip(math.floor(value / size), 0, BUCKET_LIMIT - 1)) for value in (y0, y1))
+        chunks = self.postings.chunks
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(chunks):
+            # Большой прямоугольник: дешевле перебрать непустые корзины
+            codes = [code for code in chunks
+                     if i0 <= code // BUCKET_LIMIT <= i1 and j0 <= code % BUCKET_LIMIT <= j1]
+        else:
+            codes = [i * BUCKET_LIMIT + j for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)
+                     if i * BUCKET_LIMIT + j in chunks]
+        if not codes:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self.postings.get(code) for code in codes])
+
+    def query(self, xs, ys, x0, y0, x1, y1):
+        """
+        Отсортированные номера строк с точками внутри [x0, x1) x [y0, y1).
+        """
+        rows = self.candidates(x0, y0, x1, y1)
+        px, py = xs[rows], ys[rows]
+        inside = (px >= x0) & (px < x1) & (py >= y0) & (py < y1)
+        return np.sort(rows[inside])
+
+
+def _normal_cdf(values):
+    # Формула Абрамовица-Стиган 7.1.26 для erf (ошибка < 1.5e-7), векторно по NumPy
+    z = np.abs(values) / math.sqrt(2)
+    k = 1.0 / (1.0 + 0.3275911 * z)
+    poly = k * (0.254829592 + k * (-0.284496736 + k * (1.421413741
+                                                         + k * (-1.453152027 + k * 1.061405429))))
+    erf = 1.0 - poly * np.exp(-z * z)
+    return 0.5 * (1.0 + np.sign(values) * erf)
+
+
+def region_mass(index, xs, ys, rect, bandwidth, mask=None):
+    """
+    Масса плотности KDE в прямоугольнике rect = (x0, y0, x1, y1): сумма по точкам
+    доли гауссова ядра внутри него (сглаженное число точек). Гауссово ядро
+    сепарабельно, поэтому доля - произведение разностей функции распределения
+    по осям. Учитываются только точки из корзин в пределах KERNEL_REACH * bandwidth;
+    точки глубже этого внутри прямоугольника дают ровно 1 без вычисления ядра.
+    mask - булев массив выбранных строк (срез).
+    """
+    x0, y0, x1, y1 = rect
+    reach = KERNEL_REACH * bandwidth
+    rows = index.candidates(x0 - reach, y0 - reach, x1 + reach, y1 + reach)
+    if mask is not None:
+        rows = rows[mask[rows]]
+    px = xs[rows].astype(np.float64)
+    py = ys[rows].astype(np.float64)
+    inner = (px >= x0 + reach) & (px < x1 - reach) & (py >= y0 + reach) & (py < y1 - reach)
+    px, py = px[~inner], py[~inner]
+    mass_x = _normal_cdf((x1 - px) / bandwidth) - _normal_cdf((x0 - px) / bandwidth)
+    mass_y = _normal_cdf((y1 - py) / bandwidth) - _normal_cdf((y0 - py) / bandwidth)
+    return float(np.count_nonzero(inner) + np.sum(mass_x * mass_y))
+
+
+def dwell_times(times, sessions, max_gap=MAX_DWELL_GAP):
+    """
+    Время взгляда каждой точки: интервал до следующей точки того же сеанса,
+    если он не больше max_gap. Точки без сеанса (код 0) или без времени дают 0.
+    """
+    dwell = np.zeros(len(times), dtype=np.float64)
+    if len(times) < 2:
+        return dwell
+    order = np.lexsort((times, sessions))
+    sorted_times = np.asarray(times, dtype=np.float64)[order]
+    sorted_sessions = np.asarray(sessions)[order]
+    gaps = np.diff(sorted_times)
+    valid = ((sorted_sessions[1:] == sorted_sessions[:-1]) & (sorted_sessions[:-1] != 0)
+             & np.isfinite(gaps) & (gaps <= max_gap))
+    dwell[order[:-1]] = np.where(valid, gaps, 0.0)
+    return dwell
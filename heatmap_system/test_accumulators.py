@@ -0,0 +1,105 @@
+import unittest
+
+import numpy as np
+
+from accumulators import DensityAccumulator
+from heatmap_service import HOT_PARAMS_THRESHOLD, MAX_HOT_PARAMS, MAX_TRACKED_PARAMS
+from kde_engine import kde_brute
+from testing import HEIGHT, WIDTH, ServiceTestCase, random_points
+
+HOT = (10.0, 15.0, "brute")
+
+
+class DensityAccumulatorTest(unittest.TestCase):
+    def test_queued_batches_add_up_to_full_kde(self):
+        points = random_points(300)
+        accumulator = DensityAccumulator(WIDTH, HEIGHT, *HOT)
+        accumulator.queue((points[:100, 0], points[:100, 1]))
+        accumulator.queue((points[100:, 0], points[100:, 1]))
+        self.assertIsNone(accumulator.snapshot(100))
+        density = accumulator.snapshot(300)
+        expected = kde_brute(points[:, 0], points[:, 1], WIDTH, HEIGHT, 10.0, 15.0)
+        np.testing.assert_allclose(density, expected, rtol=1e-9, atol=1e-15)
+        # Снимок - копия, а не сама сетка
+        density[:] = 0
+        self.assertGreater(accumulator.density.max(), 0)
+
+
+class HotParamsTest(ServiceTestCase):
+    def make_service(self, **kwargs):
+        return super().make_service(hot_params=[HOT], **kwargs)
+
+    def accumulator(self, page_id="p", params=HOT):
+        return self.service.accumulators.get(page_id, {}).get(params)
+
+    def test_prepare_render_leaves_seeding_to_the_render(self):
+        self.add_background("p")
+        self.service.store_raw_data("p", random_points(200))
+        spec = self.service.prepare_render("p", *HOT)
+        # Поток запроса не считает KDE: плотность посчитает отрисовка
+        self.assertIsNone(spec["density"])
+        self.assertEqual(spec["seed"], (200, HOT))
+        self.assertIsNone(self.accumulator())
+
+    def test_render_seeds_accumulator_and_uploads_update_it(self):
+        self.add_background("p")
+        first, second = random_points(200, seed=1), random_points(150, seed=2)
+        self.service.store_raw_data("p", first)
+        self.assertIsNotNone(self.service.generate_heatmap("p", *HOT))
+        accumulator = self.accumulator()
+        self.assertEqual(accumulator.num_points, 200)
+
+        self.service.store_raw_data("p", second)
+        points = np.concatenate((first, second))
+        expected = kde_brute(points[:, 0], points[:, 1], WIDTH, HEIGHT, 10.0, 15.0)
+        density = accumulator.snapshot(350)
+        # Засев - из сетки float32 кэша сеток
+        np.testing.assert_allclose(density, expected, rtol=1e-5, atol=1e-6 * expected.max())
+
+        spec = self.service.prepare_render("p", *HOT)
+        self.assertIsNotNone(spec["density"])
+        self.assertIsNone(spec["points"])
+
+    def test_stale_accumulator_is_not_used_for_older_version(self):
+        self.add_background("p")
+        self.service.store_raw_data("p", random_points(100))
+        self.service.generate_heatmap("p", *HOT)
+        accumulator = self.accumulator()
+        self.assertIsNone(accumulator.snapshot(99))
+
+    def test_params_become_hot_after_threshold(self):
+        params = (5.0, 10.0, "brute")
+        for _ in range(HOT_PARAMS_THRESHOLD - 1):
+            self.service.lookup("p", *params)
+        self.assertNotIn(params, self.service.hot_params)
+        self.service.lookup("p", *params)
+        self.assertIn(params, self.service.hot_params)
+        self.assertNotIn(params, self.service.param_requests)
+
+    def test_nonlinear_methods_never_become_hot(self):
+        params = (5.0, 10.0, "adaptive")
+        for _ in range(HOT_PARAMS_THRESHOLD):
+            self.service.lookup("p", *params)
+        self.assertNotIn(params, self.service.hot_params)
+
+    def test_request_counters_are_bounded(self):
+        for bandwidth in range(MAX_TRACKED_PARAMS * 2):
+            self.service.lookup("p", float(bandwidth + 1), 15.0)
+        self.assertEqual(len(self.service.param_requests), MAX_TRACKED_PARAMS)
+
+    def test_coldest_params_are_evicted_with_accumulators(self):
+        self.add_background("p")
+        self.service.store_raw_data("p", random_points(100))
+        self.service.generate_heatmap("p", *HOT)
+        self.assertIsNotNone(self.accumulator())
+
+        for number in range(MAX_HOT_PARAMS):
+            for _ in range(HOT_PARAMS_THRESHOLD):
+                self.service.lookup("p", float(number + 20), 15.0, "brute")
+        self.assertEqual(len(self.service.hot_params), MAX_HOT_PARAMS)
+        self.assertNotIn(HOT, self.service.hot_params)
+        self.assertIsNone(self.accumulator())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from background_cache import BackgroundCache, load_background
+from testing import ServiceTestCase
+
+
+class BackgroundCacheTest(ServiceTestCase):
+    def save(self, color, size=(4, 3), mtime_ns=None):
+        Image.new("RGBA", size, color).save("bg.png")
+        if mtime_ns is not None:
+            os.utime("bg.png", ns=(mtime_ns, mtime_ns))
+
+    def test_decodes_once_per_version(self):
+        self.save((1, 2, 3, 255), mtime_ns=10**18)
+        cache = BackgroundCache(sidecar_dir="sidecars")
+        pixels = cache.get("bg.png")
+        self.assertEqual(pixels.shape, (3, 4, 4))
+        self.assertFalse(pixels.flags.writeable)
+        self.assertIs(cache.get("bg.png"), pixels)
+        self.assertEqual((cache.stats()["decodes"], cache.stats()["hits"]), (1, 1))
+
+        # Новый файл фона - новая запись, старый сайдкар не подходит
+        self.save((9, 9, 9, 255), mtime_ns=2 * 10**18)
+        self.assertEqual(tuple(cache.get("bg.png")[0, 0]), (9, 9, 9, 255))
+        self.assertEqual(cache.stats()["decodes"], 2)
+
+    def test_sidecar_is_shared_between_caches(self):
+        self.save((1, 2, 3, 255))
+        BackgroundCache(sidecar_dir="sidecars").get("bg.png")
+        other = BackgroundCache(sidecar_dir="sidecars")
+        pixels = other.get("bg.png")
+        self.assertEqual(other.stats()["sidecar_loads"], 1)
+        self.assertEqual(other.stats()["decodes"], 0)
+        np.testing.assert_array_equal(load_background("bg.png", other.sidecar_path("bg.png")),
+                                      pixels)
+
+    def test_byte_budget_evicts_old_backgrounds(self):
+        cache = BackgroundCache(max_bytes=4 * 3 * 4)
+        for name in ("a.png", "b.png"):
+            Image.new("RGBA", (4, 3)).save(name)
+            cache.get(name)
+        stats = cache.stats()
+        self.assertEqual((stats["entries"], stats["evictions"]), (1, 1))
+        self.assertEqual(list(cache.entries), ["b.png"])
+
+    def test_missing_background(self):
+        with self.assertRaises(FileNotFoundError):
+            BackgroundCache().get("missing.png")
+        self.service.store_raw_data("nobg", [[1, 2]])
+        self.assertIsNone(self.service.generate_heatmap("nobg", 10.0, 15.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
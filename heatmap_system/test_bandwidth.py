@@ -0,0 +1,56 @@
+import math
+import unittest
+
+import numpy as np
+
+from bandwidth import (FALLBACK_BANDWIDTH, MIN_AUTO_BANDWIDTH, PointMoments, scott_bandwidth,
+                       select_bandwidth, silverman_bandwidth)
+from testing import random_points
+
+
+def moments_of(points, batch=None):
+    moments = PointMoments()
+    points = np.asarray(points, dtype=np.float64)
+    for start in range(0, len(points), batch or len(points)):
+        part = points[start:start + (batch or len(points))]
+        moments.extend(part[:, 0], part[:, 1])
+    return moments
+
+
+class BandwidthRulesTest(unittest.TestCase):
+    # x = 0, 10, ..., 40; y = 2x. sigma: sqrt(250) и sqrt(1000), IQR: 20 и 40, n = 5
+    POINTS = [(10.0 * i, 20.0 * i) for i in range(5)]
+
+    def test_rules_by_hand(self):
+        moments = moments_of(self.POINTS)
+        # Скотт: sqrt(sigma_x * sigma_y) * n^(-1/6) = sqrt(500) * 5^(-1/6) = 10 * 5^(1/3)
+        self.assertAlmostEqual(scott_bandwidth(moments), 10 * 5 ** (1 / 3), places=9)
+        # Сильверман, d = 2: IQR / 1.34 < sigma по обеим осям, множитель (4/4)^(1/6) = 1
+        expected = math.sqrt(20 / 1.34 * 40 / 1.34) * 5 ** (-1 / 6)
+        self.assertAlmostEqual(silverman_bandwidth(moments), expected, places=9)
+        self.assertEqual(select_bandwidth(moments, "auto"), 17.0)
+        self.assertEqual(select_bandwidth(moments, "silverman"), 16.0)
+
+    def test_streaming_moments_match_numpy(self):
+        points = random_points(1000)
+        moments = moments_of(points, batch=97)
+        np.testing.assert_allclose(moments.std(), points.std(axis=0, ddof=1), rtol=1e-12)
+        low, high = np.percentile(points, (25, 75), axis=0)
+        np.testing.assert_allclose(moments.iqr(), high - low)
+
+    def test_clustered_data_gets_narrower_silverman_kernel(self):
+        # Плотная область и редкие точки вокруг: sigma велика, а IQR - по плотной области
+        clusters = np.concatenate((random_points(900, seed=1, width=10, height=10) + 100,
+                                   random_points(100, seed=2, width=1000, height=1000)))
+        moments = moments_of(clusters)
+        self.assertLess(silverman_bandwidth(moments), scott_bandwidth(moments) / 2)
+
+    def test_degenerate_data(self):
+        self.assertEqual(select_bandwidth(None, "auto"), FALLBACK_BANDWIDTH)
+        self.assertEqual(select_bandwidth(moments_of([(1, 1)]), "silverman"), FALLBACK_BANDWIDTH)
+        self.assertEqual(select_bandwidth(moments_of([(1, 1)] * 10), "silverman"),
+                         MIN_AUTO_BANDWIDTH)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import email.parser
+import email.policy
+import io
+import json
+import unittest
+import zipfile
+
+from heatmap_service import DEFAULT_STYLE, render_heatmap_group
+from server import parse_batch
+from testing import ServerTestCase, ServiceTestCase, random_points
+
+
+def item(page_id, bandwidth=10.0, grid=15.0):
+    return (page_id, bandwidth, grid, "brute", DEFAULT_STYLE, ())
+
+
+class ParseBatchTest(unittest.TestCase):
+    def test_specs_are_parsed_like_queries(self):
+        body = json.dumps({"format": "multipart",
+                           "specs": [{"page_id": "p", "bandwidth": 5, "grid": 10}]}).encode()
+        batch_format, items, queries = parse_batch(body)
+        self.assertEqual(batch_format, "multipart")
+        self.assertEqual(items[0][:3], ("p", 5.0, 10.0))
+        self.assertEqual(queries, [{"page_id": "p", "bandwidth": "5", "grid": "10"}])
+
+    def test_invalid_batches(self):
+        for data, message in (({"format": "tar", "specs": [{}]}, "Unknown format"),
+                              ({"specs": []}, "non-empty"),
+                              ({"specs": [1]}, "Spec 0 must be an object"),
+                              ({"specs": [{}, {"bandwidth": -1}]}, "Spec 1")):
+            with self.assertRaisesRegex(ValueError, message):
+                parse_batch(json.dumps(data).encode())
+
+
+class GenerateBatchTest(ServiceTestCase):
+    def setUp(self):
+        super().setUp()
+        for page_id in ("a", "b"):
+            self.add_background(page_id)
+            self.service.store_raw_data(page_id, random_points(100))
+        self.groups = []
+
+    def runner(self, specs):
+        self.groups.append([spec["cache_key"][0] for spec in specs])
+        return render_heatmap_group(specs)
+
+    def test_duplicates_render_once_per_page_group(self):
+        items = [item("a"), item("b"), item("a"), item("a", 20.0), item("missing")]
+        results = dict(self.service.generate_batch(items, self.runner))
+        self.assertEqual(sorted(self.groups), [["a", "a"], ["b"]])
+        self.assertIsNone(results[4])
+        self.assertEqual(results[0], results[2])
+        self.assertEqual(results[3], self.service.generate_heatmap("a", 20.0, 15.0))
+
+    def test_cached_maps_skip_rendering(self):
+        cached = self.service.generate_heatmap("a", 10.0, 15.0)
+        self.assertEqual(dict(self.service.generate_batch([item("a")], self.runner)), {0: cached})
+        self.assertEqual(self.groups, [])
+
+    def test_group_error_is_reported_for_its_items(self):
+        def failing(specs):
+            raise RuntimeError("render failed")
+
+        results = dict(self.service.generate_batch([item("a"), item("a", 20.0)], failing))
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results.values()))
+
+
+class BatchEndpointTest(ServerTestCase):
+    specs = [{"page_id": "p"}, {"page_id": "p", "bandwidth": 20}, {"page_id": "missing"}]
+
+    def setUp(self):
+        super().setUp()
+        self.add_background("p")
+        self.upload("p", random_points(100))
+
+    def expected(self, spec):
+        query = "&".join(f"{key}={value}" for key, value in spec.items())
+        return self.request("GET", f"/heatmap?{query}")[2]
+
+    def check_manifest(self, manifest):
+        self.assertEqual([entry["status"] for entry in manifest], ["ok", "ok", "not_found"])
+        self.assertEqual([entry["bandwidth"] for entry in manifest[:2]], [10.0, 20.0])
+        return [entry.get("file") for entry in manifest]
+
+    def test_zip(self):
+        status, headers, body = self.request("POST", "/heatmap/batch", {"specs": self.specs})
+        self.assertEqual((status, headers["Content-Type"]), (200, "application/zip"))
+        archive = zipfile.ZipFile(io.BytesIO(body))
+        files = self.check_manifest(json.loads(archive.read("manifest.json")))
+        self.assertEqual(sorted(archive.namelist()), sorted(files[:2] + ["manifest.json"]))
+        for spec, name in zip(self.specs[:2], files):
+            self.assertEqual(archive.read(name), self.expected(spec))
+
+    def test_multipart(self):
+        status, headers, body = self.request("POST", "/heatmap/batch",
+                                             {"format": "multipart", "specs": self.specs})
+        self.assertEqual(status, 200)
+        message = email.parser.BytesParser(policy=email.policy.default).parsebytes(
+            f"Content-Type: {headers['Content-Type']}\r\n\r\n".encode() + body)
+        parts = {part.get_filename(): part.get_content() for part in message.iter_parts()}
+        files = self.check_manifest(json.loads(parts.pop("manifest.json")))
+        self.assertEqual(parts, {name: self.expected(spec)
+                                 for spec, name in zip(self.specs[:2], files)})
+
+    def test_bad_batch_answers_400(self):
+        self.assertEqual(self.request("POST", "/heatmap/batch", {"specs": []})[0], 400)
+        self.assertEqual(self.request("POST", "/heatmap/batch", b"not json")[0], 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
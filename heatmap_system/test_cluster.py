@@ -0,0 +1,119 @@
+import io
+import json
+import socket
+import unittest
+import zipfile
+from collections import Counter
+
+from cluster import FORWARDED_HEADER, Cluster, ForwardError, HashRing
+from heatmap_service import HeatmapService
+from testing import ServerTestCase, random_points
+
+
+def free_address():
+    # Порт, на котором никто не слушает
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return "127.0.0.1:%d" % sock.getsockname()[1]
+
+
+class HashRingTest(unittest.TestCase):
+    KEYS = [f"page-{number}" for number in range(3000)]
+
+    def test_keys_are_spread_over_nodes(self):
+        ring = HashRing(["a", "b", "c"])
+        owners = Counter(ring.owner(key) for key in self.KEYS)
+        self.assertEqual(set(owners), {"a", "b", "c"})
+        for count in owners.values():
+            self.assertTrue(0.2 < count / len(self.KEYS) < 0.47, owners)
+        # Владелец зависит только от ключа и состава узлов
+        self.assertEqual(HashRing(["c", "b", "a"]).owner("page-1"), ring.owner("page-1"))
+
+    def test_removing_node_moves_only_its_keys(self):
+        full, reduced = HashRing(["a", "b", "c"]), HashRing(["a", "b"])
+        for key in self.KEYS:
+            if full.owner(key) != "c":
+                self.assertEqual(reduced.owner(key), full.owner(key), key)
+
+
+class ClusterTest(unittest.TestCase):
+    def test_config(self):
+        with self.assertRaises(ValueError):
+            Cluster("c", {"a": "127.0.0.1:1", "b": "127.0.0.1:2"})
+        cluster = Cluster("a", {"a": "127.0.0.1:1", "b": "127.0.0.1:2"})
+        self.assertEqual(list(cluster.pools), ["b"])
+        for _ in range(20):
+            self.assertTrue(cluster.is_local(cluster.new_job_id()))
+
+    def test_unavailable_node(self):
+        cluster = Cluster("a", {"a": "127.0.0.1:1", "b": free_address()})
+        with self.assertRaises(ForwardError):
+            cluster.forward("b", "GET", "/stats")
+
+
+class TwoNodeTest(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        # Узел b со своими каталогами кэша; фоны страниц общие (images/ в текущей папке)
+        self.other = HeatmapService(cache_dir="b_images", grid_dir="b_grids",
+                                    background_dir="b_backgrounds")
+        _, self.httpd_b = self.start_server(self.other)
+        nodes = {name: "%s:%d" % httpd.server_address
+                 for name, httpd in (("a", self.httpd), ("b", self.httpd_b))}
+        for (handler, _), name in zip(self.servers, nodes):
+            handler.cluster = Cluster(name, nodes)
+            handler.jobs.new_id = handler.cluster.new_job_id
+        ring = HashRing(nodes)
+        self.page = next(f"p{number}" for number in range(100) if ring.owner(f"p{number}") == "b")
+        self.add_background(self.page)
+
+    def test_requests_of_remote_page_go_to_its_owner(self):
+        self.upload(self.page, random_points(80))
+        self.assertEqual(self.other.points.count(self.page), 80)
+        self.assertNotIn(self.page, self.service.points.pages)
+
+        status, headers, body = self.request("GET", f"/heatmap?page_id={self.page}")
+        self.assertEqual(status, 200)
+        direct = self.request("GET", f"/heatmap?page_id={self.page}", httpd=self.httpd_b)
+        self.assertEqual((body, headers["ETag"]), (direct[2], direct[1]["ETag"]))
+        self.assertEqual(self.request("GET", f"/heatmap?page_id={self.page}",
+                                      headers={"If-None-Match": headers["ETag"]})[0], 304)
+
+        stats = json.loads(self.request("GET", "/stats")[2])["cluster"]
+        self.assertEqual(stats["forwarded"]["b"], 3)
+        # Соединение с узлом переиспользуется
+        self.assertEqual(stats["connections"]["b"]["created"], 1)
+
+    def test_jobs_and_batches_across_nodes(self):
+        self.upload(self.page, random_points(50))
+        status, _, body = self.request("POST", f"/heatmap/jobs?page_id={self.page}")
+        self.assertEqual(status, 202, body)
+        job_id = json.loads(body)["id"]
+        self.assertEqual(HashRing(["a", "b"]).owner(job_id), "b")
+        self.assertEqual(self.request("GET", f"/heatmap/jobs/{job_id}")[0], 200)
+
+        # Карты чужих страниц пакета запрашиваются у владельца
+        status, _, body = self.request("POST", "/heatmap/batch", {
+            "specs": [{"page_id": self.page}, {"page_id": "missing"}]})
+        self.assertEqual(status, 200)
+        archive = zipfile.ZipFile(io.BytesIO(body))
+        manifest = json.loads(archive.read("manifest.json"))
+        self.assertEqual([entry["status"] for entry in manifest], ["ok", "not_found"])
+        direct = self.request("GET", f"/heatmap?page_id={self.page}", httpd=self.httpd_b)[2]
+        self.assertEqual(archive.read(manifest[0]["file"]), direct)
+
+    def test_forwarded_request_is_handled_locally(self):
+        self.upload(self.page, random_points(50))
+        status, _, _ = self.request("GET", f"/heatmap?page_id={self.page}",
+                                    headers={FORWARDED_HEADER: "b"})
+        self.assertEqual(status, 404)
+
+    def test_unavailable_owner_answers_502(self):
+        self.handler.cluster = Cluster("a", {"a": "%s:%d" % self.httpd.server_address,
+                                             "b": free_address()})
+        status, _, _ = self.request("GET", f"/heatmap?page_id={self.page}")
+        self.assertEqual(status, 502)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+
+from heatmap_cache import key_etag, normalize_key
+from server import CACHE_CONTROL, etag_matches
+from testing import ServerTestCase, random_points
+
+
+class EtagMatchTest(unittest.TestCase):
+    def test_if_none_match_forms(self):
+        etag = key_etag(normalize_key("p", "5-ab", 10.0, 15.0))
+        self.assertTrue(etag_matches(etag, etag))
+        self.assertTrue(etag_matches(f'"other", W/{etag}', etag))
+        self.assertTrue(etag_matches("*", etag))
+        self.assertFalse(etag_matches('"other"', etag))
+        self.assertFalse(etag_matches(etag.strip('"'), etag))
+
+    def test_etag_follows_key(self):
+        key = normalize_key("p", "5-ab", 10.0, 15.0)
+        self.assertEqual(key_etag(key), key_etag(normalize_key("p", "5-ab", 10, 15)))
+        self.assertNotEqual(key_etag(key), key_etag(normalize_key("p", "6-ab", 10.0, 15.0)))
+        self.assertNotEqual(key_etag(key), key_etag(normalize_key("p", "5-ab", 10.0, 16.0)))
+
+
+class ConditionalRequestTest(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_background("p")
+        self.upload("p", random_points(100))
+
+    def get(self, path, etag=None):
+        return self.request("GET", path, headers={"If-None-Match": etag} if etag else None)
+
+    def renders(self):
+        return self.service.flights.stats()["computations"]
+
+    def test_304_for_current_etag_without_rendering(self):
+        status, headers, body = self.get("/heatmap?page_id=p")
+        self.assertEqual((status, headers["Cache-Control"]), (200, CACHE_CONTROL))
+        etag = headers["ETag"]
+        # Карта вытеснена из кэша: 304 всё равно не требует отрисовки
+        for key in self.service.cache.keys():
+            self.service.cache.discard(key)
+        renders = self.renders()
+        status, headers, body = self.get("/heatmap?page_id=p", etag)
+        self.assertEqual((status, body, headers["ETag"]), (304, b"", etag))
+        self.assertNotIn("Content-Length", headers)
+        self.assertEqual(self.renders(), renders)
+        self.assertEqual(self.get("/heatmap?page_id=p&bandwidth=20", etag)[0], 200)
+
+    def test_upload_changes_etag(self):
+        etag = self.get("/heatmap?page_id=p")[1]["ETag"]
+        self.upload("p", random_points(10, seed=1))
+        status, headers, _ = self.get("/heatmap?page_id=p", etag)
+        self.assertEqual(status, 200)
+        self.assertNotEqual(headers["ETag"], etag)
+        self.assertEqual(self.get("/heatmap?page_id=p", headers["ETag"])[0], 304)
+
+    def test_tiles_and_animations(self):
+        self.upload("p", [[10, 10, 1.0], [20, 20, 100.0]])
+        for path in ("/heatmap/tiles/p/0/0/0.png", "/heatmap/animation?page_id=p&interval=30"):
+            status, headers, _ = self.get(path)
+            self.assertEqual(status, 200, path)
+            self.assertEqual(self.get(path, headers["ETag"])[0], 304, path)
+
+    def test_page_without_points_has_no_etag(self):
+        status, headers, _ = self.get("/heatmap?page_id=missing", "*")
+        self.assertEqual(status, 404)
+        self.assertNotIn("ETag", headers)
+
+
+if __name__ == "__main__":
+    unittest.main()
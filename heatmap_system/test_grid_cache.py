@@ -0,0 +1,65 @@
+import os
+import unittest
+
+import numpy as np
+
+from grid_cache import GridCache, load_grid, save_grid
+from heatmap_service import DEFAULT_STYLE, render_heatmap
+from testing import ServiceTestCase, random_points
+
+
+class GridCacheTest(ServiceTestCase):
+    def test_grid_round_trip(self):
+        grid = np.arange(12, dtype=np.float32).reshape(3, 4)
+        save_grid("grid.npy", grid)
+        np.testing.assert_array_equal(load_grid("grid.npy"), grid)
+        self.assertEqual([name for name in os.listdir(".") if name.endswith(".tmp")], [])
+
+    def test_only_written_grids_are_registered(self):
+        cache = GridCache("grids", 1024)
+        cache.add(("p", "1", "density"))
+        self.assertIsNone(cache.find(("p", "1", "density")))
+        save_grid(cache.path(("p", "1", "density")), np.zeros((2, 2), dtype=np.float32))
+        cache.add(("p", "1", "density"))
+        self.assertIsNotNone(cache.find(("p", "1", "density")))
+
+
+class RenderStagesTest(ServiceTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_background("p")
+        self.service.store_raw_data("p", random_points(200))
+        self.specs = []
+
+    def runner(self, spec):
+        self.specs.append(spec)
+        return render_heatmap(spec)
+
+    def render(self, style=DEFAULT_STYLE):
+        return self.service.generate_heatmap("p", 10.0, 15.0, style=style, runner=self.runner)
+
+    def test_new_style_reuses_cached_grids(self):
+        first = self.render()
+        self.assertFalse(self.specs[0]["density_cached"] or self.specs[0]["normalized_cached"])
+
+        # Другой цвет - та же нормированная сетка, KDE не нужен
+        recolored = self.render(DEFAULT_STYLE._replace(color="00ff00"))
+        self.assertTrue(self.specs[1]["normalized_cached"])
+        self.assertNotEqual(recolored, first)
+
+        # Другая шкала - та же плотность, нормировка заново. Третий запрос делает
+        # параметры горячими: плотность приходит готовой из засеянного аккумулятора
+        self.render(DEFAULT_STYLE._replace(norm="log"))
+        spec = self.specs[2]
+        self.assertFalse(spec["normalized_cached"])
+        self.assertTrue(spec["density_cached"] or spec["density"] is not None)
+
+    def test_cached_density_is_float32_grid(self):
+        self.render()
+        density = load_grid(self.specs[0]["density_path"])
+        self.assertEqual(density.dtype, np.float32)
+        self.assertEqual(density.shape, (10, 13))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from heatmap_cache import (HASHED_PREFIX, KEY_FILE_SUFFIX, MAX_STEM_BYTES, DiskCache, MemoryLRU,
+                           TwoTierCache, filename_to_key, key_etag, key_to_filename,
+                           normalize_key)
+from testing import ServiceTestCase, random_points
+
+
+def write(cache, key, data):
+    with open(cache.path(key), "wb") as f:
+        f.write(data)
+
+
+class KeyTest(unittest.TestCase):
+    def test_numbers_are_canonical(self):
+        self.assertEqual(normalize_key("p", 10, 15.0), normalize_key("p", 10.0, 15))
+        self.assertEqual(normalize_key("p", 2.5), ("p", "2.5"))
+
+    def test_filename_round_trip(self):
+        key = normalize_key("page/with+odd chars", "5-ab", 10, "gender:f,m")
+        self.assertEqual(filename_to_key(key_to_filename(key)), key)
+
+    def test_long_keys_are_hashed(self):
+        key = normalize_key("p", "1-ab", "x" * (MAX_STEM_BYTES + 1))
+        filename = key_to_filename(key)
+        self.assertTrue(filename.startswith(HASHED_PREFIX))
+        self.assertIsNone(filename_to_key(filename))
+        self.assertLess(len(filename), 255)
+
+    def test_etag_depends_on_key(self):
+        self.assertEqual(key_etag(("p", "1")), key_etag(("p", "1")))
+        self.assertNotEqual(key_etag(("p", "1")), key_etag(("p", "2")))
+
+
+class MemoryLRUTest(unittest.TestCase):
+    def test_evicts_least_recently_used_by_bytes(self):
+        lru = MemoryLRU(10)
+        lru.put("a", b"1234")
+        lru.put("b", b"1234")
+        lru.get("a")
+        lru.put("c", b"1234")
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.get("a"), b"1234")
+        self.assertEqual(lru.size, 8)
+        self.assertEqual(lru.evictions, 1)
+
+    def test_oversized_entry_is_not_kept(self):
+        lru = MemoryLRU(3)
+        lru.put("a", b"1234")
+        self.assertIsNone(lru.get("a"))
+
+
+class DiskCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_budget_evicts_oldest_files(self):
+        cache = DiskCache(self.tmp, 10)
+        for name in ("a", "b", "c"):
+            key = ("p", "1", name)
+            write(cache, key, b"1234")
+            cache.add(key)
+            if name == "a":
+                cache.find(key)
+        self.assertEqual(cache.keys(), [("p", "1", "b"), ("p", "1", "c")])
+        self.assertFalse(os.path.exists(cache.path(("p", "1", "a"))))
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_index_is_rebuilt_on_restart(self):
+        cache = DiskCache(self.tmp, 100)
+        long_key = ("p", "1", "f" * MAX_STEM_BYTES)
+        for key in (("p", "1", "a"), long_key):
+            write(cache, key, b"data")
+            cache.add(key)
+        self.assertTrue(os.path.exists(cache.path(long_key) + KEY_FILE_SUFFIX))
+        # Старые файлы .png и хэшированный файл без .key (сбой до add) удаляются
+        open(os.path.join(self.tmp, "old.png"), "wb").close()
+        orphan = ("p", "1", "o" * MAX_STEM_BYTES)
+        write(cache, orphan, b"data")
+
+        restarted = DiskCache(self.tmp, 100, stale_suffixes=(".png",))
+        self.assertEqual(set(restarted.keys()), {("p", "1", "a"), long_key})
+        self.assertEqual(restarted.get(long_key), b"data")
+        self.assertEqual(restarted.size, 8)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, "old.png")))
+        self.assertFalse(os.path.exists(restarted.path(orphan)))
+
+    def test_discard_removes_key_file(self):
+        cache = DiskCache(self.tmp, 100)
+        key = ("p", "1", "k" * MAX_STEM_BYTES)
+        write(cache, key, b"data")
+        cache.add(key)
+        cache.discard(key)
+        self.assertEqual(os.listdir(self.tmp), [])
+
+    def test_missing_file_is_a_miss(self):
+        cache = DiskCache(self.tmp, 100)
+        key = ("p", "1")
+        write(cache, key, b"data")
+        cache.add(key)
+        os.remove(cache.path(key))
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(cache.keys(), [])
+
+
+class TwoTierCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_disk_hit_is_promoted_to_memory(self):
+        cache = TwoTierCache(self.tmp, 100, 100)
+        key = ("p", "1")
+        write(cache, key, b"image")
+        self.assertEqual(cache.add_file(key), b"image")
+
+        restarted = TwoTierCache(self.tmp, 100, 100)
+        self.assertEqual(restarted.memory.get(key), None)
+        with restarted.get(key, as_file=True) as f:
+            self.assertEqual(f.read(), b"image")
+        self.assertEqual(restarted.get(key), b"image")
+        self.assertEqual(restarted.memory.get(key), b"image")
+
+    def test_discard_clears_both_tiers(self):
+        cache = TwoTierCache(self.tmp, 100, 100)
+        key = ("p", "1")
+        write(cache, key, b"image")
+        cache.add_file(key)
+        cache.discard(key)
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(cache.keys(), set())
+        stats = cache.stats()
+        self.assertEqual((stats["memory"]["bytes"], stats["disk"]["bytes"]), (0, 0))
+
+
+class ServiceCacheTest(ServiceTestCase):
+    def test_restarted_service_serves_maps_from_disk(self):
+        self.add_background("p")
+        service = self.make_service(data_dir="data")
+        service.store_raw_data("p", random_points(100))
+        data = service.generate_heatmap("p", 10.0, 15.0)
+
+        def runner(spec):
+            raise AssertionError("cached map was rendered again")
+
+        restarted = self.make_service(data_dir="data")
+        self.assertEqual(restarted.generate_heatmap("p", 10.0, 15.0, runner=runner), data)
+
+    def test_disk_budget_bounds_cached_maps(self):
+        self.add_background("p")
+        service = self.make_service(memory_cache_bytes=0, disk_cache_bytes=1)
+        service.store_raw_data("p", random_points(100))
+        self.assertIsNotNone(service.generate_heatmap("p", 10.0, 15.0))
+        self.assertEqual(service.cache.keys(), set())
+        self.assertEqual(os.listdir("cache_images"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import json
+import threading
+import unittest
+
+from heatmap_service import DEFAULT_STYLE, render_heatmap
+from job_queue import (CANCELLED, DONE, FINISHED, MAX_JOBS_PER_CLIENT, NOT_FOUND,
+                       JobLimitExceeded, JobQueue)
+from testing import ServerTestCase, ServiceTestCase, random_points, wait_until
+
+
+def params(page_id, bandwidth=10.0):
+    return (page_id, bandwidth, 15.0, "brute", DEFAULT_STYLE, ())
+
+
+class JobQueueTest(ServiceTestCase):
+    def setUp(self):
+        super().setUp()
+        self.release = threading.Event()
+        self.rendered = []
+        for page_id in ("blocker", "low", "normal", "high"):
+            self.add_background(page_id)
+            self.service.store_raw_data(page_id, random_points(50))
+        self.jobs = JobQueue(self.service, 1, self.runner)
+
+    def tearDown(self):
+        self.release.set()
+        self.jobs.shutdown()
+        super().tearDown()
+
+    def runner(self, spec):
+        page_id = spec["cache_key"][0]
+        self.rendered.append(page_id)
+        if page_id == "blocker":
+            self.release.wait(10)
+        return render_heatmap(spec)
+
+    def wait_finished(self, job):
+        self.assertTrue(wait_until(lambda: self.jobs.get(job.id)["status"] in FINISHED))
+        return self.jobs.get(job.id)
+
+    def test_higher_priority_runs_first(self):
+        blocker = self.jobs.submit("a", params("blocker"))
+        self.assertTrue(wait_until(lambda: self.rendered == ["blocker"]))
+        low = self.jobs.submit("b", params("low"), "low")
+        normal = self.jobs.submit("b", params("normal"))
+        high = self.jobs.submit("b", params("high"), "high")
+        self.assertEqual(self.jobs.get(low.id)["position"], 2)
+        self.assertEqual(self.jobs.get(high.id)["position"], 0)
+        self.release.set()
+        for job in (blocker, low, normal, high):
+            self.assertEqual(self.wait_finished(job)["status"], DONE)
+        self.assertEqual(self.rendered, ["blocker", "high", "normal", "low"])
+        status, data = self.jobs.result(high.id)
+        self.assertEqual(status, DONE)
+        self.assertEqual(data, self.service.generate_heatmap("high", 10.0, 15.0))
+
+    def test_cancelled_job_is_skipped(self):
+        self.jobs.submit("a", params("blocker"))
+        self.assertTrue(wait_until(lambda: self.rendered == ["blocker"]))
+        job = self.jobs.submit("a", params("low"))
+        self.assertEqual(self.jobs.cancel(job.id)["status"], CANCELLED)
+        self.release.set()
+        self.assertTrue(wait_until(lambda: self.jobs.stats()["clients"] == 0))
+        self.assertEqual(self.rendered, ["blocker"])
+        self.assertEqual(self.jobs.result(job.id), (CANCELLED, None))
+        self.assertIsNone(self.jobs.cancel("0" * 32))
+
+    def test_per_client_limit(self):
+        jobs = [self.jobs.submit("a", params("blocker", bandwidth=number + 1))
+                for number in range(MAX_JOBS_PER_CLIENT)]
+        with self.assertRaises(JobLimitExceeded):
+            self.jobs.submit("a", params("low"))
+        self.jobs.submit("b", params("low"))
+        # Отмена освобождает место клиента
+        self.jobs.cancel(jobs[-1].id)
+        self.jobs.submit("a", params("low"))
+        with self.assertRaises(ValueError):
+            self.jobs.submit("c", params("low"), "urgent")
+
+    def test_page_without_data(self):
+        self.release.set()
+        job = self.jobs.submit("a", params("missing"))
+        self.assertEqual(self.wait_finished(job)["status"], NOT_FOUND)
+
+
+class JobsEndpointTest(ServerTestCase):
+    def test_submit_poll_fetch_and_cancel(self):
+        self.add_background("p")
+        self.upload("p", random_points(50))
+        status, headers, body = self.request("POST", "/heatmap/jobs?page_id=p&priority=high")
+        self.assertEqual(status, 202)
+        info = self.jobs_info(body)
+        self.assertEqual(headers["Location"], f"/heatmap/jobs/{info['id']}")
+
+        self.assertTrue(wait_until(
+            lambda: self.jobs_info(self.request("GET", headers["Location"])[2])["status"] == DONE))
+        status, headers, image = self.request("GET", f"/heatmap/jobs/{info['id']}/result")
+        self.assertEqual((status, headers["Content-Type"]), (200, "image/png"))
+        self.assertEqual(image, self.request("GET", "/heatmap?page_id=p")[2])
+
+        status, _, body = self.request("DELETE", f"/heatmap/jobs/{info['id']}")
+        self.assertEqual((status, self.jobs_info(body)["status"]), (200, DONE))
+        self.assertEqual(self.request("GET", "/heatmap/jobs/" + "0" * 32)[0], 404)
+        self.assertEqual(self.request("POST", "/heatmap/jobs?page_id=p&priority=urgent")[0], 400)
+
+    def test_client_limit_answers_429(self):
+        # Единственный исполнитель занят, задания клиента остаются в очереди
+        release = threading.Event()
+        self.addCleanup(release.set)
+        self.handler.jobs.shutdown()
+        self.handler.jobs = JobQueue(self.service, 1, lambda spec: release.wait(10))
+        self.add_background("p")
+        self.service.store_raw_data("p", random_points(50))
+        for number in range(MAX_JOBS_PER_CLIENT):
+            self.handler.jobs.submit("client", params("p", bandwidth=number + 1))
+        status, headers, _ = self.request("POST", "/heatmap/jobs?page_id=p",
+                                          headers={"X-Client-Id": "client"})
+        self.assertEqual(status, 429)
+        self.assertIn("Retry-After", headers)
+        self.assertEqual(self.request("POST", "/heatmap/jobs?page_id=p",
+                                      headers={"X-Client-Id": "other"})[0], 202)
+        release.set()
+
+    @staticmethod
+    def jobs_info(body):
+        return json.loads(body)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import importlib.util
+import os
+import sys
+import tempfile
+import unittest
+
+from kde_engine import KDE_METHODS, as_point_arrays
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Эталонные реализации (циклы Python) - в heatmap_project/main.py
+sys.path.insert(0, os.path.join(ROOT, "heatmap_project"))
+import main as reference  # noqa: E402
+
+
+def load_h_sys():
+    # h_sys/main.py тоже называется main и при импорте создаёт cache_images в текущей папке
+    spec = importlib.util.spec_from_file_location("h_sys_main",
+                                                  os.path.join(ROOT, "h_sys", "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            spec.loader.exec_module(module)
+        finally:
+            os.chdir(cwd)
+    return module
+
+WIDTH, HEIGHT = 200, 150
+# (bandwidth, grid_spacing): ячейка меньше, равна и больше bandwidth
+PARAMS = ((10, 10), (6, 4), (15, 7.5), (3, 10))
+# brute и accumulate считают то же, что эталон, отличие - только порядок сложения
+EXACT_TOLERANCE = 1e-9
+# fft приближённый (биннинг и обрезка ядра): на этих данных 5e-3..2e-2 от максимума
+FFT_TOLERANCE = 5e-2
+
+
+class KdeParityTest(unittest.TestCase):
+    """
+    Совпадение методов kde_engine с эталонными kde_brute_force и kde_accumulate
+    (отклонение отнесено к максимуму эталонной плотности).
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.points = reference.generate_random_walk_data(WIDTH, HEIGHT, 20, 50, 5.0, seed=0)
+        cls.xs, cls.ys = as_point_arrays(cls.points)
+
+    def density(self, method, bandwidth, grid_spacing):
+        return KDE_METHODS[method](self.xs, self.ys, WIDTH, HEIGHT, bandwidth, grid_spacing)
+
+    def test_brute_matches_reference(self):
+        for bandwidth, grid_spacing in PARAMS:
+            expected = reference.kde_brute_force(self.points, WIDTH, HEIGHT, bandwidth,
+                                                 grid_spacing)
+            error = reference.max_relative_error(expected,
+                                                 self.density("brute", bandwidth, grid_spacing))
+            self.assertLess(error, EXACT_TOLERANCE, (bandwidth, grid_spacing))
+
+    def test_accumulate_matches_reference(self):
+        for bandwidth, grid_spacing in PARAMS:
+            expected = reference.kde_accumulate(self.points, WIDTH, HEIGHT, bandwidth,
+                                                grid_spacing)
+            error = reference.max_relative_error(
+                expected, self.density("accumulate", bandwidth, grid_spacing))
+            self.assertLess(error, EXACT_TOLERANCE, (bandwidth, grid_spacing))
+
+    def test_fft_close_to_reference(self):
+        for bandwidth, grid_spacing in PARAMS:
+            expected = reference.kde_brute_force(self.points, WIDTH, HEIGHT, bandwidth,
+                                                 grid_spacing)
+            error = reference.max_relative_error(expected,
+                                                 self.density("fft", bandwidth, grid_spacing))
+            self.assertLess(error, FFT_TOLERANCE, (bandwidth, grid_spacing))
+
+
+class KdeCopiesParityTest(unittest.TestCase):
+    """
+    Копии векторизованного и FFT-методов в heatmap_project и h_sys
+    должны считать то же, что kde_engine: расхождение копий ловится здесь.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.points = reference.generate_random_walk_data(WIDTH, HEIGHT, 20, 50, 5.0, seed=0)
+        cls.xs, cls.ys = as_point_arrays(cls.points)
+        cls.h_sys = load_h_sys()
+
+    def assert_same(self, copy, method):
+        for bandwidth, grid_spacing in PARAMS:
+            expected = KDE_METHODS[method](self.xs, self.ys, WIDTH, HEIGHT, bandwidth,
+                                           grid_spacing)
+            actual = copy(self.points, WIDTH, HEIGHT, bandwidth, grid_spacing)
+            self.assertEqual(expected.shape, actual.shape)
+            error = reference.max_relative_error(expected, actual)
+            self.assertLess(error, EXACT_TOLERANCE, (bandwidth, grid_spacing))
+
+    def test_project_vectorized_matches_engine(self):
+        self.assert_same(reference.kde_vectorized, "brute")
+
+    def test_project_fft_matches_engine(self):
+        self.assert_same(reference.kde_binned_fft, "fft")
+
+    def test_h_sys_matches_engine(self):
+        self.assert_same(self.h_sys.kde_density_grid, "brute")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from metrics import Metrics, SlowRequestProfiler, route_label
+from server import METRICS_CONTENT_TYPE
+from testing import ServerTestCase, random_points, wait_until
+
+
+def parse_metrics(text):
+    """
+    Образцы текста Prometheus: {"имя{метки}": значение}.
+    """
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+class MetricsTest(unittest.TestCase):
+    def test_route_labels(self):
+        job_id = "0123456789abcdef" * 2
+        self.assertEqual(route_label("/heatmap"), "/heatmap")
+        self.assertEqual(route_label("/heatmap/tiles/p/1/0/0.png"), "/heatmap/tiles")
+        self.assertEqual(route_label(f"/heatmap/jobs/{job_id}"), "/heatmap/jobs/{id}")
+        self.assertEqual(route_label(f"/heatmap/jobs/{job_id}/result"), "/heatmap/jobs/{id}/result")
+        self.assertEqual(route_label("/heatmap/jobs/other"), "other")
+        self.assertEqual(route_label("/favicon.ico"), "other")
+
+    def test_histograms_are_cumulative(self):
+        metrics = Metrics()
+        for seconds in (0.001, 0.02, 0.02, 100.0):
+            metrics.observe_request("/heatmap", "GET", 200, seconds)
+        metrics.observe_request("/heatmap", "GET", 404, 0.001)
+        metrics.observe_stages("heatmap", {"kde": 0.3, "encode": 0.004})
+        samples = parse_metrics(metrics.render())
+        prefix = 'heatmap_http_request_duration_seconds_bucket{route="/heatmap",method="GET",le='
+        self.assertEqual(samples[prefix + '"0.005"}'], 2)
+        self.assertEqual(samples[prefix + '"0.025"}'], 4)
+        self.assertEqual(samples[prefix + '"30.0"}'], 4)
+        self.assertEqual(samples[prefix + '"+Inf"}'], 5)
+        self.assertAlmostEqual(
+            samples['heatmap_http_request_duration_seconds_sum{route="/heatmap",method="GET"}'],
+            100.042)
+        self.assertEqual(samples['heatmap_http_responses_total'
+                                 '{route="/heatmap",method="GET",status="404"}'], 1)
+        self.assertEqual(samples['heatmap_render_stage_seconds_count'
+                                 '{kind="heatmap",stage="kde"}'], 1)
+
+    def test_label_values_are_escaped(self):
+        metrics = Metrics()
+        metrics.observe_request('a"b\\c\n', "GET", 200, 0.1)
+        self.assertIn('route="a\\"b\\\\c\\n"', metrics.render())
+
+
+class SlowRequestProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_keeps_slowest_requests_with_stacks(self):
+        profiler = SlowRequestProfiler(0.05, self.tmp, interval=0.005, keep=2)
+        for number, seconds in enumerate((0.2, 0.01, 0.1, 0.3)):
+            profiler.start()
+            if number == 0:
+                time.sleep(0.05)
+            profiler.stop("GET", f"/heatmap?n={number}", 200, seconds)
+        report = profiler.report()
+        self.assertEqual([entry["path"] for entry in report], ["/heatmap?n=3", "/heatmap?n=0"])
+        self.assertTrue(any("test_metrics.py" in stack for stack in report[1]["samples"]))
+        with open(os.path.join(self.tmp, "slow_requests.json"), encoding="utf-8") as f:
+            self.assertEqual(json.load(f), report)
+
+
+class MetricsEndpointTest(ServerTestCase):
+    def metrics(self):
+        status, headers, body = self.request("GET", "/metrics")
+        self.assertEqual((status, headers["Content-Type"]), (200, METRICS_CONTENT_TYPE))
+        return parse_metrics(body.decode("utf-8"))
+
+    def test_requests_renders_and_pages_are_reported(self):
+        # Метрики запросов общие на процесс: сравниваем с показаниями до запросов
+        ok = 'heatmap_http_responses_total{route="/heatmap",method="GET",status="200"}'
+        renders = 'heatmap_render_stage_seconds_count{kind="heatmap",stage="kde"}'
+        before = self.metrics()
+        self.add_background("p")
+        self.upload("p", random_points(123))
+        for _ in range(2):
+            self.assertEqual(self.request("GET", "/heatmap?page_id=p")[0], 200)
+        after = self.metrics()
+        self.assertEqual(after[ok] - before.get(ok, 0), 2)
+        self.assertEqual(after[renders] - before.get(renders, 0), 1)
+        self.assertEqual(after['heatmap_page_points{page="p"}'], 123)
+        self.assertEqual(after['heatmap_cache_hits_total{cache="memory"}'], 1)
+        self.assertEqual(after['heatmap_renders_total'], 1)
+
+    def test_slow_request_report(self):
+        self.assertEqual(self.request("GET", "/debug/slow")[0], 404)
+        self.handler.profiler = SlowRequestProfiler(0, os.path.join(self.tmp, "profiles"))
+        self.request("GET", "/stats")
+        self.assertTrue(wait_until(lambda: json.loads(self.request("GET", "/debug/slow")[2])))
+        report = json.loads(self.request("GET", "/debug/slow")[2])
+        self.assertIn("/stats", [entry["path"] for entry in report])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import io
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from heatmap_service import DEFAULT_STYLE
+from renderer import save_image
+from server import parse_style
+from testing import HEIGHT, WIDTH, ServerTestCase, ServiceTestCase, random_points
+
+
+def query(text):
+    return {name: [value] for name, value in
+            (part.split("=", 1) for part in text.split("&") if part)}
+
+
+def decode(data):
+    return Image.open(io.BytesIO(data))
+
+
+class ParseStyleTest(unittest.TestCase):
+    def test_defaults_and_options(self):
+        self.assertEqual(parse_style({}), DEFAULT_STYLE)
+        style = parse_style(query("color=#00FF00&format=WEBP&level=50&overlay=yes"))
+        self.assertEqual((style.color, style.format, style.level, style.overlay),
+                         ("00ff00", "webp", 50, True))
+        # Без параметров кодирования (анимация) format и level не разбираются
+        self.assertEqual(parse_style(query("format=gif&level=500"), output=False),
+                         DEFAULT_STYLE)
+
+    def test_invalid_styles(self):
+        for text in ("format=gif", "format=png&level=10", "format=webp&level=0",
+                     "format=jpeg&level=101", "format=jpeg&overlay=1", "color=red",
+                     "opacity=1.5", "norm=cube", "interpolation=cubic"):
+            with self.assertRaises(ValueError, msg=text):
+                parse_style(query(text))
+
+
+class SaveImageTest(unittest.TestCase):
+    def setUp(self):
+        pixels = np.zeros((HEIGHT, WIDTH, 4), dtype=np.uint8)
+        pixels[..., 0] = np.arange(WIDTH) % 256
+        pixels[..., 3] = 255
+        pixels[:20, :20, 3] = 0
+        self.image = Image.fromarray(pixels, "RGBA")
+
+    def encode(self, output_format, level=None):
+        out = io.BytesIO()
+        save_image(self.image, out, output_format, level)
+        return out.getvalue()
+
+    def test_png_levels_are_lossless(self):
+        fast, small = self.encode("png", 0), self.encode("png", 9)
+        self.assertGreater(len(fast), len(small))
+        for data in (fast, small):
+            np.testing.assert_array_equal(np.asarray(decode(data)), np.asarray(self.image))
+
+    def test_lossy_formats(self):
+        webp = decode(self.encode("webp", 90))
+        self.assertEqual((webp.format, webp.mode), ("WEBP", "RGBA"))
+        jpeg = decode(self.encode("jpeg"))
+        self.assertEqual((jpeg.format, jpeg.mode, jpeg.size), ("JPEG", "RGB", (WIDTH, HEIGHT)))
+        self.assertLess(len(self.encode("jpeg", 10)), len(self.encode("jpeg", 95)))
+
+
+class StyledRenderTest(ServiceTestCase):
+    def test_styles_share_density_and_overlay_is_transparent(self):
+        self.add_background("p")
+        points = random_points(50, width=WIDTH / 2)
+        self.service.store_raw_data("p", points)
+        png = self.service.generate_heatmap("p", 5.0, 10.0)
+        overlay_style = DEFAULT_STYLE._replace(format="webp", level=100, overlay=True)
+        spec = self.service.prepare_render("p", 5.0, 10.0, style=overlay_style)
+        # Другое оформление - другой ключ, но плотность и нормировка уже готовы
+        self.assertNotEqual(spec["cache_key"], self.service.cache_key("p", 5.0, 10.0))
+        self.assertTrue(spec["normalized_cached"])
+        overlay = decode(self.service.generate_heatmap("p", 5.0, 10.0, style=overlay_style))
+        self.assertEqual(overlay.format, "WEBP")
+        alpha = np.asarray(overlay.convert("RGBA"))[..., 3]
+        # Фона нет: справа от точек слой прозрачный
+        self.assertFalse(alpha[:, -40:].any())
+        self.assertTrue(alpha[:, :WIDTH // 2].any())
+        self.assertTrue((np.asarray(decode(png))[..., 3] == 255).all())
+
+
+class FormatEndpointTest(ServerTestCase):
+    def test_content_types_and_errors(self):
+        self.add_background("p")
+        self.upload("p", random_points(50))
+        for params, content_type in (("", "image/png"), ("&format=webp", "image/webp"),
+                                     ("&format=jpeg&level=30", "image/jpeg"),
+                                     ("&format=png&overlay=1", "image/png")):
+            status, headers, body = self.request("GET", f"/heatmap?page_id=p{params}")
+            self.assertEqual((status, headers["Content-Type"]), (200, content_type), params)
+            self.assertEqual(decode(body).get_format_mimetype(), content_type)
+        for params in ("&format=gif", "&format=jpeg&overlay=1", "&level=10"):
+            self.assertEqual(self.request("GET", f"/heatmap?page_id=p{params}")[0], 400, params)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import io
+import unittest
+
+import numpy as np
+from PIL import Image
+
+import heatmap_service
+import parallel_kde
+from heatmap_service import HeatmapService
+from kde_engine import KDE_METHODS
+from parallel_kde import PARALLEL_MIN_POINTS, can_run_parallel, kde_parallel
+from testing import HEIGHT, WIDTH, ServiceTestCase, random_points
+
+
+def tearDownModule():
+    # Пул процессов spawn общий на процесс; после тестов он не нужен
+    if parallel_kde._executor is not None:
+        parallel_kde._executor.shutdown()
+        parallel_kde._executor = None
+
+
+class KdeParallelTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.xs, cls.ys = random_points(2000).T
+
+    def check(self, method, rtol, peak_share):
+        expected = KDE_METHODS[method](self.xs, self.ys, WIDTH, HEIGHT, 10.0, 5.0)
+        density = kde_parallel(self.xs, self.ys, WIDTH, HEIGHT, 10.0, 5.0, method, workers=2)
+        self.assertEqual(density.shape, expected.shape)
+        np.testing.assert_allclose(density, expected, rtol=rtol, atol=peak_share * expected.max())
+
+    def test_accumulate_matches_single_process(self):
+        # accumulate сам обрезает ядро на 3 bandwidth: полосы с запасом дают тот же результат
+        self.check("accumulate", 1e-12, 1e-15)
+
+    def test_brute_and_fft_within_truncation(self):
+        self.check("brute", 0, 4e-6)
+        self.check("fft", 0, 4e-6)
+
+    def test_empty_input(self):
+        density = kde_parallel(np.empty(0), np.empty(0), WIDTH, HEIGHT, 10.0, 5.0, workers=2)
+        self.assertEqual(density.shape, (30, 40))
+        self.assertFalse(density.any())
+
+    def test_parallel_only_for_large_point_dependent_methods(self):
+        self.assertTrue(can_run_parallel("accumulate", PARALLEL_MIN_POINTS, 2))
+        self.assertFalse(can_run_parallel("accumulate", PARALLEL_MIN_POINTS, 1))
+        self.assertFalse(can_run_parallel("brute", PARALLEL_MIN_POINTS - 1, 2))
+        self.assertFalse(can_run_parallel("fft", PARALLEL_MIN_POINTS, 2))
+
+
+class ServiceKdeWorkersTest(ServiceTestCase):
+    def test_parallel_render_matches_single_process(self):
+        self.addCleanup(setattr, parallel_kde, "PARALLEL_MIN_POINTS", PARALLEL_MIN_POINTS)
+        parallel_kde.PARALLEL_MIN_POINTS = 0
+        calls = []
+
+        def counted(*args):
+            calls.append(args[-1])
+            return kde_parallel(*args)
+
+        self.addCleanup(setattr, heatmap_service, "kde_parallel", heatmap_service.kde_parallel)
+        heatmap_service.kde_parallel = counted
+        self.add_background("p")
+        points = random_points(1000)
+        # Свои каталоги кэша: иначе второй сервис отдал бы карту первого
+        parallel = HeatmapService(cache_dir="parallel_images", grid_dir="parallel_grids",
+                                  background_dir="parallel_backgrounds", kde_workers=2)
+        for service in (self.service, parallel):
+            service.store_raw_data("p", points)
+        self.assertEqual(parallel.prepare_render("p", 10.0, 5.0, "accumulate")["kde_workers"], 2)
+        single, split = (
+            np.asarray(Image.open(io.BytesIO(service.generate_heatmap("p", 10.0, 5.0, "accumulate"))),
+                       dtype=int)
+            for service in (self.service, parallel))
+        self.assertLessEqual(np.abs(split - single).max(), 1)
+        self.assertEqual(calls, [2])
+
+
+if __name__ == "__main__":
+    unittest.main()
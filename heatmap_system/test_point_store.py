@@ -0,0 +1,66 @@
+import unittest
+
+import numpy as np
+
+from point_store import MIN_CAPACITY, PointStore
+
+
+class PointStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.store = PointStore()
+
+    def test_formats_are_stored_as_columns(self):
+        self.store.append("p", [[1, 2], [3, 4, 5]])
+        self.store.append("p", [{"x": 6, "y": 7, "t": 8, "user": "u1", "gender": "f",
+                                 "age": 30, "device": "mobile"}])
+        self.store.append("p", np.array([[9.0, 10.0]]), {"session": "u2"})
+        columns = self.store.page("p").view()
+        np.testing.assert_array_equal(columns["x"], [1, 3, 6, 9])
+        np.testing.assert_array_equal(columns["y"], [2, 4, 7, 10])
+        np.testing.assert_array_equal(columns["t"][1:3], [5, 8])
+        self.assertTrue(np.isnan(columns["t"][0]))
+        codes = self.store.categories["session"]
+        np.testing.assert_array_equal(columns["session"], [0, 0, codes["u1"], codes["u2"]])
+        self.assertEqual(columns["age"][2], 30)
+        self.assertEqual(self.store.count("p"), 4)
+
+    def test_capacity_grows_in_chunks(self):
+        for _ in range(3):
+            self.store.append("p", np.zeros((MIN_CAPACITY // 2, 2)))
+        page = self.store.page("p")
+        self.assertEqual(len(page), MIN_CAPACITY * 3 // 2)
+        self.assertGreaterEqual(page.capacity, len(page))
+        self.assertLess(page.capacity, 2 * len(page))
+
+    def test_invalid_batches_are_rejected(self):
+        for points in ([[1]], [[1, 2, 3, 4]], np.zeros((2, 4)), [[np.nan, 1]], [[1e39, 1]],
+                       [{"x": 1, "y": 2, "age": 300}]):
+            with self.assertRaises(ValueError, msg=points):
+                self.store.append("p", points)
+        self.assertNotIn("p", self.store)
+
+    def test_rejected_batch_leaves_no_category_codes(self):
+        self.store.append("p", [{"x": 1, "y": 2, "session": "kept"}])
+        self.store._categories_dirty = False
+        with self.assertRaises(ValueError):
+            self.store.append("p", [{"x": 1, "y": 2, "session": "a", "gender": "f"},
+                                    {"x": float("inf"), "y": 2, "device": "tv"}])
+        self.assertEqual(self.store.categories["session"], {"kept": 1})
+        self.assertEqual(self.store.categories["gender"], {})
+        self.assertEqual(self.store.categories["device"], {})
+        self.assertFalse(self.store._categories_dirty)
+        # Следующий новый код - сразу за последним принятым
+        self.store.append("p", [{"x": 1, "y": 2, "session": "next"}])
+        self.assertEqual(self.store.categories["session"]["next"], 2)
+
+    def test_stats(self):
+        self.store.append("a", np.zeros((10, 2)))
+        self.store.append("b", np.zeros((30, 2)))
+        stats = self.store.stats()
+        self.assertEqual(stats["pages"]["a"]["points"], 10)
+        self.assertEqual(stats["total"]["points"], 40)
+        self.assertEqual(stats["total"]["bytes_per_point"], stats["pages"]["a"]["bytes_per_point"])
+
+
+if __name__ == "__main__":
+    unittest.main()
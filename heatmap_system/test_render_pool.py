@@ -0,0 +1,76 @@
+import threading
+import time
+import unittest
+
+from render_pool import RenderPool, RenderPoolBusy
+from testing import ServerTestCase, random_points
+
+
+class RenderPoolTest(unittest.TestCase):
+    def test_submissions_beyond_workers_and_queue_are_refused(self):
+        pool = RenderPool(1, 1)
+        try:
+            futures = [pool.submit(time.sleep, 0.5), pool.submit(time.sleep, 0)]
+            with self.assertRaises(RenderPoolBusy):
+                pool.submit(time.sleep, 0)
+            for future in futures:
+                future.result()
+            self.assertEqual(pool.in_flight, 0)
+            # Места освободились - задание снова принимается
+            self.assertEqual(pool.submit(abs, -1).result(), 1)
+        finally:
+            pool.shutdown()
+
+
+class SaturatedServerTest(ServerTestCase):
+    render_workers = 1
+    max_pending = 0
+
+    def test_busy_pool_answers_503_but_serves_cached_maps(self):
+        self.add_background("p")
+        self.upload("p", random_points(100))
+        status, _, cached = self.request("GET", "/heatmap?page_id=p&bandwidth=10&grid=15")
+        self.assertEqual(status, 200)
+
+        # Единственное место в пуле занято долгой задачей
+        blocker = self.handler.render_pool.submit(time.sleep, 2)
+        try:
+            status, headers, _ = self.request("GET", "/heatmap?page_id=p&bandwidth=12&grid=15")
+            self.assertEqual(status, 503)
+            self.assertEqual(headers["Retry-After"], "2")
+            start = time.perf_counter()
+            status, _, body = self.request("GET", "/heatmap?page_id=p&bandwidth=10&grid=15")
+            self.assertEqual((status, body), (200, cached))
+            self.assertLess(time.perf_counter() - start, 1.0)
+            self.upload("p", random_points(10, seed=1))
+        finally:
+            blocker.result()
+        status, _, _ = self.request("GET", "/heatmap?page_id=p&bandwidth=12&grid=15")
+        self.assertEqual(status, 200)
+
+
+class ConcurrentStatsTest(ServerTestCase):
+    def test_stats_during_uploads_creating_pages(self):
+        errors = []
+
+        def upload():
+            try:
+                for number in range(200):
+                    self.service.store_raw_data(f"page{number}", [[1, 2]])
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=upload)
+        thread.start()
+        while thread.is_alive():
+            stats = self.service.stats()
+            self.assertIn("total", stats)
+        thread.join()
+        self.assertEqual(errors, [])
+        status, _, body = self.request("GET", "/metrics")
+        self.assertEqual(status, 200)
+        self.assertIn(b"page199", body)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+import numpy as np
+
+from bench_render import render_rectangles
+from renderer import grid_to_rgba, overlay_palette, render_overlay
+
+COLOR = (255, 0, 0)
+
+
+class RenderOverlayTest(unittest.TestCase):
+    def setUp(self):
+        self.normalized = np.random.default_rng(0).integers(0, 256, (6, 8), dtype=np.uint8)
+
+    def test_nearest_matches_rectangle_loop(self):
+        size = (8 * 5 + 3, 6 * 5 + 2)
+        expected = np.asarray(render_rectangles(self.normalized, 5, size, COLOR))
+        actual = np.asarray(render_overlay(self.normalized, 5, size, COLOR))
+        self.assertEqual(actual.shape, expected.shape)
+        # Прямоугольники включают правую и нижнюю границу - сравниваем внутри сетки
+        np.testing.assert_array_equal(actual[:30, :40], expected[:30, :40])
+        # Остаток за последней целой ячейкой прозрачен
+        self.assertEqual(actual[30:, :, 3].max(), 0)
+        self.assertEqual(actual[:, 40:, 3].max(), 0)
+
+    def test_opacity_scales_alpha(self):
+        image = np.asarray(grid_to_rgba(self.normalized, COLOR, 0.5))
+        np.testing.assert_array_equal(image[..., 3], (self.normalized * 0.5).astype(np.uint8))
+        self.assertTrue((image[..., :3] == COLOR).all())
+
+    def test_bilinear_fills_the_grid_area(self):
+        image = render_overlay(self.normalized, 4, (32, 24), COLOR, interpolation="bilinear")
+        self.assertEqual(image.size, (32, 24))
+        self.assertGreater(np.asarray(image)[..., 3].max(), 0)
+
+    def test_empty_grid_gives_transparent_layer(self):
+        image = render_overlay(np.zeros((0, 0), dtype=np.uint8), 10, (5, 5), COLOR)
+        self.assertEqual(np.asarray(image)[..., 3].max(), 0)
+
+    def test_palette_overlay_keeps_alpha(self):
+        overlay = render_overlay(self.normalized, 2, (16, 12), COLOR)
+        indexed = overlay_palette(overlay, COLOR)
+        np.testing.assert_array_equal(np.asarray(indexed.convert("RGBA")), np.asarray(overlay))
+
+
+if __name__ == "__main__":
+    unittest.main()
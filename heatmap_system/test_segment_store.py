@@ -0,0 +1,143 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+
+from point_store import PointStore
+from segment_store import (COUNT_OFFSET, GENERATION_OFFSET, GENERATION_SIZE, HEADER_SIZE,
+                           RECORD_DTYPE, PageSegment, SegmentError)
+from testing import ServiceTestCase, random_points
+
+
+def batch(xs, ys):
+    return {"x": np.asarray(xs, dtype=np.float32), "y": np.asarray(ys, dtype=np.float32),
+            "t": np.zeros(len(xs))}
+
+
+class PageSegmentTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "p.seg")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_reopen_keeps_records_and_generation(self):
+        segment = PageSegment.create(self.path)
+        segment.append(batch([1, 2], [3, 4]))
+        segment.append(batch([5], [6]))
+        reopened = PageSegment.open(self.path)
+        self.assertEqual(len(reopened), 3)
+        np.testing.assert_array_equal(reopened.xy()[0], [1, 2, 5])
+        self.assertEqual(reopened.generation, segment.generation)
+        self.assertEqual(len(bytes.fromhex(reopened.generation)), GENERATION_SIZE)
+
+    def test_new_segments_get_new_generations(self):
+        first = PageSegment.create(self.path)
+        second = PageSegment.create(os.path.join(self.tmp, "q.seg"))
+        self.assertNotEqual(first.generation, second.generation)
+
+    def test_records_past_header_count_are_ignored(self):
+        segment = PageSegment.create(self.path)
+        segment.append(batch([1, 2], [3, 4]))
+        # Сбой после записи данных, но до обновления счётчика, плюс оборванная запись
+        with open(self.path, "ab") as f:
+            f.write(np.zeros(1, dtype=RECORD_DTYPE).tobytes() + b"\x01\x02")
+        reopened = PageSegment.open(self.path)
+        self.assertEqual(len(reopened), 2)
+        reopened.append(batch([7], [8]))
+        np.testing.assert_array_equal(PageSegment.open(self.path).xy()[0], [1, 2, 7])
+
+    def test_count_beyond_file_is_clamped(self):
+        segment = PageSegment.create(self.path)
+        segment.append(batch([1, 2], [3, 4]))
+        with open(self.path, "r+b") as f:
+            f.seek(COUNT_OFFSET)
+            f.write(struct.pack("<Q", 10))
+        self.assertEqual(len(PageSegment.open(self.path)), 2)
+
+    def test_legacy_segment_gets_generation(self):
+        PageSegment.create(self.path).append(batch([1], [2]))
+        with open(self.path, "r+b") as f:
+            f.seek(GENERATION_OFFSET)
+            f.write(bytes(GENERATION_SIZE))
+        migrated = PageSegment.open(self.path)
+        self.assertNotEqual(migrated.generation, bytes(GENERATION_SIZE).hex())
+        self.assertEqual(PageSegment.open(self.path).generation, migrated.generation)
+
+    def test_broken_headers_are_rejected(self):
+        with open(self.path, "wb") as f:
+            f.write(b"short")
+        with self.assertRaises(SegmentError):
+            PageSegment.open(self.path)
+        with open(self.path, "wb") as f:
+            f.write(b"\x00" * HEADER_SIZE)
+        with self.assertRaises(SegmentError):
+            PageSegment.open(self.path)
+
+    def test_prefix_snapshot(self):
+        segment = PageSegment.create(self.path)
+        segment.append(batch([1, 2, 3], [4, 5, 6]))
+        _, path, count = segment.source()
+        segment.append(batch([9], [9]))
+        np.testing.assert_array_equal(PageSegment.map_prefix(path, count).xy()[1], [4, 5, 6])
+
+
+class PersistentPointStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_restart_restores_pages_categories_and_version(self):
+        store = PointStore(self.tmp)
+        store.append("page/1", [{"x": 1, "y": 2, "session": "s1", "device": "tv"}])
+        generation = store.generation("page/1")
+        restarted = PointStore(self.tmp)
+        self.assertEqual(restarted.count("page/1"), 1)
+        self.assertEqual(restarted.generation("page/1"), generation)
+        self.assertEqual(restarted.categories["device"], {"tv": 1})
+        self.assertEqual(restarted.page("page/1").view()["device"][0], 1)
+
+    def test_recreated_page_changes_generation(self):
+        store = PointStore(self.tmp)
+        store.append("p", [[1, 2]])
+        generation = store.generation("p")
+        for filename in os.listdir(self.tmp):
+            os.remove(os.path.join(self.tmp, filename))
+        store = PointStore(self.tmp)
+        store.append("p", [[1, 2]])
+        self.assertNotEqual(store.generation("p"), generation)
+
+
+class DataVersionTest(ServiceTestCase):
+    def test_version_survives_restart_and_separates_datasets(self):
+        service = self.make_service(data_dir="data")
+        self.assertEqual(service.data_version("p"), 0)
+        service.store_raw_data("p", random_points(50, seed=1))
+        version = service.data_version("p")
+        self.assertTrue(version.startswith("50-"))
+        self.assertEqual(self.make_service(data_dir="data").data_version("p"), version)
+
+        # Другой набор того же размера (пересозданные данные) - другой ключ кэша
+        other = self.make_service(data_dir="other")
+        other.store_raw_data("p", random_points(50, seed=2))
+        self.assertNotEqual(other.cache_key("p", 10.0, 15.0), service.cache_key("p", 10.0, 15.0))
+
+    def test_upload_drops_cached_maps_of_old_version(self):
+        self.add_background("p")
+        self.service.store_raw_data("p", random_points(50))
+        old_key = self.service.cache_key("p", 10.0, 15.0)
+        self.assertIsNotNone(self.service.generate_heatmap("p", 10.0, 15.0))
+        self.assertIn(old_key, self.service.cache.keys())
+        self.service.store_raw_data("p", random_points(5, seed=3))
+        self.assertNotIn(old_key, self.service.cache.keys())
+        self.assertFalse(any(key[0] == "p" for key in self.service.grids.keys()))
+
+
+if __name__ == "__main__":
+    unittest.main()
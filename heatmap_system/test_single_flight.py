@@ -0,0 +1,99 @@
+import threading
+import unittest
+
+from heatmap_service import render_heatmap
+from single_flight import SingleFlight
+from testing import ServiceTestCase, random_points, wait_until
+
+CALLERS = 4
+
+
+def run_concurrently(func, count=CALLERS):
+    results = [None] * count
+
+    def call(index):
+        try:
+            results[index] = func()
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=call, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def slow(self, result):
+        def func():
+            self.calls += 1
+            # Лидер ждёт, пока остальные не станут в очередь за его результатом
+            self.release.wait(5)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        return func
+
+    def wait_for_waiters(self):
+        wait_until(lambda: self.flights.stats()["waiting"] == CALLERS - 1)
+        self.release.set()
+
+    def test_concurrent_calls_share_one_computation(self):
+        threading.Thread(target=self.wait_for_waiters).start()
+        results = run_concurrently(lambda: self.flights.do("key", self.slow("value")))
+        self.assertEqual(results, ["value"] * CALLERS)
+        self.assertEqual(self.calls, 1)
+        stats = self.flights.stats()
+        self.assertEqual((stats["computations"], stats["coalesced"]), (1, CALLERS - 1))
+        self.assertEqual(stats["in_flight"], 0)
+
+    def test_error_reaches_every_waiter(self):
+        error = RuntimeError("render failed")
+        threading.Thread(target=self.wait_for_waiters).start()
+        results = run_concurrently(lambda: self.flights.do("key", self.slow(error)))
+        self.assertEqual(results, [error] * CALLERS)
+        # После ошибки ключ свободен: следующий вызов считает заново
+        self.assertEqual(self.flights.do("key", lambda: 1), 1)
+
+    def test_different_keys_do_not_wait_for_each_other(self):
+        self.assertEqual(self.flights.do("a", lambda: 1), 1)
+        self.assertEqual(self.flights.do("b", lambda: 2), 2)
+        self.assertEqual(self.flights.stats()["computations"], 2)
+
+
+class CoalescedRenderTest(ServiceTestCase):
+    def test_identical_requests_render_once(self):
+        self.add_background("p")
+        self.service.store_raw_data("p", random_points(200))
+        renders = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def runner(spec):
+            renders.append(spec["cache_key"])
+            started.set()
+            release.wait(5)
+            return render_heatmap(spec)
+
+        def waiters():
+            started.wait(5)
+            wait_until(lambda: self.service.flights.stats()["waiting"] == CALLERS - 1)
+            release.set()
+
+        threading.Thread(target=waiters).start()
+        results = run_concurrently(
+            lambda: self.service.generate_heatmap("p", 10.0, 15.0, runner=runner))
+        self.assertEqual(len(renders), 1)
+        self.assertTrue(all(isinstance(data, bytes) for data in results))
+        self.assertEqual(len(set(results)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import io
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from slice_index import (MAX_SLICE_PARTS, PageIndex, SortedIndex, filter_key, parse_filter,
+                         split_filter)
+from testing import ServiceTestCase, random_points
+
+CATEGORIES = {"session": {"s1": 1, "s2": 2}, "gender": {"f": 1, "m": 2},
+              "device": {"tv": 1, "mobile": 2}}
+
+
+class FilterTest(unittest.TestCase):
+    def test_parse_is_canonical(self):
+        self.assertEqual(parse_filter("device:tv, mobile ;user:s1;age:18-34;t:60"),
+                         (("age", (18.0, 34.0)), ("device", ("mobile", "tv")),
+                          ("session", ("s1",)), ("t", (60.0, 60.0))))
+        self.assertEqual(parse_filter("age:50-"), (("age", (50.0, np.inf)),))
+        self.assertEqual(parse_filter(""), ())
+        self.assertEqual(filter_key(parse_filter("t:-5.0;gender:m")), "gender:m;t:-5")
+
+    def test_invalid_filters(self):
+        for text in ("color:red", "gender", "gender:f;gender:m", "device: ,", "age:40-20",
+                     "age:a-b"):
+            with self.assertRaises(ValueError, msg=text):
+                parse_filter(text)
+
+    def test_split_into_disjoint_parts(self):
+        parts = split_filter(parse_filter("gender:f,m;device:tv,mobile;age:18-"))
+        self.assertEqual(len(parts), 4)
+        self.assertIn((("age", (18.0, np.inf)), ("device", ("tv",)), ("gender", ("m",))), parts)
+        single = parse_filter("gender:f;age:1-2")
+        self.assertEqual(split_filter(single), [single])
+        values = ",".join(str(number) for number in range(MAX_SLICE_PARTS + 1))
+        wide = parse_filter(f"session:{values}")
+        self.assertEqual(split_filter(wide), [wide])
+
+
+class SortedIndexTest(unittest.TestCase):
+    def test_runs_answer_like_one_sorted_array(self):
+        rng = np.random.default_rng(0)
+        index = SortedIndex()
+        batches = [rng.integers(0, 50, size).astype(float) for size in (1000, 10, 10, 300, 1, 50)]
+        batches[1][:3] = np.nan
+        start = 0
+        for batch in batches:
+            index.extend(batch, start)
+            start += len(batch)
+        values = np.concatenate(batches)
+        # Отрезки сливаются по мере роста, а не копируются на каждую партию
+        self.assertLess(len(index.runs), len(batches))
+        for low, high in ((10, 20), (-np.inf, np.inf), (7, 7), (60, 70)):
+            expected = np.flatnonzero((values >= low) & (values <= high))
+            np.testing.assert_array_equal(index.range(low, high), expected)
+
+        merged_values, rows = index.merged()
+        self.assertEqual(len(index.runs), 1)
+        np.testing.assert_array_equal(merged_values, values[rows])
+        finite = np.isfinite(merged_values)
+        self.assertFalse(finite[finite.sum():].any())
+        self.assertTrue((np.diff(merged_values[finite]) >= 0).all())
+        # При равных значениях строки идут по возрастанию
+        same = merged_values[1:] == merged_values[:-1]
+        self.assertTrue((np.diff(rows)[same] > 0).all())
+
+    def test_empty_index(self):
+        self.assertEqual(len(SortedIndex().range(0, 1)), 0)
+        self.assertEqual([len(part) for part in SortedIndex().merged()], [0, 0])
+
+
+class PageIndexTest(unittest.TestCase):
+    def test_select_matches_column_masks(self):
+        rng = np.random.default_rng(1)
+        columns = {"x": np.zeros(500), "age": rng.integers(0, 80, 500),
+                   "t": rng.uniform(0, 100, 500)}
+        for name in CATEGORIES:
+            columns[name] = rng.integers(0, 3, 500)
+        index = PageIndex()
+        index.extend({name: values[:200] for name, values in columns.items()})
+        index.extend({name: values[200:] for name, values in columns.items()})
+
+        slice_filter = parse_filter("gender:f,m;device:tv;age:18-50;t:-60;session:s2,unknown")
+        mask = (np.isin(columns["gender"], [1, 2]) & (columns["device"] == 1)
+                & (columns["age"] >= 18) & (columns["age"] <= 50) & (columns["t"] <= 60)
+                & (columns["session"] == 2))
+        np.testing.assert_array_equal(index.select(slice_filter, CATEGORIES), np.flatnonzero(mask))
+        # Возраст 0 - "не указан": не попадает даже в открытый диапазон
+        np.testing.assert_array_equal(index.select(parse_filter("age:-"), CATEGORIES),
+                                      np.flatnonzero(columns["age"] > 0))
+        np.testing.assert_array_equal(index.select((), CATEGORIES), np.arange(500))
+
+
+class SlicedRenderTest(ServiceTestCase):
+    def test_slice_renders_like_page_of_its_points(self):
+        points = random_points(300)
+        devices = np.where(np.arange(300) % 3 == 0, "tv", np.where(np.arange(300) % 3 == 1,
+                                                                   "mobile", "desktop"))
+        for page_id in ("sliced", "subset"):
+            self.add_background(page_id)
+        self.service.store_raw_data("sliced", [{"x": x, "y": y, "device": device}
+                                               for (x, y), device in zip(points, devices)])
+        # Срез из двух значений собирается из частей (сумма плотностей)
+        self.service.store_raw_data("subset", points[devices != "desktop"])
+        sliced = self.service.generate_heatmap("sliced", 10.0, 15.0, "brute",
+                                               slice_filter=parse_filter("device:tv,mobile"))
+        expected = self.service.generate_heatmap("subset", 10.0, 15.0, "brute")
+        difference = np.abs(np.asarray(Image.open(io.BytesIO(sliced)), dtype=int)
+                            - np.asarray(Image.open(io.BytesIO(expected)), dtype=int))
+        self.assertLessEqual(difference.max(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
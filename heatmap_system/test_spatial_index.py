@@ -0,0 +1,122 @@
+import json
+import math
+import unittest
+
+import numpy as np
+
+from slice_index import parse_filter
+from spatial_index import GridIndex, dwell_times, region_mass
+from testing import HEIGHT, WIDTH, ServerTestCase, ServiceTestCase, random_points
+
+RECTS = [(0, 0, 64, 64), (30.5, 20, 150, 90), (-100, -100, 1000, 1000), (60, 60, 60, 70)]
+
+
+def direct_mass(xs, ys, rect, bandwidth):
+    x0, y0, x1, y1 = rect
+
+    def share(low, high, values):
+        cdf = np.vectorize(lambda value: 0.5 * (1 + math.erf(value / math.sqrt(2))))
+        return cdf((high - values) / bandwidth) - cdf((low - values) / bandwidth)
+
+    return float(np.sum(share(x0, x1, xs) * share(y0, y1, ys)))
+
+
+class GridIndexTest(unittest.TestCase):
+    def setUp(self):
+        points = random_points(1000)
+        # Точки за краем попадают в крайние корзины
+        points[:10] = [[-5, -5]] * 5 + [[WIDTH + 300, HEIGHT + 300]] * 5
+        self.xs, self.ys = points.T.astype(np.float32)
+        self.index = GridIndex()
+        self.index.extend(self.xs[:400], self.ys[:400])
+        self.index.extend(self.xs[400:], self.ys[400:])
+
+    def test_query_matches_mask(self):
+        for x0, y0, x1, y1 in RECTS:
+            inside = (self.xs >= x0) & (self.xs < x1) & (self.ys >= y0) & (self.ys < y1)
+            np.testing.assert_array_equal(self.index.query(self.xs, self.ys, x0, y0, x1, y1),
+                                          np.flatnonzero(inside))
+
+    def test_region_mass_matches_direct_sum(self):
+        for rect in RECTS:
+            for bandwidth in (2.0, 15.0):
+                expected = direct_mass(self.xs, self.ys, rect, bandwidth)
+                self.assertAlmostEqual(region_mass(self.index, self.xs, self.ys, rect, bandwidth),
+                                       expected, delta=1e-4)
+        mask = np.arange(1000) % 2 == 0
+        self.assertAlmostEqual(region_mass(self.index, self.xs, self.ys, RECTS[1], 15.0, mask),
+                               direct_mass(self.xs[mask], self.ys[mask], RECTS[1], 15.0),
+                               delta=1e-4)
+
+
+class DwellTimesTest(unittest.TestCase):
+    def test_gaps_within_session(self):
+        times = np.array([0.0, 1.0, 5.0, 0.5, 1.5, 2.0, np.nan])
+        sessions = np.array([1, 1, 1, 2, 0, 0, 2])
+        # Сеанс 1: 0 -> 1 (1 с), 1 -> 5 (разрыв больше 2 с); сеанс 2: 0.5 -> NaN
+        np.testing.assert_array_equal(dwell_times(times, sessions), [1, 0, 0, 0, 0, 0, 0])
+
+
+class AoiStatsTest(ServiceTestCase):
+    def setUp(self):
+        super().setUp()
+        points = random_points(200)
+        self.xs, self.ys = points.T.astype(np.float32)
+        self.service.store_raw_data("p", [
+            {"x": x, "y": y, "t": number * 0.5, "session": f"s{number % 2}",
+             "device": "tv" if number < 50 else "mobile"}
+            for number, (x, y) in enumerate(points.tolist())])
+
+    def test_counts_shares_and_mass(self):
+        rect = (20, 30, 120, 100)
+        result = self.service.aoi_stats("p", [("a", *rect)], bandwidth=10.0)
+        self.assertEqual((result["points"], result["bandwidth"]), (200, 10.0))
+        inside = (self.xs >= 20) & (self.xs < 120) & (self.ys >= 30) & (self.ys < 100)
+        entry = result["regions"][0]
+        self.assertEqual(entry["count"], int(inside.sum()))
+        self.assertAlmostEqual(entry["share"], inside.sum() / 200)
+        self.assertEqual(entry["sessions"], 2)
+        # Соседние точки сеанса идут через 1 с
+        self.assertEqual(entry["dwell"], float(inside[:-2].sum()))
+        self.assertAlmostEqual(entry["density"], direct_mass(self.xs, self.ys, rect, 10.0),
+                               delta=1e-4)
+
+    def test_slice(self):
+        result = self.service.aoi_stats("p", [("all", 0, 0, WIDTH, HEIGHT)],
+                                        slice_filter=parse_filter("device:tv"))
+        self.assertEqual(result["points"], 50)
+        self.assertEqual(result["regions"][0]["count"], 50)
+        self.assertEqual(result["regions"][0]["share"], 1.0)
+        self.assertNotIn("density", result["regions"][0])
+        self.assertIsNone(self.service.aoi_stats("missing", [("all", 0, 0, 1, 1)]))
+
+
+class AoiEndpointTest(ServerTestCase):
+    def test_aoi(self):
+        points = random_points(100)
+        self.upload("p", points)
+        status, _, body = self.request("POST", "/heatmap/aoi", {
+            "page_id": "p", "bandwidth": 10,
+            "regions": [{"name": "left", "x": 0, "y": 0, "width": WIDTH / 2, "height": HEIGHT},
+                        {"name": "page", "x": -1000, "y": -1000, "width": 3000, "height": 3000}]})
+        self.assertEqual(status, 200, body)
+        result = json.loads(body)
+        self.assertEqual(result["points"], 100)
+        left, page = result["regions"]
+        self.assertEqual(left["count"], int(np.sum(points[:, 0].astype(np.float32) < WIDTH / 2)))
+        self.assertAlmostEqual(left["share"], left["count"] / 100)
+        self.assertEqual((page["count"], page["share"]), (100, 1.0))
+        # Масса плотности по всей плоскости - число точек
+        self.assertAlmostEqual(page["density"], 100.0, places=3)
+
+        for data in ({"page_id": "p", "regions": []},
+                     {"page_id": "p", "regions": [{"x": 0, "y": 0, "width": 0, "height": 1}]},
+                     {"page_id": "p", "bandwidth": -1,
+                      "regions": [{"x": 0, "y": 0, "width": 1, "height": 1}]}):
+            self.assertEqual(self.request("POST", "/heatmap/aoi", data)[0], 400, data)
+        self.assertEqual(self.request("POST", "/heatmap/aoi", {
+            "page_id": "missing", "regions": [{"x": 0, "y": 0, "width": 1, "height": 1}]})[0], 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import io
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from heatmap_service import DEFAULT_STYLE
+from testing import ServerTestCase, ServiceTestCase, random_points
+from tile_pyramid import TILE_SIZE, max_zoom, pyramid_level, reduce_grid, tile_count, tile_scale
+
+PAGE = (600, 400)
+
+
+def decode(data):
+    return np.asarray(Image.open(io.BytesIO(data)).convert("RGBA"), dtype=int)
+
+
+class PyramidTest(unittest.TestCase):
+    def test_levels(self):
+        self.assertEqual(max_zoom(200, 150), 0)
+        self.assertEqual(max_zoom(*PAGE), 2)
+        self.assertEqual(tile_scale(0, 2), 0.25)
+        self.assertEqual(tile_count(*PAGE, 1.0), (3, 2))
+        self.assertEqual(tile_count(*PAGE, 0.25), (1, 1))
+        self.assertEqual(pyramid_level(15.0, 1.0), 0)
+        self.assertEqual(pyramid_level(15.0, 1 / 16), 1)
+        self.assertEqual(pyramid_level(2.0, 1 / 8), 2)
+
+    def test_reduce_averages_available_cells(self):
+        grid = np.arange(15, dtype=np.float32).reshape(3, 5)
+        reduced = reduce_grid(grid)
+        self.assertEqual(reduced.shape, (2, 3))
+        self.assertEqual(reduced[0, 0], grid[:2, :2].mean())
+        self.assertEqual(reduced[0, 2], grid[:2, 4].mean())
+        self.assertEqual(reduced[1, 2], grid[2, 4])
+
+
+class TileServiceTest(ServiceTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_background("p", PAGE)
+        self.service.store_raw_data("p", random_points(300, width=PAGE[0], height=PAGE[1]))
+
+    def tile(self, zoom, tile_x, tile_y, grid=15.0):
+        return self.service.generate_tile("p", zoom, tile_x, tile_y, 20.0, grid)
+
+    def test_top_zoom_tile_matches_full_map(self):
+        full = decode(self.service.generate_heatmap("p", 20.0, 15.0))
+        for tile_x, tile_y in ((0, 0), (2, 1)):
+            tile = decode(self.tile(2, tile_x, tile_y))
+            self.assertEqual(tile.shape, (TILE_SIZE, TILE_SIZE, 4))
+            x0, y0 = tile_x * TILE_SIZE, tile_y * TILE_SIZE
+            crop = full[y0:y0 + TILE_SIZE, x0:x0 + TILE_SIZE]
+            height, width = crop.shape[:2]
+            self.assertLessEqual(np.abs(tile[:height, :width] - crop).max(), 1)
+            # За краем страницы тайл прозрачный
+            self.assertFalse(tile[height:, :, 3].any())
+            self.assertFalse(tile[:, width:, 3].any())
+
+    def test_low_zoom_builds_and_caches_pyramid_levels(self):
+        tile = decode(self.tile(0, 0, 0, grid=2.0))
+        # Страница 600x400 в масштабе 1/4
+        self.assertTrue(tile[:100, :150, 3].all())
+        self.assertFalse(tile[100:, :, 3].any())
+        spec = self.service.prepare_tile("p", 0, 0, 0, 20.0, 2.0)
+        self.assertEqual(spec["level"], 1)
+        self.assertTrue(all(level["cached"] for level in spec["levels"]))
+        self.assertTrue(spec["level_normalized_cached"])
+        self.assertIn(spec["cache_key"], self.service.cache.keys())
+
+    def test_invalid_tiles(self):
+        for zoom, tile_x, tile_y in ((3, 0, 0), (2, 3, 0), (2, 0, 2), (0, 1, 0)):
+            with self.assertRaises(ValueError, msg=(zoom, tile_x, tile_y)):
+                self.tile(zoom, tile_x, tile_y)
+        self.assertIsNone(self.service.generate_tile("missing", 0, 0, 0, 20.0, 15.0))
+        self.assertIsNone(self.service.prepare_tile("missing", 0, 0, 0, 20.0, 15.0,
+                                                    style=DEFAULT_STYLE))
+
+
+class TileEndpointTest(ServerTestCase):
+    def test_tiles(self):
+        self.add_background("p", PAGE)
+        self.upload("p", random_points(100, width=PAGE[0], height=PAGE[1]))
+        status, headers, body = self.request("GET", "/heatmap/tiles/p/1/1/0.png?bandwidth=20")
+        self.assertEqual((status, headers["Content-Type"]), (200, "image/png"))
+        self.assertEqual(body, self.service.generate_tile("p", 1, 1, 0, 20.0, 15.0))
+        self.assertEqual(self.request("GET", "/heatmap/tiles/p/5/0/0.png")[0], 404)
+        self.assertEqual(self.request("GET", "/heatmap/tiles/p/1/2/0.png")[0], 404)
+        self.assertEqual(self.request("GET", "/heatmap/tiles/missing/0/0/0.png")[0], 404)
+        self.assertEqual(self.request("GET", "/heatmap/tiles/p/0/0/0.png?bandwidth=-1")[0], 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
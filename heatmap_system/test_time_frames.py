@@ -0,0 +1,134 @@
+import io
+import json
+import unittest
+import zipfile
+
+import numpy as np
+from PIL import Image
+
+from heatmap_service import DEFAULT_STYLE
+from kde_engine import kde_brute
+from testing import HEIGHT, WIDTH, ServerTestCase, ServiceTestCase, random_points
+from time_frames import (MAX_ANIMATION_FRAMES, MAX_FRAME_CELLS, MAX_FRAMES, Animation,
+                         animation_windows, build_frames, frame_layout, window_density)
+
+PARAMS = (WIDTH, HEIGHT, 10.0, 15.0, "brute")
+
+
+def timed_points(count=300, seed=0, duration=100.0):
+    points = random_points(count, seed)
+    times = np.random.default_rng(seed + 1).uniform(5, 5 + duration, count)
+    return np.column_stack((points, times))
+
+
+def animation(interval=10.0, **options):
+    fields = dict(interval=interval, start=None, end=None, step=None, window=None, scale=1.0,
+                  fps=4.0, format="zip")
+    fields.update(options)
+    return Animation(**fields)
+
+
+class FramesTest(unittest.TestCase):
+    def setUp(self):
+        points = timed_points()
+        self.xs, self.ys, times = points.T
+        self.rows = np.argsort(times, kind="stable")
+        self.times = times[self.rows]
+
+    def direct(self, t0, t1):
+        mask = (self.times >= t0) & (self.times < t1)
+        selected = self.rows[mask]
+        return kde_brute(self.xs[selected], self.ys[selected], WIDTH, HEIGHT, 10.0, 15.0)
+
+    def test_frames_accumulate_whole_intervals(self):
+        frames = build_frames(self.xs, self.ys, self.times, self.rows, *PARAMS, 10.0)
+        origin, count = frame_layout(self.times, 10.0)
+        self.assertEqual((origin, frames.shape[0]), (0.0, count + 1))
+        self.assertFalse(frames[0].any())
+        for k in (1, 5, count):
+            expected = self.direct(-np.inf, origin + k * 10.0)
+            np.testing.assert_allclose(frames[k], expected, rtol=1e-5, atol=1e-6 * expected.max())
+
+    def test_window_density_matches_direct_kde(self):
+        frames = build_frames(self.xs, self.ys, self.times, self.rows, *PARAMS, 10.0)
+        # Окна по границам кадров, между ними, внутри одного кадра и за краями данных
+        for t0, t1 in ((10, 50), (12.5, 47.5), (21, 29), (-50, 200), (50, 50)):
+            expected = self.direct(t0, t1)
+            density = window_density(frames, self.times, self.rows, self.xs, self.ys, t0, t1,
+                                     10.0, *PARAMS)
+            np.testing.assert_allclose(density, expected, rtol=1e-5,
+                                       atol=1e-6 * max(expected.max(), 1e-300))
+
+    def test_limits(self):
+        with self.assertRaisesRegex(ValueError, "Too many frames"):
+            frame_layout(np.array([0.0, MAX_FRAMES * 1.0]), 1.0)
+        with self.assertRaisesRegex(ValueError, "Frames are too large"):
+            frame_layout(np.array([0.0, 1.0]), 10.0, MAX_FRAME_CELLS)
+        with self.assertRaisesRegex(ValueError, "Too many animation frames"):
+            animation_windows(0, MAX_ANIMATION_FRAMES + 1, 1)
+
+    def test_windows(self):
+        self.assertEqual(animation_windows(0, 25, 10), [(0, 10), (0, 20), (0, 25)])
+        self.assertEqual(animation_windows(0, 25, 10, window=15), [(0, 10), (5, 20), (10, 25)])
+
+
+class AnimationServiceTest(ServiceTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_background("p")
+        self.points = timed_points()
+        # Точки без времени в анимацию не входят
+        self.service.store_raw_data("p", np.concatenate((self.points, [[1, 1, np.nan]] * 5)))
+
+    def generate(self, **options):
+        return self.service.generate_animation("p", 10.0, 15.0, "brute", DEFAULT_STYLE, (),
+                                               animation(**options))
+
+    def test_zip_frames_and_manifest(self):
+        archive = zipfile.ZipFile(io.BytesIO(self.generate(step=25.0, window=50.0)))
+        manifest = json.loads(archive.read("manifest.json"))
+        windows = [(frame["t0"], frame["t1"]) for frame in manifest["frames"]]
+        start, end = self.points[:, 2].min(), np.nextafter(self.points[:, 2].max(), np.inf)
+        self.assertEqual(windows, animation_windows(start, end, 25.0, 50.0))
+        self.assertEqual(manifest["frame_ms"], 250)
+        frame = Image.open(io.BytesIO(archive.read(manifest["frames"][-1]["file"])))
+        self.assertEqual(frame.size, (WIDTH, HEIGHT))
+
+    def test_apng_and_frame_cache(self):
+        data = self.generate(format="apng", step=20.0, scale=0.5)
+        image = Image.open(io.BytesIO(data))
+        self.assertEqual((image.n_frames, image.size), (5, (WIDTH // 2, HEIGHT // 2)))
+        # Накопленные кадры переиспользуются другой анимацией с тем же интервалом
+        spec = self.service.prepare_animation("p", 10.0, 15.0, "brute", DEFAULT_STYLE, (),
+                                              animation(format="gif"))
+        self.assertTrue(spec["frames_cached"])
+
+    def test_invalid_animations(self):
+        with self.assertRaisesRegex(ValueError, "end must be after"):
+            self.generate(start=50.0, end=40.0)
+        with self.assertRaisesRegex(ValueError, "does not support"):
+            self.service.prepare_animation("p", 10.0, 15.0, "adaptive", DEFAULT_STYLE, (),
+                                           animation())
+        self.service.store_raw_data("untimed", random_points(10))
+        self.add_background("untimed")
+        self.assertIsNone(self.service.generate_animation("untimed", 10.0, 15.0,
+                                                          animation=animation()))
+
+
+class AnimationEndpointTest(ServerTestCase):
+    def test_animation(self):
+        self.add_background("p")
+        self.upload("p", timed_points(100))
+        status, headers, body = self.request(
+            "GET", "/heatmap/animation?page_id=p&interval=10&step=30&format=gif")
+        self.assertEqual((status, headers["Content-Type"]), (200, "image/gif"))
+        self.assertEqual(Image.open(io.BytesIO(body)).n_frames, 4)
+        for query in ("interval=0.01", "interval=10&format=mp4", "interval=10&fps=100",
+                      "interval=10&scale=2", "interval=10&step=0.1"):
+            status, _, body = self.request("GET", f"/heatmap/animation?page_id=p&{query}")
+            self.assertEqual(status, 400, (query, body))
+        self.assertEqual(self.request("GET", "/heatmap/animation?page_id=missing")[0], 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+import io
+import unittest
+
+import numpy as np
+
+import upload_stream
+from testing import ServerTestCase
+from upload_stream import BINARY_POINT_SIZE, iter_body, iter_chunked, iter_lines, stream_batches
+
+
+def pieces(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def collect(content_type, data, size=7):
+    return [point for batch in stream_batches(content_type, pieces(data, size)) for point in batch]
+
+
+def small_batches(test, size=2):
+    test.addCleanup(setattr, upload_stream, "BATCH_POINTS", upload_stream.BATCH_POINTS)
+    upload_stream.BATCH_POINTS = size
+
+
+class BodyTest(unittest.TestCase):
+    def test_content_length_body(self):
+        body = b"0123456789"
+        chunks = list(iter_body(io.BytesIO(body + b"next request"), {"Content-Length": "10"}))
+        self.assertEqual(b"".join(chunks), body)
+        with self.assertRaises(ValueError):
+            list(iter_body(io.BytesIO(b"short"), {"Content-Length": "10"}))
+
+    def test_chunked_body(self):
+        raw = b"4;ext=1\r\nabcd\r\n3\r\nefg\r\n0\r\nTrailer: x\r\n\r\n"
+        self.assertEqual(b"".join(iter_body(io.BytesIO(raw), {"Transfer-Encoding": "chunked"})),
+                         b"abcdefg")
+        for broken in (b"zz\r\nab\r\n", b"4\r\nab", b"2\r\nabXX\r\n0\r\n\r\n"):
+            with self.assertRaises(ValueError, msg=broken):
+                list(iter_chunked(io.BytesIO(broken)))
+
+    def test_lines_split_across_chunks(self):
+        lines = list(iter_lines([b"a\nb", b"c\n", b"\nd"]))
+        self.assertEqual(lines, [(1, b"a"), (2, b"bc"), (3, b""), (4, b"d")])
+
+
+class FormatsTest(unittest.TestCase):
+    def test_ndjson(self):
+        data = b'[1, 2]\n\n[3, 4, 5]\n{"x": 6, "y": 7, "device": "tv"}'
+        self.assertEqual(collect("application/x-ndjson", data),
+                         [[1, 2], [3, 4, 5], {"x": 6, "y": 7, "device": "tv"}])
+        with self.assertRaisesRegex(ValueError, "Line 2"):
+            collect("application/x-ndjson", b"[1, 2]\n[3,\n")
+
+    def test_csv_with_and_without_header(self):
+        self.assertEqual(collect("text/csv", b"1,2\r\n3,4\n"),
+                         [[1.0, 2.0], [3.0, 4.0]])
+        data = b"X,Y,t,device\n1,2,,tv\n3,4,5,\n"
+        self.assertEqual(collect("text/csv", data),
+                         [{"x": 1.0, "y": 2.0, "device": "tv"}, {"x": 3.0, "y": 4.0, "t": 5.0}])
+        with self.assertRaisesRegex(ValueError, "Line 3: expected 2 fields"):
+            collect("text/csv", b"x,y\n1,2\n1,2,3\n")
+        with self.assertRaisesRegex(ValueError, "x and y"):
+            collect("text/csv", b"a,b\n1,2\n")
+
+    def test_binary(self):
+        points = np.arange(10, dtype="<f4").reshape(-1, 2)
+        batches = list(stream_batches("application/octet-stream", pieces(points.tobytes(), 5)))
+        np.testing.assert_array_equal(np.concatenate(batches), points)
+        with self.assertRaisesRegex(ValueError, str(BINARY_POINT_SIZE)):
+            list(stream_batches("application/octet-stream", [points.tobytes()[:-1]]))
+
+    def test_large_uploads_are_split_into_batches(self):
+        small_batches(self)
+        batches = list(stream_batches("application/x-ndjson", [b"[1,2]\n" * 5]))
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+
+
+class StreamUploadEndpointTest(ServerTestCase):
+    def test_chunked_ndjson_upload(self):
+        # Тело-генератор http.client отправляет с Transfer-Encoding: chunked
+        body = (b"[%d, %d]\n" % (i, i) for i in range(100))
+        status, _, reply = self.request("POST", "/upload_data?page_id=p&device=tv", body,
+                                        {"Content-Type": "application/x-ndjson"})
+        self.assertEqual(status, 200, reply)
+        self.assertEqual(self.service.points.count("p"), 100)
+        device = self.service.points.categories["device"]["tv"]
+        self.assertTrue((self.service.points.page("p").view()["device"] == device).all())
+
+    def test_binary_and_csv_uploads(self):
+        points = np.array([[1, 2], [3, 4]], dtype="<f4")
+        self.assertEqual(self.request("POST", "/upload_data?page_id=p", points.tobytes(),
+                                      {"Content-Type": "application/octet-stream"})[0], 200)
+        self.assertEqual(self.request("POST", "/upload_data?page_id=p", b"x,y\n5,6\n",
+                                      {"Content-Type": "text/csv; charset=utf-8"})[0], 200)
+        np.testing.assert_array_equal(self.service.points.page("p").view()["x"], [1, 3, 5])
+
+    def test_bad_line_answers_400_and_keeps_stored_batches(self):
+        small_batches(self)
+        status, _, reply = self.request("POST", "/upload_data?page_id=p", b"[1,2]\n[3,4]\nbad\n",
+                                        {"Content-Type": "application/x-ndjson"})
+        self.assertEqual(status, 400)
+        self.assertIn(b"Line 3", reply)
+        self.assertIn(b"2 points stored", reply)
+        self.assertEqual(self.service.points.count("p"), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import http.client
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from http.server import ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+from heatmap_service import HeatmapService
+from job_queue import JobQueue
+from render_pool import RenderPool
+from server import SimpleRequestHandler
+
+WIDTH, HEIGHT = 200, 150
+
+
+def random_points(count, seed=0, width=WIDTH, height=HEIGHT):
+    rng = np.random.default_rng(seed)
+    return np.column_stack((rng.uniform(0, width, count), rng.uniform(0, height, count)))
+
+
+def wait_until(predicate, timeout=10.0):
+    """
+    Ждёт, пока predicate() не станет истинным; False - не дождались за timeout секунд.
+    """
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+class ServiceTestCase(unittest.TestCase):
+    """
+    Сервис во временной папке. Фоны страниц сервис ищет в images/ текущей папки,
+    поэтому на время теста она становится текущей.
+    """
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        os.makedirs("images")
+        self.service = self.make_service()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def make_service(self, **kwargs):
+        return HeatmapService(cache_dir="cache_images", grid_dir="cache_grids",
+                              background_dir="cache_backgrounds", **kwargs)
+
+    def add_background(self, page_id, size=(WIDTH, HEIGHT)):
+        Image.new("RGBA", size, (255, 255, 255, 255)).save(os.path.join("images", f"{page_id}.png"))
+
+
+class ServerTestCase(ServiceTestCase):
+    """
+    Сервер на свободном порту поверх сервиса теста. Обработчик - подкласс
+    SimpleRequestHandler: его сервис, пул и очередь заданий не видны другим тестам.
+    render_workers > 0 - отрисовка в пуле процессов (как RENDER_WORKERS).
+    Дополнительные серверы (узлы кластера) запускает start_server.
+    """
+
+    render_workers = 0
+    max_pending = 0
+
+    def setUp(self):
+        super().setUp()
+        self.servers = []
+        self.handler, self.httpd = self.start_server(self.service)
+
+    def start_server(self, service):
+        handler = type("Handler", (SimpleRequestHandler,), {"service": service})
+        if self.render_workers > 0:
+            handler.render_pool = RenderPool(self.render_workers, self.max_pending)
+        handler.jobs = JobQueue(service, max(1, self.render_workers), handler.runner())
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        # Частый опрос флага остановки: shutdown иначе ждёт до 0.5 с на каждый сервер
+        threading.Thread(target=httpd.serve_forever, kwargs={"poll_interval": 0.01},
+                         daemon=True).start()
+        self.servers.append((handler, httpd))
+        return handler, httpd
+
+    def tearDown(self):
+        for handler, httpd in self.servers:
+            httpd.shutdown()
+            httpd.server_close()
+            handler.jobs.shutdown()
+            if handler.render_pool is not None:
+                handler.render_pool.shutdown()
+            if handler.cluster is not None:
+                handler.cluster.close()
+        super().tearDown()
+
+    def request(self, method, path, body=None, headers=None, httpd=None):
+        """
+        Возвращает (код, заголовки, тело); dict или list в body отправляется как JSON.
+        httpd - сервер, которому отправить запрос (по умолчанию основной).
+        """
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode("utf-8")
+        connection = http.client.HTTPConnection(*(httpd or self.httpd).server_address, timeout=60)
+        try:
+            connection.request(method, path, body, headers or {})
+            response = connection.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            connection.close()
+
+    def upload(self, page_id, points, **attributes):
+        status, _, body = self.request("POST", f"/upload_data?page_id={page_id}",
+                                       {"points": np.asarray(points).tolist(), **attributes})
+        self.assertEqual(status, 200, body)
@@ -0,0 +1,96 @@
+import math
+
+import numpy as np
+from PIL import Image
+
+from renderer import INTERPOLATIONS, grid_to_rgba
+
+# Размер тайла в пикселях
+TILE_SIZE = 256
+
+
+def max_zoom(width, height, tile_size=TILE_SIZE):
+    """
+    Уровень, на котором тайлы идут в исходном разрешении (1 пиксель фона = 1 пиксель тайла).
+    На уровне 0 вся страница помещается в один тайл.
+    """
+    return max(0, math.ceil(math.log2(max(width, height) / tile_size)))
+
+
+def tile_scale(zoom, top_zoom):
+    """
+    Сколько пикселей тайла приходится на пиксель фона на уровне zoom.
+    """
+    return 2.0 ** (zoom - top_zoom)
+
+
+def tile_count(width, height, scale, tile_size=TILE_SIZE):
+    return math.ceil(width * scale / tile_size), math.ceil(height * scale / tile_size)
+
+
+def pyramid_level(grid_spacing, scale):
+    """
+    Уровень пирамиды плотности (сетка, укрупнённая в 2**level раз), у которого
+    ячейка на тайле не мельче пикселя: более мелкие детали всё равно не видны.
+    """
+    cell_pixels = grid_spacing * scale
+    if cell_pixels >= 1:
+        return 0
+    return math.ceil(math.log2(1 / cell_pixels))
+
+
+def reduce_grid(grid):
+    """
+    Следующий уровень пирамиды: среднее по блокам 2x2 (на нечётном краю - по имеющимся ячейкам).
+    """
+    height, width = grid.shape
+    out_h, out_w = (height + 1) // 2, (width + 1) // 2
+    sums = np.zeros((out_h * 2, out_w * 2), dtype=np.float64)
+    counts = np.zeros((out_h * 2, out_w * 2), dtype=np.float64)
+    sums[:height, :width] = grid
+    counts[:height, :width] = 1
+    sums = sums.reshape(out_h, 2, out_w, 2).sum(axis=(1, 3))
+    counts = counts.reshape(out_h, 2, out_w, 2).sum(axis=(1, 3))
+    return (sums / np.maximum(counts, 1)).astype(np.float32)
+
+
+def render_tile_image(pixels, normalized, cell_size, tile, top_zoom, color, opacity=1.0,
+                      interpolation="nearest", tile_size=TILE_SIZE, with_background=True):
+    """
+    Тайл (z, x, y): участок фона pixels (RGBA, height x width x 4), уменьшенный
+    до масштаба уровня, и поверх него - ячейки нормированной сетки уровня
+    пирамиды размером cell_size пикселей фона. За краем страницы тайл прозрачный.
+    with_background=False - только ячейки карты на прозрачном тайле.
+    """
+    zoom, tile_x, tile_y = tile
+    height, width = pixels.shape[:2]
+    scale = tile_scale(zoom, top_zoom)
+    span = tile_size / scale  # сторона тайла в пикселях фона
+    x0, y0 = tile_x * span, tile_y * span
+    x1, y1 = min(width, x0 + span), min(height, y0 + span)
+    out_w = max(1, round((x1 - x0) * scale))
+    out_h = max(1, round((y1 - y0) * scale))
+
+    layer = Image.new("RGBA", (out_w, out_h), (0, 0, 0, 0))
+    grid_h, grid_w = normalized.shape
+    j0, i0 = int(x0 // cell_size), int(y0 // cell_size)
+    j1 = min(grid_w, math.ceil(x1 / cell_size))
+    i1 = min(grid_h, math.ceil(y1 / cell_size))
+    if j1 > j0 and i1 > i0:
+        cells = grid_to_rgba(np.ascontiguousarray(normalized[i0:i1, j0:j1]), color, opacity)
+        size = (max(1, round((j1 - j0) * cell_size * scale)),
+                max(1, round((i1 - i0) * cell_size * scale)))
+        offset = (round((j0 * cell_size - x0) * scale), round((i0 * cell_size - y0) * scale))
+        layer.paste(cells.resize(size, INTERPOLATIONS[interpolation]), offset)
+
+    result = Image.new("RGBA", (tile_size, tile_size), (0, 0, 0, 0))
+    if not with_background:
+        result.paste(layer, (0, 0))
+        return result
+    region = np.ascontiguousarray(pixels[int(y0):math.ceil(y1), int(x0):math.ceil(x1)])
+    background = Image.fromarray(region, "RGBA")
+    if background.size != (out_w, out_h):
+        background = background.resize((out_w, out_h), Image.Resampling.BILINEAR,
+                                       reducing_gap=2.0)
+    result.paste(Image.alpha_composite(background, layer), (0, 0))
+    return result
@@ -0,0 +1,138 @@
+import io
+import json
+import math
+import os
+import zipfile
+from collections import namedtuple
+
+import numpy as np
+
+from accumulators import DensityAccumulator
+from kde_engine import compute_density, grid_shape
+
+# Ограничения на число накопленных кадров и кадров анимации
+MAX_FRAMES = 1024
+MAX_ANIMATION_FRAMES = 240
+# Накопленные кадры - один массив float32 (и один файл в кэше сеток): ячеек сетки
+# во всех кадрах не больше этого (128 МБ)
+MAX_FRAME_CELLS = 32 * 1024 * 1024
+# Анимированные PNG/GIF собираются в памяти целиком: кадры * пиксели кадра не больше этого
+MAX_ANIMATION_PIXELS = 64 * 1024 * 1024
+
+# Формат ответа -> Content-Type; zip - последовательность PNG-кадров с manifest.json
+ANIMATION_FORMATS = {"apng": "image/png", "gif": "image/gif", "zip": "application/zip"}
+
+# Параметры анимации: интервал накопленных кадров (с), начало и конец (None - по данным),
+# шаг между кадрами, ширина окна (None - накопление от начала), масштаб кадра,
+# кадров в секунду, формат
+Animation = namedtuple("Animation", ["interval", "start", "end", "step", "window", "scale",
+                                     "fps", "format"])
+
+
+def frame_layout(times, interval, frame_cells=0):
+    """
+    Границы кадров origin + k*interval (k = 0..count) для отсортированных времён:
+    кадр k - плотность всех точек с t < origin + k*interval. frame_cells - ячеек
+    сетки в одном кадре (для ограничения памяти под все кадры).
+    """
+    origin = math.floor(times[0] / interval) * interval
+    count = int((times[-1] - origin) // interval) + 1
+    if count > MAX_FRAMES:
+        raise ValueError(f"Too many frames ({count} > {MAX_FRAMES}), increase interval")
+    if (count + 1) * frame_cells > MAX_FRAME_CELLS:
+        raise ValueError(f"Frames are too large ({count + 1} x {frame_cells} cells), "
+                         "increase interval or grid")
+    return origin, count
+
+
+def build_frames(xs, ys, times, rows, width, height, bandwidth, grid_spacing, method, interval):
+    """
+    Накопленные кадры плотности: массив (count + 1, grid_h, grid_w) float32,
+    кадр 0 - пустой. times - времена точек по возрастанию, rows - их номера
+    в xs, ys. Каждая точка попадает в KDE один раз: кадр k = кадр k-1 +
+    плотность точек интервала k (KDE линеен по точкам).
+    """
+    grid_h, grid_w = grid_shape(width, height, grid_spacing)
+    if len(times) == 0:
+        return np.zeros((1, grid_h, grid_w), dtype=np.float32)
+    origin, count = frame_layout(times, interval, grid_h * grid_w)
+    bounds = np.searchsorted(times, origin + np.arange(count + 1) * interval, side="left")
+    frames = np.zeros((count + 1, grid_h, grid_w), dtype=np.float32)
+    accumulator = DensityAccumulator(width, height, bandwidth, grid_spacing, method)
+    for k in range(count):
+        selected = rows[bounds[k]:bounds[k + 1]]
+        accumulator.add((xs[selected], ys[selected]))
+        frames[k + 1] = accumulator.density
+    return frames
+
+
+def window_density(frames, times, rows, xs, ys, t0, t1, interval, width, height,
+                   bandwidth, grid_spacing, method):
+    """
+    Плотность точек с t в [t0, t1): разность двух накопленных кадров плюс
+    остатки у краёв окна, не попавшие на границы кадров (считаются напрямую).
+    """
+    def residual(start, stop):
+        begin, end = np.searchsorted(times, (start, stop), side="left")
+        selected = rows[begin:end]
+        return compute_density((xs[selected], ys[selected]), width, height, bandwidth,
+                               grid_spacing, method)
+
+    if len(times) == 0 or t1 <= t0:
+        return np.zeros(frames.shape[1:], dtype=np.float64)
+    origin = math.floor(times[0] / interval) * interval
+    last = frames.shape[0] - 1
+    k0 = min(last, max(0, math.ceil((t0 - origin) / interval)))
+    k1 = min(last, max(0, math.floor((t1 - origin) / interval)))
+    if k1 <= k0:
+        return residual(t0, t1)
+    density = frames[k1].astype(np.float64) - frames[k0]
+    density += residual(t0, origin + k0 * interval)
+    density += residual(origin + k1 * interval, t1)
+    return np.maximum(density, 0.0)
+
+
+def animation_windows(start, end, step, window=None):
+    """
+    Окна кадров анимации: концы идут от start + step до end с шагом step,
+    окно - последние window секунд (или всё от start, если window не задано).
+    """
+    if step <= 0:
+        raise ValueError("step must be positive")
+    count = max(1, math.ceil((end - start) / step))
+    if count > MAX_ANIMATION_FRAMES:
+        raise ValueError(f"Too many animation frames ({count} > {MAX_ANIMATION_FRAMES})")
+    windows = []
+    for index in range(1, count + 1):
+        stop = min(end, start + index * step)
+        windows.append((start if window is None else max(start, stop - window), stop))
+    return windows
+
+
+def save_animation(images, animation, windows, out_path):
+    """
+    Сохраняет кадры (итератор изображений) анимированным PNG, GIF или zip-архивом
+    PNG-кадров с manifest.json (окно [t0, t1) каждого кадра). Возвращает путь.
+    """
+    tmp_path = f"{out_path}.{os.getpid()}.tmp"
+    duration = round(1000 / animation.fps)
+    if animation.format == "zip":
+        manifest = []
+        with zipfile.ZipFile(tmp_path, "w") as archive:
+            for number, (image, (t0, t1)) in enumerate(zip(images, windows)):
+                name = f"frame_{number:04d}.png"
+                buffer = io.BytesIO()
+                image.save(buffer, format="PNG")
+                archive.writestr(name, buffer.getvalue())
+                manifest.append({"file": name, "t0": t0, "t1": t1})
+            archive.writestr("manifest.json", json.dumps({"frame_ms": duration,
+                                                          "frames": manifest}))
+    else:
+        images = iter(images)
+        if animation.format == "gif":
+            images = (image.convert("RGB") for image in images)
+        first = next(images)
+        first.save(tmp_path, format="PNG" if animation.format == "apng" else "GIF",
+                   save_all=True, append_images=list(images), duration=duration, loop=0)
+    os.replace(tmp_path, out_path)
+    return out_path
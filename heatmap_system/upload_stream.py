@@ -0,0 +1,171 @@
+import csv
+import json
+
+import numpy as np
+
+# Размер куска, которым читается тело запроса
+CHUNK_BYTES = 1 << 20
+# Сколько точек накапливается перед записью в хранилище
+BATCH_POINTS = 1 << 16
+# Максимальная длина строки NDJSON/CSV
+MAX_LINE_BYTES = 1 << 20
+
+# Бинарный формат: пары x, y в float32 little-endian, 8 байт на точку
+BINARY_POINT_SIZE = 8
+
+CSV_COORDINATES = ("x", "y", "t")
+
+
+def iter_body(rfile, headers):
+    """
+    Тело запроса кусками не больше CHUNK_BYTES:
+    по Content-Length или в режиме Transfer-Encoding: chunked.
+    """
+    if "chunked" in headers.get("Transfer-Encoding", "").lower():
+        yield from iter_chunked(rfile)
+        return
+    remaining = int(headers.get("Content-Length", 0))
+    while remaining > 0:
+        chunk = rfile.read(min(CHUNK_BYTES, remaining))
+        if not chunk:
+            raise ValueError("Request body ended early")
+        remaining -= len(chunk)
+        yield chunk
+
+
+def iter_chunked(rfile):
+    while True:
+        size_line = rfile.readline(MAX_LINE_BYTES)
+        if not size_line.endswith(b"\n"):
+            raise ValueError("Malformed chunk header")
+        try:
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+        except ValueError:
+            raise ValueError("Malformed chunk size") from None
+        if size == 0:
+            # Трейлеры до пустой строки
+            while rfile.readline(MAX_LINE_BYTES).strip():
+                pass
+            return
+        while size > 0:
+            chunk = rfile.read(min(CHUNK_BYTES, size))
+            if not chunk:
+                raise ValueError("Request body ended early")
+            size -= len(chunk)
+            yield chunk
+        if rfile.readline(MAX_LINE_BYTES).strip():
+            raise ValueError("Malformed chunk terminator")
+
+
+def iter_lines(chunks):
+    """
+    Строки (номер, bytes) из потока кусков; хвост без перевода строки - последняя строка.
+    """
+    tail = b""
+    number = 0
+    for chunk in chunks:
+        lines = (tail + chunk).split(b"\n")
+        tail = lines.pop()
+        if len(tail) > MAX_LINE_BYTES:
+            raise ValueError(f"Line {number + len(lines) + 1} is too long")
+        for line in lines:
+            number += 1
+            yield number, line
+    if tail:
+        yield number + 1, tail
+
+
+def ndjson_batches(chunks):
+    """
+    Одна точка на строку: [x, y], [x, y, t] или объект, как в JSON-загрузке.
+    """
+    batch = []
+    for number, line in iter_lines(chunks):
+        if not line.strip():
+            continue
+        try:
+            batch.append(json.loads(line))
+        except ValueError as e:
+            raise ValueError(f"Line {number}: {e}") from None
+        if len(batch) >= BATCH_POINTS:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def csv_batches(chunks):
+    """
+    CSV с заголовком (x, y и любые из t, session, user, gender, age, device)
+    или без него (столбцы x, y[, t]).
+    """
+    columns = None
+    batch = []
+    for number, line in iter_lines(chunks):
+        text = line.decode("utf-8").rstrip("\r")
+        if not text.strip():
+            continue
+        row = [field.strip() for field in next(csv.reader([text]))]
+        if columns is None:
+            columns = _csv_header(row)
+            if columns is not None:
+                continue
+            columns = CSV_COORDINATES[:len(row)]
+        if len(row) != len(columns):
+            raise ValueError(f"Line {number}: expected {len(columns)} fields, got {len(row)}")
+        try:
+            if columns == CSV_COORDINATES[:len(columns)]:
+                batch.append([float(value) for value in row])
+            else:
+                point = {name: value for name, value in zip(columns, row) if value != ""}
+                for name in CSV_COORDINATES:
+                    if name in point:
+                        point[name] = float(point[name])
+                batch.append(point)
+        except ValueError as e:
+            raise ValueError(f"Line {number}: {e}") from None
+        if len(batch) >= BATCH_POINTS:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _csv_header(row):
+    try:
+        [float(value) for value in row]
+        return None
+    except ValueError:
+        pass
+    columns = tuple(name.lower() for name in row)
+    if "x" not in columns or "y" not in columns:
+        raise ValueError("CSV header must contain x and y")
+    return columns
+
+
+def binary_batches(chunks):
+    """
+    Упакованные пары float32 little-endian (x, y) - массивы формы (n, 2).
+    """
+    tail = b""
+    for chunk in chunks:
+        data = tail + chunk
+        usable = len(data) - len(data) % BINARY_POINT_SIZE
+        tail = data[usable:]
+        if usable:
+            yield np.frombuffer(data, dtype="<f4", count=usable // 4).reshape(-1, 2)
+    if tail:
+        raise ValueError(f"Binary body size is not a multiple of {BINARY_POINT_SIZE} bytes")
+
+
+# Форматы потоковой загрузки по Content-Type
+STREAM_FORMATS = {
+    "application/x-ndjson": ndjson_batches,
+    "application/ndjson": ndjson_batches,
+    "text/csv": csv_batches,
+    "application/octet-stream": binary_batches,
+}
+
+
+def stream_batches(content_type, chunks):
+    return STREAM_FORMATS[content_type](chunks)